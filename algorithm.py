@@ -1,5 +1,7 @@
 import abc
 import concurrent.futures
+import heapq
+import itertools
 import random
 import tempfile
 
@@ -8,8 +10,7 @@ import datetime
 import os
 import webbrowser
 
-import pypandoc
-import tqdm
+from instrumentation import METRICS
 
 
 class Algorithm(abc.ABC):
@@ -19,18 +20,32 @@ class Algorithm(abc.ABC):
         '''called by TiddlyWiki.apply and implements the visitor pattern'''
 
 
+def reservoir_sample(iterable, k, rng=random):
+    '''returns a list of k items drawn uniformly at random from iterable
+    in a single pass, without materializing iterable (reservoir sampling).
+    if iterable has fewer than k items, all of them are returned.
+    '''
+    reservoir = []
+    for index, item in enumerate(iterable):
+        if index < k:
+            reservoir.append(item)
+        else:
+            j = rng.randrange(index + 1)
+            if j < k:
+                reservoir[j] = item
+    return reservoir
+
+
 class GetRandomTiddler(Algorithm):
 
     def __init__(self, *predicates):
         self.predicates = predicates
 
     def evaluate(self, tiddl_wiki):
-        if self.predicates is None:
-            available = tiddl_wiki.tiddlers
-        else:
-            available = list(tiddl_wiki.apply(FindAllTiddlers(*self.predicates)))
-
-        return random.choice(available)
+        sample = reservoir_sample(tiddl_wiki.apply(FindAllTiddlers(*self.predicates)), 1)
+        if not sample:
+            raise IndexError('no tiddler satisfies the predicates')
+        return sample[0]
 
 
 class FindTiddler(Algorithm):
@@ -56,12 +71,94 @@ class FindAllTiddlers(Algorithm):
             if all(p(tiddler) for p in self.predicates):
                 yield tiddler
 
+
+class Pipeline(Algorithm):
+    '''a lazy, composable chain of stages (filter, sort, limit, sample, map, group).
+    every stage returns a new Pipeline, the stages are only run when the pipeline
+    is applied to a TiddlyWiki, e.g.
+
+        newest = tiddly_wiki.apply(Pipeline().filter(p).sort(key, reverse=True).limit(50))
+
+    adjacent stages are fused: consecutive filters are checked in one pass,
+    sort followed by limit is a heap-based top-k selection and sample is a
+    single-pass reservoir sampling, so the wiki is never fully materialized or
+    sorted unless a stage needs it.
+    evaluate returns an iterator, or a dict of lists if the last stage is group.
+    '''
+
+    def __init__(self, stages=()):
+        self.stages = tuple(stages)
+
+    def __then(self, name, *args):
+        if self.stages and self.stages[-1][0] == 'group':
+            raise ValueError('group must be the last stage of a pipeline')
+        return type(self)(self.stages + ((name, args),))
+
+    def filter(self, *predicates):
+        return self.__then('filter', predicates)
+
+    def sort(self, key=None, reverse=False):
+        return self.__then('sort', key, reverse)
+
+    def limit(self, n):
+        return self.__then('limit', n)
+
+    def sample(self, k, rng=random):
+        return self.__then('sample', k, rng)
+
+    def map(self, function):
+        return self.__then('map', function)
+
+    def group(self, key):
+        return self.__then('group', key)
+
+    def evaluate(self, tiddly_wiki):
+        iterator = iter(tiddly_wiki)
+        stages = list(self.stages)
+
+        while stages:
+            name, args = stages.pop(0)
+
+            if name == 'filter':
+                predicates = list(args[0])
+                while stages and stages[0][0] == 'filter':
+                    predicates.extend(stages.pop(0)[1][0])
+                iterator = (t for t in iterator if all(p(t) for p in predicates))
+
+            elif name == 'sort':
+                key, reverse = args
+                if stages and stages[0][0] == 'limit':
+                    n = stages.pop(0)[1][0]
+                    select = heapq.nlargest if reverse else heapq.nsmallest
+                    iterator = iter(select(n, iterator, key=key))
+                else:
+                    iterator = iter(sorted(iterator, key=key, reverse=reverse))
+
+            elif name == 'limit':
+                iterator = itertools.islice(iterator, args[0])
+
+            elif name == 'sample':
+                k, rng = args
+                iterator = iter(reservoir_sample(iterator, k, rng))
+
+            elif name == 'map':
+                iterator = map(args[0], iterator)
+
+            elif name == 'group':
+                groups = {}
+                for item in iterator:
+                    groups.setdefault(args[0](item), []).append(item)
+                return groups
+
+        return iterator
+
 # TODO: non-linear toc?
 class ExportToFile(Algorithm):
 
     MAX_WORKERS = os.cpu_count()
 
-    def __init__(self, path, *extra_args, format=None, predicates=None, key=None):
+    def __init__(self, path, *extra_args, format=None, predicates=None, key=None,
+                 reverse=False, limit=None):
         self.path = path
         self.extra_args = extra_args
         if format is None:
@@ -73,24 +170,27 @@ class ExportToFile(Algorithm):
             self.key = lambda t: t.created
         else:
             self.key = key
+        self.reverse = reverse
+        self.limit = limit
 
     def __get_tiddlers(self, tiddly_wiki):
+        pipeline = Pipeline()
         if self.predicates is not None:
-            tiddlers = list(tiddly_wiki.apply(FindAllTiddlers(*self.predicates)))
-        else:
-            tiddlers = list(tiddly_wiki)
-        return tiddlers
+            pipeline = pipeline.filter(*self.predicates)
+        if self.limit is not None:
+            pipeline = pipeline.sort(self.key, self.reverse).limit(self.limit)
+        return list(tiddly_wiki.apply(pipeline))
 
     def __get_safe_tiddlers(self, iterable_tiddlers):
         safe_tiddlers = []
         non_safe_tiddlers = []
 
-        for tiddler in tqdm.tqdm(iterable_tiddlers):
+        for tiddler in METRICS.progress(iterable_tiddlers, desc='safety check'):
             with tempfile.NamedTemporaryFile('w', suffix='.'+self.format) as fh:
                 try:
                     tiddler.export_to_file(fh.name)
                 except RuntimeError as error:
-                    print(error)
+                    METRICS.progress.message(error)
                     non_safe_tiddlers.append(tiddler)
                 else:
                     safe_tiddlers.append(tiddler)
@@ -109,12 +209,12 @@ class ExportToFile(Algorithm):
             safe_tiddlers = []
             non_safe_tiddlers = []
             futures = concurrent.futures.as_completed(future_to_tiddler.keys())
-            for future in tqdm.tqdm(futures, total=len(future_to_tiddler)):
+            for future in METRICS.progress(futures, total=len(future_to_tiddler), desc='safety check'):
                 tiddler = future_to_tiddler[future]
                 try:
                     future.result()
                 except RuntimeError as error:
-                    print(error)
+                    METRICS.progress.message(error)
                     non_safe_tiddlers.append(tiddler)
                 else:
                     safe_tiddlers.append(tiddler)
@@ -128,7 +228,7 @@ class ExportToFile(Algorithm):
         else:
             safe_tiddlers = tiddlers
             non_safe_tiddlers = []
-        safe_tiddlers.sort(key=self.key)
+        safe_tiddlers.sort(key=self.key, reverse=self.reverse)
 
         with tempfile.NamedTemporaryFile('w', suffix='.md', delete=False) as fh:
             title = '% {}\n' \
@@ -138,7 +238,7 @@ class ExportToFile(Algorithm):
                                       str(datetime.date.today()))
             fh.write(title)
 
-            for tiddler in tqdm.tqdm(safe_tiddlers):
+            for tiddler in METRICS.progress(safe_tiddlers, desc='export'):
                 if self.format in {'pdf'}:
                     encoding = 'latin-1'
                 else:
@@ -147,23 +247,24 @@ class ExportToFile(Algorithm):
                 fh.write(tiddler_md)
                 fh.write('\n\n---\n\n---\n\n')
 
-        pypandoc.convert_file(fh.name,
-                              self.format,
-                              format='md',
-                              outputfile=self.path,
-                              extra_args=self.extra_args)
+        METRICS.convert_file(fh.name,
+                             self.format,
+                             format='md',
+                             outputfile=self.path,
+                             extra_args=self.extra_args)
 
         if non_safe_tiddlers:
             msg = 'Could only export {} out of {} tiddlers.'
-            print(msg.format(len(safe_tiddlers), len(tiddlers)))
-            print("The following tiddlers raised a pandoc error:")
+            METRICS.progress.message(msg.format(len(safe_tiddlers), len(tiddlers)))
+            METRICS.progress.message("The following tiddlers raised a pandoc error:")
             for tiddler in non_safe_tiddlers:
-                print("\t{}".format(tiddler.title))
+                METRICS.progress.message("\t{}".format(tiddler.title))
 
 
 class OpenInBrowser(Algorithm):
 
-    def __init__(self, *extra_args, format='html', predicates=None, key=None):
+    def __init__(self, *extra_args, format='html', predicates=None, key=None,
+                 reverse=False, limit=None):
         self.extra_args = extra_args
         self.format = format
         self.predicates = predicates
@@ -171,17 +272,20 @@ class OpenInBrowser(Algorithm):
             self.key = lambda t: t.created
         else:
             self.key = key
+        self.reverse = reverse
+        self.limit = limit
 
     def __get_tiddlers(self, tiddly_wiki):
+        pipeline = Pipeline()
         if self.predicates is not None:
-            tiddlers = list(tiddly_wiki.apply(FindAllTiddlers(*self.predicates)))
-        else:
-            tiddlers = list(tiddly_wiki)
-        return tiddlers
+            pipeline = pipeline.filter(*self.predicates)
+        if self.limit is not None:
+            pipeline = pipeline.sort(self.key, self.reverse).limit(self.limit)
+        return list(tiddly_wiki.apply(pipeline))
 
     def evaluate(self, tiddly_wiki):
         tiddlers = self.__get_tiddlers(tiddly_wiki)
-        tiddlers.sort(key=self.key)
+        tiddlers.sort(key=self.key, reverse=self.reverse)
         with tempfile.NamedTemporaryFile('w', suffix='.'+self.format, delete=False) as fh:
             title = '% {}\n' \
                     '% {}\n' \
@@ -190,7 +294,7 @@ class OpenInBrowser(Algorithm):
                                       str(datetime.date.today()))
             result = title
 
-            for tiddler in tqdm.tqdm(tiddlers):
+            for tiddler in METRICS.progress(tiddlers, desc='export'):
                 if self.format in {'pdf'}:
                     encoding = 'latin-1'
                 else:
@@ -199,10 +303,10 @@ class OpenInBrowser(Algorithm):
                 result += tiddler_md
                 result += '\n\n---\n\n---\n\n'
 
-            pypandoc.convert_text(result,
-                                  self.format,
-                                  format='md',
-                                  outputfile=fh.name,
-                                  extra_args=self.extra_args)
+            METRICS.convert_text(result,
+                                 self.format,
+                                 format='md',
+                                 outputfile=fh.name,
+                                 extra_args=self.extra_args)
             webbrowser.get(using='chrome').open('file://' + fh.name, new=1)
 
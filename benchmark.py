@@ -0,0 +1,276 @@
+"""reproducible benchmarks of PyTiddlyWiki on synthetic wikis, see synthwiki.py
+
+    python benchmark.py --tiddlers 2000 --stub-pandoc --output bench.json
+    python benchmark.py --tiddlers 2000 --stub-pandoc --compare bench.json
+    python benchmark.py --only pathological --pathological-size 100000
+
+results are written as json, so that runs on different commits can be compared.
+"""
+import argparse
+import contextlib
+import gc
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import pypandoc
+
+from algorithm import Pipeline
+from instrumentation import METRICS, NullProgress
+from synthwiki import PathologicalCorpus, SyntheticWiki
+from tiddler import Tiddler
+from tiddlywiki import TiddlyWiki
+
+
+BENCHMARKS = ('parse', 'search', 'convert', 'export_tiddler', 'export_wiki', 'diff', 'pathological')
+
+
+@contextlib.contextmanager
+def stubbed_pandoc():
+    '''replaces pypandoc.convert_text and pypandoc.convert_file by identity conversions,
+    so that only the python (cpu) part of an export is measured.
+    '''
+    def convert_text(source, to, format=None, extra_args=(), encoding='utf-8', outputfile=None, **kwargs):
+        if outputfile is None:
+            return source
+        with open(outputfile, 'w', encoding=encoding) as fh:
+            fh.write(source)
+        return ''
+
+    def convert_file(source_file, to, format=None, extra_args=(), encoding='utf-8', outputfile=None, **kwargs):
+        with open(source_file, 'r', encoding=encoding) as fh:
+            return convert_text(fh.read(), to, format, extra_args, encoding, outputfile)
+
+    original = pypandoc.convert_text, pypandoc.convert_file
+    pypandoc.convert_text, pypandoc.convert_file = convert_text, convert_file
+    try:
+        yield
+    finally:
+        pypandoc.convert_text, pypandoc.convert_file = original
+
+
+def measure(function, repeat):
+    '''calls function repeat times and returns timing statistics in seconds.
+    the garbage collector is disabled while timing, as timeit does.
+    '''
+    timings = []
+    for _ in range(repeat):
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            t0 = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - t0)
+        finally:
+            if enabled:
+                gc.enable()
+    return {'repeat': repeat,
+            'min': min(timings),
+            'median': statistics.median(timings),
+            'mean': statistics.mean(timings)}
+
+
+def run_pathological(args):
+    '''times parsing and conversion of the PathologicalCorpus at 1, 2 and 4 times --pathological-size.
+    the exponent log2(t(4 size) / t(2 size)) is 1 for linear time and 2 for quadratic time.
+    '''
+    results = {}
+    sizes = [args.pathological_size * factor for factor in (1, 2, 4)]
+
+    cases = []
+    for name in PathologicalCorpus.TEXTS:
+        cases.append((name + '/md', lambda text: Tiddler.convert_tw5_to_md(text), PathologicalCorpus.texts))
+        cases.append((name + '/ast', lambda text: Tiddler.convert_tw5_to_ast(text), PathologicalCorpus.texts))
+        cases.append((name + '/tags', lambda text: Tiddler.get_tag_list(text), PathologicalCorpus.texts))
+    for name in PathologicalCorpus.STORES:
+        cases.append((name + '/parse', lambda html: TiddlyWiki.parse_from_string(html), PathologicalCorpus.stores))
+
+    inputs = {size: {} for size in sizes}
+    for label, function, corpus in cases:
+        name = label.split('/')[0]
+        timings = []
+        for size in sizes:
+            if corpus not in inputs[size]:
+                inputs[size][corpus] = corpus(size)
+            text = inputs[size][corpus][name]
+            timings.append(measure(lambda: function(text), args.repeat)['min'])
+
+        exponent = math.log2(timings[2] / timings[1]) if timings[1] > 0 else 0.0
+        key = 'pathological[{}]'.format(label)
+        results[key] = {'repeat': args.repeat, 'sizes': sizes, 'min': timings[-1], 'median': timings[-1],
+                        'timings': timings, 'exponent': exponent}
+        flag = '  <-- super-linear' if exponent > args.max_exponent else ''
+        print('{:<44} {:.4f}s  exponent {:.2f}{}'.format(key, timings[-1], exponent, flag), file=sys.stderr)
+
+    return results
+
+
+def run(args):
+    results = {}
+    stores = ('div', 'json') if args.store == 'both' else (args.store,)
+
+    if 'pathological' in args.only:
+        results.update(run_pathological(args))
+    benchmarks = [name for name in args.only if name != 'pathological']
+    if not benchmarks:
+        return results
+
+    for store in stores:
+        synthetic = SyntheticWiki(tiddlers=args.tiddlers, body_size=args.body_size,
+                                  tag_count=args.tags, images=args.images,
+                                  image_size=args.image_size, store=store, seed=args.seed)
+        html = synthetic.html()
+        tw5 = TiddlyWiki.parse_from_string(html)
+        texts = [t for t in tw5 if t.type_ == 'text/vnd.tiddlywiki']
+        export_sample = texts[:args.export_count]
+
+        def parse():
+            TiddlyWiki.parse_from_string(html)
+
+        def search():
+            list(tw5.finditer(lambda t: 'tag1' in t.tags))
+            tw5.find_tiddler(lambda t: t.title == 'no such tiddler')
+            list(tw5.apply(Pipeline().filter(lambda t: t.tags).sort(lambda t: t.modified, reverse=True).limit(50)))
+            tw5.get_random_tiddler(lambda t: 'tag2' in t.tags)
+
+        def convert():
+            for tiddler in texts:
+                Tiddler.convert_tw5_to_md(tiddler.content)
+
+        def export_tiddler():
+            for tiddler in export_sample:
+                tiddler.export(backend=args.backend)
+
+        def export_wiki():
+            with tempfile.TemporaryDirectory() as tmp:
+                tw5.export_to_file(os.path.join(tmp, 'wiki.' + args.format),
+                                   predicates=[lambda t: t in export_sample],
+                                   backend=args.backend)
+
+        # a second copy with every 100th tiddler changed, diffed and merged with the first one
+        edited = TiddlyWiki.parse_from_string(html) if 'diff' in benchmarks else None
+        for tiddler in list(edited or ())[::100]:
+            tiddler.content += '\nedited'
+
+        def diff():
+            tw5.diff(edited)
+            edited.merge(tw5, tw5)
+
+        functions = {'parse': parse, 'search': search, 'convert': convert,
+                     'export_tiddler': export_tiddler, 'export_wiki': export_wiki, 'diff': diff}
+
+        for name in benchmarks:
+            label = '{}[{}]'.format(name, store)
+            results[label] = measure(functions[name], args.repeat)
+            print('{:<24} median {:.4f}s  min {:.4f}s'.format(label, results[label]['median'],
+                                                               results[label]['min']),
+                  file=sys.stderr)
+
+    return results
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    if args.stub_pandoc:
+        pandoc = 'stub'
+    else:
+        try:
+            pandoc = pypandoc.get_pandoc_version()
+        except OSError:
+            pandoc = None
+
+    return {'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pandoc': pandoc,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'params': {key: value for key, value in vars(args).items()
+                       if key not in {'output', 'compare'}}}
+
+
+def compare(old, new, threshold):
+    '''prints the ratio new/old of the median timings, returns the list of regressions.'''
+    regressions = []
+    print('{:<24} {:>10} {:>10} {:>7}'.format('benchmark', 'old', 'new', 'ratio'))
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before = old['results'][name]['median']
+        after = result['median']
+        ratio = after / before if before else float('inf')
+        flag = '  <-- regression' if ratio > 1 + threshold else ''
+        print('{:<24} {:>9.4f}s {:>9.4f}s {:>7.2f}{}'.format(name, before, after, ratio, flag))
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tiddlers', type=int, default=1000)
+    parser.add_argument('--body-size', type=int, default=500)
+    parser.add_argument('--tags', type=int, default=20, help='tag cardinality')
+    parser.add_argument('--images', type=int, default=0, help='number of embedded image tiddlers')
+    parser.add_argument('--image-size', type=int, default=2048)
+    parser.add_argument('--store', choices=('div', 'json', 'both'), default='both')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--export-count', type=int, default=50,
+                        help='number of tiddlers exported in export_tiddler and export_wiki')
+    parser.add_argument('--format', default='md', help='output format of export_wiki')
+    parser.add_argument('--backend', choices=('markdown', 'ast'), default='markdown',
+                        help='export backend of export_tiddler and export_wiki')
+    parser.add_argument('--only', type=lambda s: s.split(','), default=list(BENCHMARKS),
+                        help='comma separated subset of ' + ','.join(BENCHMARKS))
+    parser.add_argument('--stub-pandoc', action='store_true',
+                        help='replace pandoc by an identity conversion (cpu-only run)')
+    parser.add_argument('--pathological-size', type=int, default=50000,
+                        help='smallest input size (characters) of the pathological benchmark')
+    parser.add_argument('--max-exponent', type=float, default=1.5,
+                        help='growth exponent reported as super-linear by the pathological benchmark')
+    parser.add_argument('--output', help='write the results as json to this file')
+    parser.add_argument('--compare', help='json results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as regression by --compare')
+    args = parser.parse_args(argv)
+
+    unknown = set(args.only) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(sorted(unknown)))
+
+    METRICS.progress = NullProgress()
+    METRICS.reset()
+    with stubbed_pandoc() if args.stub_pandoc else contextlib.nullcontext():
+        report = {'meta': metadata(args), 'results': run(args), 'metrics': METRICS.summary()}
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    super_linear = [name for name, result in report['results'].items()
+                    if result.get('exponent', 0.0) > args.max_exponent]
+
+    if args.compare:
+        with open(args.compare) as fh:
+            regressions = compare(json.load(fh), report, args.threshold)
+        return 1 if regressions or super_linear else 0
+
+    return 1 if super_linear else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
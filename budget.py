@@ -0,0 +1,49 @@
+import time
+
+
+class BudgetExceeded(Exception):
+    '''raised when the conversion of a tiddler exceeds its Budget.
+    reason is 'size' or 'time'.
+    '''
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+class Deadline:
+    '''the time budget of one conversion, checked cooperatively between its steps.'''
+
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.end = None if seconds is None else time.perf_counter() + seconds
+
+    def check(self):
+        if self.end is not None and time.perf_counter() > self.end:
+            raise BudgetExceeded('time', 'conversion took more than {} seconds'.format(self.seconds))
+
+
+class Budget:
+    '''per-tiddler limits of the conversion of tw5 content:
+    max_size characters of content and max_seconds per conversion (None for no limit).
+    a tiddler exceeding its budget is exported as raw text (a code block) instead, e.g.
+
+        Tiddler.budget = Budget(max_size=200000, max_seconds=2)
+
+    as the conversions take linear time in the size of the content,
+    max_size bounds their time, too. max_seconds guards against a slow machine or a huge constant.
+    '''
+
+    def __init__(self, max_size=None, max_seconds=None):
+        self.max_size = max_size
+        self.max_seconds = max_seconds
+
+    def start(self, text):
+        '''checks the size of text and returns the Deadline of its conversion.'''
+        if self.max_size is not None and len(text) > self.max_size:
+            msg = 'content of {} characters exceeds the budget of {}'
+            raise BudgetExceeded('size', msg.format(len(text), self.max_size))
+        return Deadline(self.max_seconds)
+
+
+UNLIMITED = Budget()
@@ -0,0 +1,381 @@
+import functools
+import json
+import re
+
+from instrumentation import METRICS
+
+
+# pandoc json ast nodes, see https://hackage.haskell.org/package/pandoc-types
+NULL_ATTR = ['', [], []]
+SPACE = {'t': 'Space'}
+SOFT_BREAK = {'t': 'SoftBreak'}
+HORIZONTAL_RULE = {'t': 'HorizontalRule'}
+
+# used if the api version cannot be read from pandoc, e.g. with a stubbed pandoc
+DEFAULT_API_VERSION = [1, 23, 1]
+
+
+@functools.lru_cache(maxsize=None)
+def api_version():
+    '''returns the pandoc-api-version of the installed pandoc (one pandoc call per process).
+    pandoc only reads json documents of its own api version.
+    '''
+    try:
+        return json.loads(METRICS.convert_text('', 'json', format='md'))['pandoc-api-version']
+    except (ValueError, KeyError):
+        return DEFAULT_API_VERSION
+
+
+def document(blocks, title=None, subtitle=None, date=None):
+    '''returns a pandoc json document of blocks with the same title block as
+    the markdown header '% title\\n% subtitle\\n% date' of the markdown export.
+    '''
+    meta = {}
+    if title is not None:
+        meta['title'] = {'t': 'MetaInlines', 'c': text_to_inlines(title)}
+    if subtitle is not None:
+        meta['author'] = {'t': 'MetaList', 'c': [{'t': 'MetaInlines', 'c': text_to_inlines(subtitle)}]}
+    if date is not None:
+        meta['date'] = {'t': 'MetaInlines', 'c': text_to_inlines(date)}
+    return {'pandoc-api-version': api_version(), 'meta': meta, 'blocks': assign_identifiers(blocks)}
+
+
+def assign_identifiers(blocks, used=None):
+    '''gives each header without identifier a unique identifier derived from its text
+    (as pandoc does when reading markdown), so that a table of contents can link to it.
+    headers nested in lists, block quotes and divs are numbered in document order with the others.
+    '''
+    if used is None:
+        used = set()
+    if isinstance(blocks, list):
+        for child in blocks:
+            assign_identifiers(child, used)
+    elif isinstance(blocks, dict):
+        if blocks.get('t') == 'Header':
+            level, attr, inlines = blocks['c']
+            identifier = attr[0]
+            if not identifier:
+                # pandoc keeps alphanumerics, _-. and spaces and drops everything up to the first letter
+                identifier = re.sub('[^\\w\\-. ]', '', stringify(inlines).lower()).strip()
+                identifier = re.sub('^[\\W\\d_]*', '', re.sub('\\s+', '-', identifier))
+            identifier = identifier or 'section'
+            unique, n = identifier, 0
+            while unique in used:
+                n += 1
+                unique = '{}-{}'.format(identifier, n)
+            used.add(unique)
+            blocks['c'] = [level, [unique] + attr[1:], inlines]
+        else:
+            assign_identifiers(blocks.get('c'), used)
+    return blocks
+
+
+def rewrite_images(node, images):
+    '''replaces the targets of images whose target is a key of images (in place),
+    e.g. the title of an image tiddler by the path of its asset file.
+    '''
+    if isinstance(node, list):
+        for child in node:
+            rewrite_images(child, images)
+    elif isinstance(node, dict):
+        if node.get('t') == 'Image':
+            attr, alt, (target, title) = node['c']
+            path = images.get(target)
+            if path is not None:
+                node['c'] = [attr, alt or text_to_inlines(target), [path, title]]
+        else:
+            rewrite_images(node.get('c'), images)
+    return node
+
+
+def stringify(inlines):
+    result = []
+    for inline in inlines:
+        if inline['t'] == 'Str':
+            result.append(inline['c'])
+        elif inline['t'] in {'Space', 'SoftBreak', 'LineBreak'}:
+            result.append(' ')
+        elif inline['t'] in {'Strong', 'Emph', 'Strikeout', 'Superscript', 'Subscript'}:
+            result.append(stringify(inline['c']))
+        elif inline['t'] in {'Link', 'Image'}:
+            result.append(stringify(inline['c'][1]))
+        elif inline['t'] in {'Code', 'Math'}:
+            result.append(inline['c'][1])
+    return ''.join(result)
+
+
+def text_to_inlines(text):
+    '''converts plain text (no markup) to Str, Space and SoftBreak inlines.'''
+    inlines = []
+    for token in re.split('(\\s+)', text):
+        if not token:
+            continue
+        if token.isspace():
+            inlines.append(SOFT_BREAK if '\n' in token else SPACE)
+        else:
+            inlines.append({'t': 'Str', 'c': token})
+    return inlines
+
+
+class ConvertASTMixin:
+
+    # inline markup: the opening delimiter, the closing delimiter and the ast node
+    INLINE_PAIRS = {"''": ("''", 'Strong'),
+                    '//': ('//', 'Emph'),
+                    '~~': ('~~', 'Strikeout'),
+                    '^^': ('^^', 'Superscript'),
+                    ',,': (',,', 'Subscript')}
+
+    # urls are matched first, so that their '//' is not taken for italics
+    RE_INLINE = re.compile("(?P<url>(?:https?|ftp|file)://[^\\s\\]|]+)"
+                           "|\\[img(?P<options>[^\\[\\]]*)\\[(?P<source>[^\\[\\]]*)\\]\\]"
+                           "|''|//|~~|\\^\\^|,,|`|\\$\\$|\\[\\[|~")
+
+    RE_HEADING = re.compile('[\\t ]*(?P<level>!+)[!\\t ]*(?P<text>.*)')
+    RE_LIST_ITEM = re.compile('[\\t ]*(?P<markers>[*#]+)[*#\\t ]*(?P<text>.*)')
+    RE_SEPARATOR = re.compile('-{3,}[\\t ]*')
+    # a ~ in front of a CamelCase word keeps tiddlywiki from linking it
+    RE_CAMEL_CASE = re.compile('[A-Z][a-z0-9_\\-]+[A-Z]')
+
+    # deeper list items are flattened to this depth, which bounds the recursion of build_lists
+    MAX_LIST_DEPTH = 16
+
+    @staticmethod
+    def unescape_html(text):
+        '''converts the html entities of the <div> store area back to characters.'''
+        return (text.replace('&lt;', '<')
+                    .replace('&gt;', '>')
+                    .replace('&quot;', '"')
+                    .replace('&amp;', '&'))
+
+    @classmethod
+    def convert_tw5_to_ast(cls, text, deadline=None):
+        """convert a tw5-flavored text to a list of pandoc json ast blocks.
+        takes linear time in the length of text, deadline (see budget.Deadline) is checked per line.
+        """
+        assert isinstance(text, str)
+        return cls.parse_blocks(cls.unescape_html(text).split('\n'), deadline)
+
+    @classmethod
+    def parse_blocks(cls, lines, deadline=None):
+        blocks = []
+        paragraph = []
+        # the first line without closing line after it, per kind of block,
+        # so that unclosed blocks do not scan the remaining lines again
+        unclosed = {}
+
+        def flush():
+            if paragraph:
+                blocks.append({'t': 'Para', 'c': cls.parse_inlines('\n'.join(paragraph))})
+                del paragraph[:]
+
+        def closing(start, kind, test):
+            if start >= unclosed.get(kind, len(lines) + 1):
+                return None
+            for j in range(start, len(lines)):
+                if test(lines[j]):
+                    return j
+            unclosed[kind] = start
+            return None
+
+        i = 0
+        while i < len(lines):
+            if deadline is not None:
+                deadline.check()
+            line = lines[i]
+            stripped = line.strip()
+
+            if not stripped:
+                flush()
+                i += 1
+                continue
+
+            # display math $$\n...\n$$
+            if stripped == '$$':
+                j = closing(i + 1, '$$', lambda l: l.strip() == '$$')
+                if j is not None:
+                    flush()
+                    math = '\n'.join(lines[i + 1:j])
+                    blocks.append({'t': 'Para', 'c': [{'t': 'Math', 'c': [{'t': 'DisplayMath'}, math]}]})
+                    i = j + 1
+                    continue
+
+            # multiline environment """\n...\n"""
+            if stripped == '"""':
+                j = closing(i + 1, '"""', lambda l: l.strip() == '"""')
+                if j is not None:
+                    flush()
+                    blocks.append({'t': 'LineBlock', 'c': [cls.parse_inlines(l) for l in lines[i + 1:j]]})
+                    i = j + 1
+                    continue
+
+            # code block ```lang\n...\n```
+            if stripped.startswith('```'):
+                j = closing(i + 1, '```', lambda l: l.strip() == '```')
+                if j is not None:
+                    flush()
+                    language = stripped[3:].strip()
+                    attr = ['', [language] if language else [], []]
+                    blocks.append({'t': 'CodeBlock', 'c': [attr, '\n'.join(lines[i + 1:j])]})
+                    i = j + 1
+                    continue
+
+            # block quote <<<...<<< reference, as in convert_tw5_to_md the closing <<<
+            # may be anywhere in a line, the rest of that line is the reference
+            if line.startswith('<<<'):
+                first = line[3:]
+                j = i if '<<<' in first else closing(i + 1, '<<<', lambda l: '<<<' in l)
+                if j is not None:
+                    flush()
+                    inner = [first.lstrip()] + lines[i + 1:j + 1]
+                    end = inner[-1].index('<<<')
+                    inner[-1], reference = inner[-1][:end], inner[-1][end + 3:].strip()
+                    quote = cls.parse_blocks(inner, deadline)
+                    if reference:
+                        reference = cls.parse_inlines('({})'.format(reference))
+                        if quote and quote[-1]['t'] == 'Para':
+                            quote[-1]['c'].extend([SPACE] + reference)
+                        else:
+                            quote.append({'t': 'Para', 'c': reference})
+                    blocks.append({'t': 'BlockQuote', 'c': quote})
+                    i = j + 1
+                    continue
+
+            if cls.RE_SEPARATOR.fullmatch(line):
+                flush()
+                blocks.append(HORIZONTAL_RULE)
+                i += 1
+                continue
+
+            match = cls.RE_HEADING.fullmatch(line)
+            if match:
+                flush()
+                level = min(len(match.group('level')), 6)
+                blocks.append({'t': 'Header', 'c': [level, NULL_ATTR, cls.parse_inlines(match.group('text'))]})
+                i += 1
+                continue
+
+            if cls.RE_LIST_ITEM.fullmatch(line):
+                flush()
+                items = []
+                while i < len(lines):
+                    match = cls.RE_LIST_ITEM.fullmatch(lines[i])
+                    if match is None:
+                        break
+                    items.append((match.group('markers')[:cls.MAX_LIST_DEPTH],
+                                  cls.parse_inlines(match.group('text'))))
+                    i += 1
+                blocks.extend(cls.build_lists(items, 0))
+                continue
+
+            paragraph.append(line)
+            i += 1
+
+        flush()
+        return blocks
+
+    @classmethod
+    def build_lists(cls, items, depth):
+        '''builds nested bullet (*) and ordered (#) lists from (markers, inlines) items,
+        all of them having more than depth markers.
+        '''
+        blocks = []
+        i = 0
+        while i < len(items):
+            kind = items[i][0][depth]
+            entries = []
+            while i < len(items) and items[i][0][depth] == kind:
+                markers, inlines = items[i]
+                if len(markers) == depth + 1:
+                    entries.append([{'t': 'Plain', 'c': inlines}])
+                    i += 1
+                    continue
+                j = i
+                while j < len(items) and len(items[j][0]) > depth + 1 and items[j][0][depth] == kind:
+                    j += 1
+                nested = cls.build_lists(items[i:j], depth + 1)
+                if entries:
+                    entries[-1].extend(nested)
+                else:
+                    entries.append(nested)
+                i = j
+
+            if kind == '*':
+                blocks.append({'t': 'BulletList', 'c': entries})
+            else:
+                attributes = [1, {'t': 'Decimal'}, {'t': 'Period'}]
+                blocks.append({'t': 'OrderedList', 'c': [attributes, entries]})
+        return blocks
+
+    @classmethod
+    def parse_inlines(cls, text):
+        inlines = []
+        # delimiters without any closing delimiter after the current position,
+        # remembered to keep the scan linear in the length of text
+        unclosed = set()
+        pos = 0
+
+        def find_closing(delimiter, start):
+            if delimiter in unclosed:
+                return -1
+            end = text.find(delimiter, start)
+            if end == -1:
+                unclosed.add(delimiter)
+            return end
+
+        for match in cls.RE_INLINE.finditer(text):
+            if match.start() < pos:
+                continue
+            token = match.group()
+            inlines.extend(text_to_inlines(text[pos:match.start()]))
+            pos = match.end()
+
+            if match.group('url') is not None:
+                inlines.append({'t': 'Str', 'c': token})
+
+            elif match.group('source') is not None:
+                alt, _, source = match.group('source').rpartition('|')
+                inlines.append({'t': 'Image', 'c': [NULL_ATTR, text_to_inlines(alt), [source, '']]})
+
+            elif token in cls.INLINE_PAIRS:
+                closing, node = cls.INLINE_PAIRS[token]
+                end = find_closing(closing, pos + 1)
+                if end == -1:
+                    inlines.append({'t': 'Str', 'c': token})
+                else:
+                    inlines.append({'t': node, 'c': cls.parse_inlines(text[pos:end])})
+                    pos = end + len(closing)
+
+            elif token == '`':
+                end = find_closing('`', pos)
+                if end == -1:
+                    inlines.append({'t': 'Str', 'c': token})
+                else:
+                    inlines.append({'t': 'Code', 'c': [NULL_ATTR, text[pos:end]]})
+                    pos = end + 1
+
+            elif token == '$$':
+                end = find_closing('$$', pos)
+                if end == -1:
+                    inlines.append({'t': 'Str', 'c': token})
+                else:
+                    inlines.append({'t': 'Math', 'c': [{'t': 'InlineMath'}, text[pos:end].strip()]})
+                    pos = end + 2
+
+            elif token == '[[':
+                end = find_closing(']]', pos)
+                if end == -1:
+                    inlines.append({'t': 'Str', 'c': token})
+                else:
+                    name, _, target = text[pos:end].partition('|')
+                    if not target:
+                        target = name
+                    inlines.append({'t': 'Link', 'c': [NULL_ATTR, text_to_inlines(name), [target, '']]})
+                    pos = end + 2
+
+            # a single ~ escapes a CamelCase word and is dropped, any other ~ is kept as text
+            elif not cls.RE_CAMEL_CASE.match(text, pos):
+                pos = match.start()
+
+        inlines.extend(text_to_inlines(text[pos:]))
+        return inlines
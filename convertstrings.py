@@ -8,10 +8,21 @@ class ConvertStringsMixin:
     # TODO: improve readibility of this function
     # TODO: use pandoc custom writers instead? see 'pandoc --print-default-data-file sample.lua'
     @staticmethod
-    def convert_tw5_to_md(text):
-        """convert a tw5-flavored md text to a github-flavored md"""
+    def convert_tw5_to_md(text, images=None, deadline=None):
+        """convert a tw5-flavored md text to a github-flavored md.
+        images optionally maps the titles of image tiddlers to asset files (see AssetDirectory),
+        [img[title]] references to them are converted to images of the asset files.
+        deadline (see budget.Deadline) is checked between the conversion steps.
+        all steps take linear time: delimited phrases either end at the same delimiter
+        or cannot contain the opening bracket, so no opening delimiter is scanned to the end twice,
+        and links are found by a single scan (see iter_links).
+        """
         assert isinstance(text, str)
 
+        def check():
+            if deadline is not None:
+                deadline.check()
+
         def convert_list_symbols(match):
             match_string = match.group('list_symbols')
             # remove all spaces, tabs, etc.
@@ -31,22 +42,28 @@ class ConvertStringsMixin:
             match_string = ''.join(match_string.split())
             return '#' * len(match_string) + ' '
 
+        def sub_links(function, text):
+            # replaces the links of text by function(name, link)
+            parts, pos = [], 0
+            for start, end, name, link in ConvertStringsMixin.iter_links(text):
+                parts += [text[pos:start], function(name, link)]
+                pos = end
+            parts.append(text[pos:])
+            return ''.join(parts)
+
         # TODO: remove links of images before conversion
         # TODO: unify the remove/restore process of katex, links and images
         links = []
         def remove_links(text):
-            def append_link(match):
+            def append_link(name, link):
                 index = len(links)
-                if match.group('link2') is None:
-                    links.append(match.group('link1'))
-                    return '[[{}|{}]]'.format(match.group('name'), index)
+                links.append(link)
+                if name is not None:
+                    return '[[{}|{}]]'.format(name, index)
                 else:
-                    links.append(match.group('link2'))
                     return '[[{}]]'.format(index)
 
-            text = re.sub('\[\[(?P<name>[\w\W]+?)\|(?P<link1>[\w\W]+?)\]\]|\[\[(?P<link2>[^\|]+?)\]\]',
-                          append_link,
-                          text)
+            text = sub_links(append_link, text)
             return text
 
         katex = []
@@ -62,18 +79,14 @@ class ConvertStringsMixin:
             return text
 
         def restore_links(text):
-            def get_link(match):
-                if match.group('index2') is None:
-                    index = int(match.group('index1'))
-                    return '[[{}|{}]]'.format(match.group('name'), links[index])
+            def get_link(name, index):
+                link = links[int(index)] if index.isdecimal() and int(index) < len(links) else index
+                if name is not None:
+                    return '[[{}|{}]]'.format(name, link)
                 else:
-                    index = int(match.group('index2'))
-                    return '[[{}]]'.format(links[index])
+                    return '[[{}]]'.format(link)
 
-            text = re.sub('\[\[(?P<name>[\w\W]+?)\|(?P<index1>\d+?)\]\]|'
-                          '\[\[(?P<index2>\d+?)\]\]',
-                          get_link,
-                          text)
+            text = sub_links(get_link, text)
             return text
 
         def restore_katex(text):
@@ -100,24 +113,32 @@ class ConvertStringsMixin:
 
         text = remove_katex(text)
         text = remove_links(text)
+        check()
 
         # convert multiline environment """<some text>"""
-        matches = list(re.finditer('^\"\"\"\n?(?P<multiline>[\w\W]*?)\n?\"\"\"',
-                                   text, flags=re.MULTILINE))
-        while matches:
-            match = matches.pop()
-            quote = match.group('multiline')
-            quote = re.sub('\n', '\\\n', quote)
-            text = text[:match.start()] + quote + text[match.end():]
+        text = re.sub('^\"\"\"\n?(?P<multiline>[\w\W]*?)\n?\"\"\"',
+                      lambda match: match.group('multiline').replace('\n', '\\\n'),
+                      text,
+                      flags=re.MULTILINE)
 
         # add additional blank lines before and after separator for safety
         text = re.sub('(?<=\n)-{3,}(?=\n)', '\n\n---\n\n', text)
 
         # TODO: linked images on the web are not included correctly in pdf
-        # convert images
-        text = re.sub('\[[\s]*img(?P<options>[\w\W]*?)\[(?P<link>[\w\W]+?)\]\]',
-                      '\![\g<options>](\g<link>)',
+        # convert images, images of asset files are restored after the conversion of headings etc.
+        assets = []
+        def convert_image(match):
+            alt, _, source = match.group('link').rpartition('|')
+            path = None if images is None else images.get(source)
+            if path is None:
+                return '\\![{}]({})'.format(match.group('options'), match.group('link'))
+            assets.append('![{}](<{}>)'.format(alt or source, path))
+            return '\x1a{}\x1a'.format(len(assets) - 1)
+
+        text = re.sub('\[[\s]*img(?P<options>[^\[\]]*)\[(?P<link>(?:[^\[\]]|\](?!\]))+)\]\]',
+                      convert_image,
                       text)
+        check()
 
         # convert list-symbols * and #
         text = re.sub('^(?P<list_symbols>[\t ]*[*#]+[*#\t ]*)',
@@ -131,6 +152,8 @@ class ConvertStringsMixin:
                       text,
                       flags=re.MULTILINE)
 
+        check()
+
         # convert ''bold'' to __bold__
         text = re.sub('\'\'(?P<phrase>[\w\W]+?)\'\'',
                       '__\g<phrase>__',
@@ -143,25 +166,30 @@ class ConvertStringsMixin:
 
         # remove single ~ in front of words
         text = re.sub('(?<!~)~(?!~)', '', text, flags=re.MULTILINE)
+        check()
 
         # convert block quote
-        matches = list(re.finditer('^<<<[\t ]*(?P<quote>[\w\W]*?)<<<(?P<ref>[\w\W]*?)(?=\n)',
-                                   text, flags=re.MULTILINE))
-        while matches:
-            match = matches.pop()
-            quote = match.group('quote')
-            quote = re.sub('\n', '\n> ', quote)
-            quote = '> ' + quote
+        def convert_quote(match):
+            quote = '> ' + match.group('quote').replace('\n', '\n> ')
             ref = match.group('ref').strip()
             if ref:
                 quote += '({})'.format(ref)
-            text = text[:match.start()] + quote + text[match.end():]
+            return quote
+
+        # a block quote whose closing <<< is on the last line is left as is:
+        # the last line is left out, so the ref of every closing <<< is followed by a line break
+        end = text.rfind('\n') + 1
+        text = re.sub('^<<<[\t ]*(?P<quote>[\w\W]*?)<<<(?P<ref>[^\n]*)(?=\n)',
+                      convert_quote,
+                      text[:end],
+                      flags=re.MULTILINE) + text[end:]
 
         # TODO: convert tables
         # TODO: convert definitions
         # TODO: how to handle transclusions (in tiddlywiki.TiddlyWiki?)
         # TODO: how to handel links to other tiddlers?
 
+        check()
         text = restore_katex(text)
 
         # convert $$ to $
@@ -173,38 +201,86 @@ class ConvertStringsMixin:
 
         text = restore_links(text)
 
-        # convert links without reference
-        text = re.sub('\[\[(?P<link>[^\|]+?)\]\]',
-                      '[\g<link>](\g<link>)',
-                      text)
+        # convert links without and with reference
+        text = sub_links(lambda name, link: '[{}]({})'.format(link if name is None else name, link),
+                         text)
 
-        # convert links with reference
-        text = re.sub('\[\[(?P<name>[\w\W]+?)\|(?P<link>[\w\W]+?)\]\]',
-                      '[\g<name>](\g<link>)',
-                      text)
+        if assets:
+            text = re.sub('\x1a(?P<index>\d+)\x1a',
+                          lambda match: assets[int(match.group('index'))],
+                          text)
 
         return text
 
+    @staticmethod
+    def iter_links(text, names=True, multiline=True):
+        '''generator function, yielding (start, end, name, link) of the links [[link]] and [[name|link]] of text,
+        name is None for the former (and always, if names is False). a link ends at the nearest ]]
+        after its first character, so it may contain single brackets. [[]], [[|link]] and [[name|]] are no links,
+        neither are links spanning lines unless multiline is True.
+        the nearest ]], | and line break are looked up once for all [[ before them,
+        so text is scanned in linear time, even if it has many unclosed [[.
+        '''
+        nearest = {}
+
+        def find(sub, pos):
+            # the position of the nearest sub at or after pos, len(text) if there is none
+            found = nearest.get(sub, -1)
+            if found < pos:
+                found = text.find(sub, pos)
+                nearest[sub] = found = len(text) if found < 0 else found
+            return found
+
+        start = text.find('[[')
+        while start >= 0:
+            # a link has at least one character
+            end = find(']]', start + 3)
+            if end == len(text):
+                return
+            if text.startswith(']]', start + 2) or (not multiline and find('\n', start + 2) < end):
+                pass
+            elif not names or find('|', start + 2) > end:
+                yield start, end + 2, None, text[start + 2:end]
+                start = text.find('[[', end + 2)
+                continue
+            elif find('|', start + 3) < end - 1:
+                # the name has at least one character, too
+                bar = find('|', start + 3)
+                yield start, end + 2, text[start + 2:bar], text[bar + 1:end]
+                start = text.find('[[', end + 2)
+                continue
+            start = text.find('[[', start + 1)
+
+    @staticmethod
+    def raw_to_md(text):
+        '''returns text as a fenced code block, i.e. passed through without conversion.'''
+        fence = '`' * max([3] + [len(run) + 1 for run in re.findall('`{3,}', text)])
+        return '{0}\n{1}\n{0}'.format(fence, text)
+
+    @staticmethod
+    def html_encode(text):
+        '''escapes &, <, > and " the way TiddlyWiki does in its <div> store area.'''
+        return (text.replace('&', '&amp;')
+                    .replace('<', '&lt;')
+                    .replace('>', '&gt;')
+                    .replace('"', '&quot;'))
+
     @staticmethod
     def get_tag_list(tag_string):
         '''gets a string with tags, each tag is separated by a space.
         if a tag contains a space itself, it is enclosed by double square brackets,
         e.g. '[[tag with spaces]]'.
-        returns a list of tags.
+        returns a list of tags in the order of tag_string.
         '''
         assert isinstance(tag_string, str)
 
-        RE_LINK = re.compile('\[\[(?P<link>.*?)\]\]')
-
-        result = []
-        matches = list(re.finditer(RE_LINK, tag_string))
-        for match in reversed(matches):
-            result.append(match.group('link'))
-            s = match.start()
-            e = match.end()
-            tag_string = tag_string[:s] + tag_string[e:]
-
-        result += tag_string.split()
+        result, pos = [], 0
+        for start, end, _, tag in ConvertStringsMixin.iter_links(tag_string, names=False, multiline=False):
+            # [[]] is no tag
+            result += [word for word in tag_string[pos:start].split() if word != '[[]]']
+            result.append(tag)
+            pos = end
+        result += [word for word in tag_string[pos:].split() if word != '[[]]']
 
         return result
 
@@ -214,4 +290,30 @@ class ConvertStringsMixin:
         the first 14 digits are being interpreted as year+month+day+hour+minute+sec
         returns a datetime object.
         '''
-        return datetime.strptime(date_string[:14], '%Y%m%d%H%M%S')
\ No newline at end of file
+        return datetime.strptime(date_string[:14], '%Y%m%d%H%M%S')
+
+    @staticmethod
+    def date_to_string(date):
+        '''gets a datetime object.
+        returns the 17 digit string of TiddlyWiki, e.g. '20180101201500000' (with milliseconds).
+        '''
+        return date.strftime('%Y%m%d%H%M%S') + '{:03d}'.format(date.microsecond // 1000)
+
+    @staticmethod
+    def get_tag_string(tags):
+        '''the inverse of get_tag_list: tags containing whitespace or [[ are enclosed by double square brackets.
+        empty tags are left out, as in TiddlyWiki.
+        raises ValueError for an enclosed tag that get_tag_list cannot read back,
+        i.e. one containing ]] or a newline or ending with ].
+        '''
+        words = []
+        for tag in tags:
+            if not tag:
+                continue
+            if not re.search('\\s|\\[\\[', tag):
+                words.append(tag)
+                continue
+            if ']]' in tag or '\n' in tag or tag.endswith(']'):
+                raise ValueError('the tag {!r} cannot be written to a tag string'.format(tag))
+            words.append('[[{}]]'.format(tag))
+        return ' '.join(words)
\ No newline at end of file
@@ -0,0 +1,288 @@
+import copy
+import difflib
+import hashlib
+
+from instrumentation import METRICS
+
+# the value of an attribute a tiddler does not have
+MISSING = object()
+
+
+def attributes(tiddler):
+    '''returns the attributes of tiddler that are compared by diff and merge, including content.'''
+    result = {key: value for key, value in vars(tiddler).items() if not key.startswith('_')}
+    result['content'] = tiddler.content
+    result['tags'] = tuple(tiddler.tags)
+    return result
+
+
+def digest(tiddler):
+    '''returns a hash of all attributes of tiddler.'''
+    # the content is hashed as bytes, which is faster than its repr, the other attributes are small
+    content = (tiddler.content or '').encode('utf-8', 'surrogatepass')
+    fields = sorted(item for item in vars(tiddler).items() if not item[0].startswith('_') and item[0] != 'content')
+    value = hashlib.blake2b(content, digest_size=16)
+    value.update(repr((len(content), fields)).encode('utf-8', 'surrogatepass'))
+    return value.digest()
+
+
+def merge_lines(base, ours, theirs):
+    '''three-way merge of the lists of lines base, ours and theirs.
+    returns the merged lines, or None if both sides changed the same (or adjacent) lines differently.
+    '''
+    changes = []
+    for side in (ours, theirs):
+        matcher = difflib.SequenceMatcher(None, base, side, autojunk=False)
+        changes.extend((i1, i2, tuple(side[j1:j2]))
+                       for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal')
+    changes.sort()
+
+    merged, pos, previous = [], 0, None
+    for change in changes:
+        if change == previous:
+            continue  # the same change on both sides
+        i1, i2, lines = change
+        if previous is not None and i1 <= previous[1]:
+            return None
+        merged.extend(base[pos:i1])
+        merged.extend(lines)
+        pos, previous = i2, change
+    merged.extend(base[pos:])
+    return merged
+
+
+class TiddlerChange:
+    '''a tiddler with title changed from old to new.'''
+
+    def __init__(self, title, old, new):
+        self.title = title
+        self.old = old
+        self.new = new
+
+    @property
+    def fields(self):
+        '''the sorted names of the changed attributes.'''
+        old, new = attributes(self.old), attributes(self.new)
+        return sorted(key for key in old.keys() | new.keys()
+                      if old.get(key, MISSING) != new.get(key, MISSING))
+
+    def content_diff(self, n=3):
+        """returns the unified diff of the lines of content (an empty list if the content did not change)."""
+        old, new = self.old.content or '', self.new.content or ''
+        if old == new:
+            return []
+        lines = difflib.unified_diff(old.splitlines(True), new.splitlines(True),
+                                     'a/' + self.title, 'b/' + self.title, n=n)
+        # as in git, a last line without line break is marked
+        return [line if line.endswith('\n') else line + '\n\\ No newline at end of file\n' for line in lines]
+
+    def __repr__(self):
+        return 'TiddlerChange({!r}, fields={})'.format(self.title, self.fields)
+
+
+class WikiDiff:
+    '''the difference between two wikis: added and removed tiddlers and the TiddlerChanges of changed ones,
+    each in the order of the wiki they are taken from, and the tiddlers with duplicate titles.
+    '''
+
+    def __init__(self, added, removed, changed, duplicates=()):
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+        # tiddlers left out of the diff, since a later tiddler of the same wiki has the same title
+        self.duplicates = list(duplicates)
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+    def unified_diff(self, n=3):
+        '''generator function, yielding the lines of the unified diff of the content of all changed tiddlers.'''
+        for change in self.changed:
+            yield from change.content_diff(n)
+
+    def __str__(self):
+        lines = ['+ ' + tiddler.title for tiddler in self.added]
+        lines += ['- ' + tiddler.title for tiddler in self.removed]
+        lines += ['~ {} ({})'.format(change.title, ', '.join(change.fields)) for change in self.changed]
+        lines += ['! {} (duplicate title)'.format(tiddler.title) for tiddler in self.duplicates]
+        lines.append('{} added, {} removed, {} changed'.format(len(self.added), len(self.removed),
+                                                                len(self.changed)))
+        return '\n'.join(lines)
+
+
+class Conflict:
+    '''a tiddler both sides of a merge changed differently.
+    kind is 'edit/edit' (fields lists the attributes in conflict), 'add/add', 'delete/edit' or 'edit/delete'
+    (ours/theirs). base, ours and theirs are the tiddlers of the three wikis (None if missing).
+    '''
+
+    def __init__(self, title, kind, base, ours, theirs, fields=()):
+        self.title = title
+        self.kind = kind
+        self.base = base
+        self.ours = ours
+        self.theirs = theirs
+        self.fields = list(fields)
+
+    def __repr__(self):
+        return 'Conflict({!r}, {!r}, fields={})'.format(self.title, self.kind, self.fields)
+
+
+class MergeResult:
+    '''the merged wiki and the list of Conflicts.
+    a conflict is resolved in favour of ours (of the edited tiddler, if the other side deleted it).
+    '''
+
+    def __init__(self, wiki, conflicts):
+        self.wiki = wiki
+        self.conflicts = conflicts
+
+    def __bool__(self):
+        '''True if the merge is free of conflicts.'''
+        return not self.conflicts
+
+
+class DiffWikiMixin:
+    """Structural diff and three-way merge of wikis.
+
+    Tiddlers are matched by title via title indexes and compared by a hash of their attributes,
+    so diff and merge take linear time in the number of tiddlers. Only changed tiddlers are compared
+    attribute by attribute and line by line.
+    """
+
+    def title_index(self, duplicates=None):
+        '''returns a dict title -> tiddler. titles are unique in TiddlyWiki, else the last tiddler wins
+        and, if a list duplicates is given, the tiddlers it replaces are appended to it.
+        '''
+        index = {}
+        for tiddler in self:
+            if duplicates is not None and tiddler.title in index:
+                duplicates.append(index[tiddler.title])
+            index[tiddler.title] = tiddler
+        return index
+
+    def diff(self, other):
+        '''returns the WikiDiff from this wiki to wiki other.'''
+        with METRICS.span('diff'):
+            duplicates = []
+            old, new = self.title_index(duplicates), other.title_index(duplicates)
+            added = [tiddler for title, tiddler in new.items() if title not in old]
+            removed = [tiddler for title, tiddler in old.items() if title not in new]
+            changed = [TiddlerChange(title, tiddler, new[title]) for title, tiddler in old.items()
+                       if title in new and digest(tiddler) != digest(new[title])]
+            METRICS.count('tiddlers_changed', len(changed))
+        return WikiDiff(added, removed, changed, duplicates)
+
+    @staticmethod
+    def __merge_tiddler(title, base, ours, theirs):
+        # returns the merged tiddler and the Conflict (or None) of a tiddler changed on both sides
+        if base is None or ours is None or theirs is None:
+            kind = 'add/add' if base is None else 'delete/edit' if ours is None else 'edit/delete'
+            return ours if ours is not None else theirs, Conflict(title, kind, base, ours, theirs)
+
+        base_attributes, our_attributes, their_attributes = attributes(base), attributes(ours), attributes(theirs)
+        merged, conflicts = {}, []
+        for key in our_attributes.keys() | their_attributes.keys():
+            b = base_attributes.get(key, MISSING)
+            o = our_attributes.get(key, MISSING)
+            t = their_attributes.get(key, MISSING)
+            if o == t or t == b:
+                merged[key] = o
+            elif o == b:
+                merged[key] = t
+            elif key == 'tags':
+                # tags are merged as sets, keeping the order of ours
+                merged[key] = tuple(tag for tag in o if tag in t or tag not in b) + \
+                              tuple(tag for tag in t if tag not in o and tag not in b)
+            elif key == 'content' and all(isinstance(value, str) for value in (b, o, t)):
+                lines = merge_lines(b.splitlines(True), o.splitlines(True), t.splitlines(True))
+                if lines is None:
+                    conflicts.append(key)
+                    merged[key] = o
+                else:
+                    merged[key] = ''.join(lines)
+            else:
+                conflicts.append(key)
+                merged[key] = o
+
+        tiddler = copy.copy(ours)
+        for key, value in merged.items():
+            if value is MISSING:
+                tiddler.__dict__.pop(key, None)
+            elif key == 'tags':
+                tiddler.tags = list(value)
+            elif value is not our_attributes.get(key, MISSING):
+                setattr(tiddler, key, value)
+        conflict = Conflict(title, 'edit/edit', base, ours, theirs, sorted(conflicts)) if conflicts else None
+        return tiddler, conflict
+
+    def merge(self, base, theirs):
+        """three-way merge of this wiki (ours) and wiki theirs, both changed from wiki base.
+        returns a MergeResult with a new wiki: changes of one side are taken over, changes of both sides
+        are merged attribute by attribute (tags as sets, content line by line), the rest are Conflicts.
+        the tiddlers are in the order of ours, followed by the ones only theirs added.
+        if ours was parsed, the merged wiki keeps its html, so that the caller can save the merge with save_html.
+        raises ValueError if a wiki has duplicate titles, as their tiddlers cannot be matched.
+        """
+        with METRICS.span('merge'):
+            duplicates = []
+            base_index = base.title_index(duplicates)
+            our_index = self.title_index(duplicates)
+            their_index = theirs.title_index(duplicates)
+            if duplicates:
+                titles = sorted({tiddler.title for tiddler in duplicates})
+                raise ValueError('cannot merge wikis with duplicate titles: {}'.format(', '.join(titles)))
+            titles = list(our_index) + [title for title in their_index if title not in our_index]
+
+            tiddlers, conflicts, replaced = [], [], {}
+            for title in titles:
+                b, o, t = base_index.get(title), our_index.get(title), their_index.get(title)
+                bd, od, td = (None if tiddler is None else digest(tiddler) for tiddler in (b, o, t))
+                if od == td or td == bd:
+                    merged = o
+                elif od == bd:
+                    merged = t
+                else:
+                    merged, conflict = self.__merge_tiddler(title, b, o, t)
+                    if conflict is not None:
+                        conflicts.append(conflict)
+                if merged is not None:
+                    tiddlers.append(merged)
+                    if o is not None and merged is not o:
+                        replaced[merged] = o
+            METRICS.count('merge_conflicts', len(conflicts))
+
+        wiki = type(self)(title=self.title, subtitle=self.subtitle, tiddlers=tiddlers)
+        # merged and theirs' tiddlers take the places of ours in the store area
+        wiki.set_source_of(self, replaced)
+        return MergeResult(wiki, conflicts)
+
+
+if __name__ == "__main__":
+
+    import sys
+
+    from tiddlywiki import TiddlyWiki
+
+    if len(sys.argv) == 3:
+        print(TiddlyWiki.parse_from_html(sys.argv[1]).diff(TiddlyWiki.parse_from_html(sys.argv[2])))
+        sys.exit()
+
+    base = TiddlyWiki.parse_from_html('./example/tw5.html')
+    ours = TiddlyWiki.parse_from_html('./example/tw5.html')
+    theirs = TiddlyWiki.parse_from_html('./example/tw5.html')
+
+    ours[0].content += '\nadded by us'
+    ours[1].tags.append('ours')
+    theirs[1].tags.append('theirs')
+    theirs.remove_tiddler(theirs[2])
+
+    diff = base.diff(ours)
+    print(diff)
+    print(''.join(diff.unified_diff()))
+
+    result = ours.merge(base, theirs)
+    print(len(result.wiki), result.conflicts)
@@ -0,0 +1,179 @@
+import concurrent.futures
+import io
+import itertools
+import os
+import shutil
+import tempfile
+
+from algorithm import Pipeline
+from instrumentation import METRICS, NullProgress
+
+
+def compile_chunk(title, subtitle, tiddlers, extra_args, backend, directory, assets=None,
+                  title_block=True, heading=None):
+    '''compiles the (already sorted) tiddlers to a pdf in a worker process.
+    the pdf starts with the title block of title and subtitle (unless title_block is False)
+    and the top-level heading heading, if given (see ExportWikiMixin.write_source).
+    latex runs in an isolated temporary directory below directory,
+    assets maps titles of binary tiddlers to already written asset files.
+    the path of the pdf and the METRICS events of the worker (see Instrumentation.replay) are returned,
+    a RuntimeError carries the events as attribute events.
+    '''
+    from tiddlywiki import TiddlyWiki  # tiddlywiki imports this module
+
+    workdir = tempfile.mkdtemp(dir=directory)
+    # pandoc (and latex) put their intermediate files into TMPDIR
+    os.environ['TMPDIR'] = workdir
+    tempfile.tempdir = workdir
+
+    # the progress is reported by the parent process only
+    METRICS.progress = NullProgress()
+    events = []
+    hook = METRICS.add_hook(events.append)
+    try:
+        wiki = TiddlyWiki(title=title, subtitle=subtitle, tiddlers=tiddlers)
+        source, source_format = wiki.write_source(wiki.tiddlers, 'pdf', backend, assets, title_block, heading)
+        output = os.path.join(workdir, 'chunk.pdf')
+        METRICS.convert_file(source, 'pdf', format=source_format, outputfile=output, extra_args=extra_args)
+    except RuntimeError as error:
+        error.events = events
+        raise
+    finally:
+        METRICS.remove_hook(hook)
+    return output, events
+
+
+class ExportChunkedMixin:
+
+    # a table of contents per chunk is replaced by the combined outline of the merged pdf
+    TOC_ARGS = {'--toc', '--table-of-contents'}
+
+    CHUNK_LABELS = {'month': lambda t: t.created.strftime('%Y-%m'),
+                    'tag': lambda t: t.tags[0] if t.tags else 'untagged'}
+
+    @classmethod
+    def split_chunks(cls, tiddlers, chunk_by='count', chunk_size=200):
+        '''splits the sorted tiddlers into a list of (label, tiddlers) chunks.
+        chunk_by is 'count' (chunks of chunk_size tiddlers), 'month' (of creation),
+        'tag' (first tag) or a function returning the chunk label of a tiddler.
+        chunks keep the order of their first tiddler, tiddlers keep their order within a chunk.
+        '''
+        if chunk_by == 'count':
+            return [('{}-{}'.format(i + 1, min(i + chunk_size, len(tiddlers))), tiddlers[i:i + chunk_size])
+                    for i in range(0, len(tiddlers), chunk_size)]
+
+        label = cls.CHUNK_LABELS.get(chunk_by, chunk_by)
+        chunks = {}
+        for tiddler in tiddlers:
+            chunks.setdefault(label(tiddler), []).append(tiddler)
+        return list(chunks.items())
+
+    def export_to_pdf_chunked(self, path, *extra_args, predicates=None, key=lambda t: t.created,
+                              reverse=False, limit=None, chunk_by='count', chunk_size=200,
+                              max_workers=None, retries=1, backend='markdown'):
+        '''export the (filtered) tiddlers sorted by key to a pdf at <path>,
+        compiling chunks of them in parallel worker processes and merging the chunk pdfs,
+        each chunk becoming an outline item (bookmark) of the merged pdf.
+        see split_chunks for chunk_by and chunk_size.
+        a failing chunk is retried <retries> times and then bisected,
+        until the failing tiddlers are isolated and left out.
+        requires pypdf for merging.
+        returns the list of tiddlers that could not be exported,
+        raises RuntimeError (and writes no pdf) if none could be exported.
+        '''
+        try:
+            import pypdf
+        except ImportError as error:
+            raise ImportError('export_to_pdf_chunked requires pypdf (pip install pypdf)') from error
+
+        extra_args = tuple(arg for arg in extra_args if arg not in self.TOC_ARGS)
+
+        with METRICS.span('select_tiddlers'):
+            pipeline = Pipeline().filter(*(predicates or ())).sort(key, reverse)
+            if limit is not None:
+                pipeline = pipeline.limit(limit)
+            # the one list of the export: the chunks are split from it and its assets written once
+            tiddlers = list(self.apply(pipeline))
+        chunks = self.split_chunks(tiddlers, chunk_by, chunk_size)
+
+        failed = []
+        parts = {}  # (chunk index, bisection path) -> pdf
+        directory = tempfile.mkdtemp()
+        try:
+            # the assets of the selected tiddlers are written once here,
+            # the workers get their paths only (not the payloads)
+            assets = self.assets(os.path.join(directory, 'assets'))
+            assets = assets.to_dict(assets.referenced_titles(tiddlers))
+
+            with METRICS.span('compile_chunks', chunks=len(chunks)), \
+                    concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+
+                def submit(index, bisection, part, attempt):
+                    # the merged pdf reads as one export: only its first part has the title block
+                    # of the wiki, and the first part of each chunk starts with the label as heading
+                    first = not any(bisection)
+                    heading = str(chunks[index][0]) if first else None
+                    future = executor.submit(compile_chunk, self.title, self.subtitle, part, extra_args,
+                                             backend, directory, assets, index == 0 and first, heading)
+                    pending[future] = (index, bisection, part, attempt)
+                    METRICS.count('pdf_chunks')
+
+                def completed():
+                    # retries and bisections are submitted while waiting
+                    while pending:
+                        done, _ = concurrent.futures.wait(pending,
+                                                          return_when=concurrent.futures.FIRST_COMPLETED)
+                        yield from done
+
+                pending = {}
+                for index, (label, part) in enumerate(chunks):
+                    submit(index, (), part, 0)
+
+                for future in METRICS.progress(completed(), desc='pdf chunks'):
+                    index, bisection, part, attempt = pending.pop(future)
+                    try:
+                        parts[(index, bisection)], events = future.result()
+                        METRICS.replay(events)
+                    except RuntimeError as error:
+                        METRICS.replay(getattr(error, 'events', ()))
+                        METRICS.progress.message(error)
+                        if attempt < retries:
+                            METRICS.count('pdf_chunk_retries')
+                            submit(index, bisection, part, attempt + 1)
+                        elif len(part) > 1:
+                            METRICS.count('pdf_chunk_bisections')
+                            half = len(part) // 2
+                            submit(index, bisection + (0,), part[:half], 0)
+                            submit(index, bisection + (1,), part[half:], 0)
+                        else:
+                            failed.extend(part)
+
+            if not parts:
+                # no pdf is written instead of an empty one
+                msg = 'none of the {} tiddlers could be exported to {}'
+                raise RuntimeError(msg.format(len(tiddlers), path))
+
+            with METRICS.span('merge_pdf', parts=len(parts)):
+                writer = pypdf.PdfWriter()
+                for index, group in itertools.groupby(sorted(parts), key=lambda part: part[0]):
+                    # the parts of a bisected chunk are merged first, to share one outline item
+                    chunk = pypdf.PdfWriter()
+                    for part in group:
+                        chunk.append(parts[part])
+                    buffer = io.BytesIO()
+                    chunk.write(buffer)
+                    buffer.seek(0)
+                    writer.append(buffer, outline_item=str(chunks[index][0]))
+                with open(path, 'wb') as fh:
+                    writer.write(fh)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        if failed:
+            msg = 'Could only export {} out of {} tiddlers.'
+            METRICS.progress.message(msg.format(len(tiddlers) - len(failed), len(tiddlers)))
+            METRICS.progress.message("The following tiddlers raised a pandoc error:")
+            for tiddler in failed:
+                METRICS.progress.message("\t{}".format(tiddler.title))
+
+        return failed
@@ -1,10 +1,22 @@
+import json
 import tempfile
 import webbrowser
 
-import pypandoc
+from budget import UNLIMITED, BudgetExceeded
+from convertast import HORIZONTAL_RULE, NULL_ATTR, document, rewrite_images, text_to_inlines
+from instrumentation import METRICS
 
 
 class ExportTiddlerMixin:
+
+    # per-tiddler limits of the tw5 conversions, see budget.Budget
+    budget = UNLIMITED
+
+    def __exceeded(self, error, content):
+        METRICS.count('budget_exceeded', reason=error.reason)
+        METRICS.progress.message('{}: {}, exported as raw text'.format(self.title, error))
+        return self.unescape_html(content)
+
     def export_header(self, format='md', encoding='utf-8'):
         '''export the tiddler head (containing title, creation date, and tags).
         format can be any valid pandoc format specifier.
@@ -18,49 +30,124 @@ class ExportTiddlerMixin:
         if encoding != 'utf-8':
             result = result.encode(encoding, errors='ignore').decode(encoding)
 
-        return pypandoc.convert_text(result, format, format='md')
+        with METRICS.span('export_header', tiddler=self.title):
+            return METRICS.convert_text(result, format, format='md')
 
 
-    def export_content(self, format='md', encoding='utf-8'):
+    def export_content(self, format='md', encoding='utf-8', assets=None):
         '''export the tiddler content.
         format can be any valid pandoc format specifier.
         first, the tiddler content is converted to github flavored markdown.
         then pypandoc is used to convert the md file to the desired format.
+        assets optionally maps titles of image tiddlers to asset files, see AssetDirectory.
         '''
-        if self.type_ == 'text/vnd.tiddlywiki':
-            content = type(self).convert_tw5_to_md(self.content)
-        elif self.type_ == 'text/html':
-            content = pypandoc.convert_text(self.content, 'md', format='html')
-        elif self.type_ == 'text/x-markdown':
-            content = self.content
-        else:
-            content = self.content
-
+        with METRICS.span('export_content', tiddler=self.title):
+            if self.type_ == 'text/vnd.tiddlywiki':
+                with METRICS.span('convert_tw5_to_md', tiddler=self.title):
+                    try:
+                        deadline = self.budget.start(self.content)
+                        content = type(self).convert_tw5_to_md(self.content, images=assets,
+                                                               deadline=deadline)
+                    except BudgetExceeded as error:
+                        content = self.raw_to_md(self.__exceeded(error, self.content))
+            elif self.type_ == 'text/html':
+                content = METRICS.convert_text(self.content, 'md', format='html')
+            elif self.type_ == 'text/x-markdown':
+                content = self.content
+            else:
+                content = self.content
+
+            if encoding != 'utf-8':
+                content = content.encode(encoding, errors='ignore').decode(encoding)
+
+            return METRICS.convert_text(content, format, format='md')
+
+
+    def export_header_ast(self, encoding='utf-8'):
+        '''export the tiddler head as a list of pandoc json ast blocks,
+        with the same content as export_header.
+        '''
+        def text(string):
+            if encoding != 'utf-8':
+                string = string.encode(encoding, errors='ignore').decode(encoding)
+            return text_to_inlines(string)
+
+        def strong(string):
+            return {'t': 'Strong', 'c': text(string)}
+
+        dates = ([strong('created'), {'t': 'Str', 'c': ':'}, {'t': 'Space'}] +
+                 text('{},'.format(self.created)) + [{'t': 'Space'}] +
+                 [strong('last modified'), {'t': 'Str', 'c': ':'}, {'t': 'Space'}] +
+                 text(str(self.modified)))
+        keywords = [strong('keywords'), {'t': 'Str', 'c': ':'}, {'t': 'Space'}] + text(str(self.tags))
+
+        return [{'t': 'Header', 'c': [1, ['', [], []], text(self.title)]},
+                {'t': 'Para', 'c': dates},
+                {'t': 'Para', 'c': keywords}]
+
+    def export_content_ast(self, encoding='utf-8', assets=None):
+        '''export the tiddler content as a list of pandoc json ast blocks.
+        tw5 content is converted to the ast directly,
+        other content types are read by pandoc (one call).
+        assets optionally maps titles of image tiddlers to asset files, see AssetDirectory.
+        '''
+        content = self.content
         if encoding != 'utf-8':
             content = content.encode(encoding, errors='ignore').decode(encoding)
 
-        return pypandoc.convert_text(content, format, format='md')
-
-
-    def export(self, format='md', encoding='utf-8'):
+        with METRICS.span('export_content_ast', tiddler=self.title):
+            if self.type_ == 'text/vnd.tiddlywiki':
+                with METRICS.span('convert_tw5_to_ast', tiddler=self.title):
+                    try:
+                        blocks = type(self).convert_tw5_to_ast(content, self.budget.start(content))
+                    except BudgetExceeded as error:
+                        blocks = [{'t': 'CodeBlock', 'c': [NULL_ATTR, self.__exceeded(error, content)]}]
+            elif self.type_ == 'text/html':
+                blocks = json.loads(METRICS.convert_text(content, 'json', format='html'))['blocks']
+            else:
+                blocks = json.loads(METRICS.convert_text(content, 'json', format='md'))['blocks']
+
+        if assets is not None:
+            rewrite_images(blocks, assets)
+        return blocks
+
+    def export_ast(self, encoding='utf-8', assets=None):
+        '''export the tiddler (header, separator and content) as a list of pandoc json ast blocks.'''
+        return (self.export_header_ast(encoding) + [HORIZONTAL_RULE] +
+                self.export_content_ast(encoding, assets=assets))
+
+    def export(self, format='md', encoding='utf-8', backend='markdown', assets=None):
         '''export the tiddler to a string.
         format can be any valid pandoc format specifier.
+        with backend='ast' the tiddler is converted to the pandoc json ast directly
+        and pandoc is called once (-f json) instead of parsing intermediate markdown.
         '''
-        result = self.export_header(encoding=encoding)
-        result += '\n\n---\n\n'
-        result += self.export_content(encoding=encoding)
-
-        try:
-            result = pypandoc.convert_text(result, format, format='md')
-        except Exception as error:  # TODO: specify Exception
-            print(error)
-            result = None
-        return result
-
-
-    def export_to_file(self, path, format=None, encoding='utf-8'):
+        if backend == 'ast':
+            with METRICS.span('export_tiddler', tiddler=self.title, backend=backend):
+                try:
+                    ast = json.dumps(document(self.export_ast(encoding, assets=assets)))
+                    return METRICS.convert_text(ast, format, format='json')
+                except Exception as error:  # TODO: specify Exception
+                    METRICS.progress.message(error)
+                    return None
+
+        with METRICS.span('export_tiddler', tiddler=self.title):
+            result = self.export_header(encoding=encoding)
+            result += '\n\n---\n\n'
+            result += self.export_content(encoding=encoding, assets=assets)
+
+            try:
+                result = METRICS.convert_text(result, format, format='md')
+            except Exception as error:  # TODO: specify Exception
+                METRICS.progress.message(error)
+                result = None
+            return result
+
+
+    def export_to_file(self, path, format=None, encoding='utf-8', backend='markdown', assets=None):
         '''export the tiddler to a file at dir <path>.
         format can be any valid pandoc format specifier.
+        backend is 'markdown' or 'ast', see export.
         '''
         if format is None:
             format = path.split('.')[-1]
@@ -79,11 +166,18 @@ class ExportTiddlerMixin:
         if format in {'pdf'}:
             encoding = 'latin-1'
 
-        md = self.export(encoding=encoding)
-        pypandoc.convert_text(md, format, format='md', outputfile=path)
+        if backend == 'ast':
+            with METRICS.span('export_tiddler_to_file', tiddler=self.title, format=format):
+                ast = json.dumps(document(self.export_ast(encoding, assets=assets)))
+                METRICS.convert_text(ast, format, format='json', outputfile=path)
+            return
+
+        md = self.export(encoding=encoding, assets=assets)
+        with METRICS.span('export_tiddler_to_file', tiddler=self.title, format=format):
+            METRICS.convert_text(md, format, format='md', outputfile=path)
 
 
-    def open_in_browser(self, format='html'):
+    def open_in_browser(self, format='html', backend='markdown'):
         with tempfile.NamedTemporaryFile('w', suffix='.' + format, delete=False) as fh:
-            self.export_to_file(fh.name, format=format)
+            self.export_to_file(fh.name, format=format, backend=backend)
         webbrowser.get(using='chrome').open('file://' + fh.name, new=1)
\ No newline at end of file
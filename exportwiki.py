@@ -1,134 +1,469 @@
+import collections
 import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import json
 
 import os
+import re
 import tempfile
 
 import datetime
+import threading
 import webbrowser
 
 import pypandoc
-import tqdm
+
+from algorithm import Pipeline
+from convertast import HORIZONTAL_RULE, NULL_ATTR, document, text_to_inlines
+from instrumentation import METRICS
+from tiddler import AssetDirectory, BinaryTiddler
+
+
+class ExportCache:
+    '''a thread-safe lru cache of tiddler conversions, see ExportWikiMixin.conversion_cache.'''
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            value = self.__entries.get(key)
+            if value is not None:
+                self.__entries.move_to_end(key)
+        METRICS.cache('conversion', value is not None)
+        return value
+
+    def put(self, key, value):
+        with self.__lock:
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+# a target of ExportWikiMixin.export_targets, the arguments of export_to_file
+ExportTarget = collections.namedtuple('ExportTarget', 'path format predicates key reverse limit extra_args',
+                                      defaults=(None, None, None, False, None, ()))
 
 
 class ExportWikiMixin:
 
     __MAX_WORKERS = os.cpu_count()
 
-    def __get_tiddlers(self, predicates):
+    # an optional ExportCache of the tiddler conversions of write_source,
+    # worth it for long running processes exporting the same tiddlers repeatedly (see wikidaemon.py)
+    conversion_cache = None
+
+    def __get_tiddlers(self, predicates, key=None, reverse=False, limit=None):
+        # an iterator of the selected tiddlers in export order, consumed by the writers as they go.
+        # callers needing the tiddlers twice (e.g. the safety check) make a list of them
+        pipeline = Pipeline()
         if predicates is not None:
-            tiddlers = list(self.finditer(*predicates))
-        else:
-            tiddlers = list(self)
-        return tiddlers
+            pipeline = pipeline.filter(*predicates)
+        pipeline = pipeline.sort(key, reverse)
+        if limit is not None:
+            # heap-based top-k, the remaining tiddlers are never sorted
+            pipeline = pipeline.limit(limit)
+        return self.apply(pipeline)
 
-    def __get_safe_tiddlers(self, iterable_tiddlers, format):
+    def __get_safe_tiddlers(self, iterable_tiddlers, format, backend='markdown', assets=None):
         safe_tiddlers = []
         non_safe_tiddlers = []
 
-        for tiddler in tqdm.tqdm(iterable_tiddlers):
+        for tiddler in METRICS.progress(iterable_tiddlers, desc='safety check'):
             with tempfile.NamedTemporaryFile('w', suffix='.' + format) as fh:
                 try:
-                    tiddler.export_to_file(fh.name)
+                    check = functools.partial(tiddler.export_to_file, fh.name, backend=backend, assets=assets)
+                    self.__check_safe(tiddler, backend, assets, check)
                 except RuntimeError as error:
-                    print(error)
+                    METRICS.progress.message(error)
                     non_safe_tiddlers.append(tiddler)
                 else:
                     safe_tiddlers.append(tiddler)
 
         return safe_tiddlers, non_safe_tiddlers
 
-    def __get_safe_tiddlers_multithread(self, iterable_tiddlers, format):
+    def __get_safe_tiddlers_multithread(self, iterable_tiddlers, format, backend='markdown', assets=None):
         workers = min(len(iterable_tiddlers), self.__MAX_WORKERS)
         with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor, \
                 tempfile.NamedTemporaryFile('w', suffix='.' + format) as fh:
             future_to_tiddler = {}
             for tiddler in iterable_tiddlers:
-                ftr = executor.submit(tiddler.export_to_file, fh.name)
+                check = functools.partial(tiddler.export_to_file, fh.name, backend=backend, assets=assets)
+                ftr = executor.submit(self.__check_safe, tiddler, backend, assets, check)
                 future_to_tiddler[ftr] = tiddler
 
             safe_tiddlers = []
             non_safe_tiddlers = []
             futures = concurrent.futures.as_completed(future_to_tiddler.keys())
-            for future in tqdm.tqdm(futures, total=len(future_to_tiddler)):
+            for future in METRICS.progress(futures, total=len(future_to_tiddler), desc='safety check'):
                 tiddler = future_to_tiddler[future]
                 try:
                     future.result()
                 except RuntimeError as error:
-                    print(error)
+                    METRICS.progress.message(error)
                     non_safe_tiddlers.append(tiddler)
                 else:
                     safe_tiddlers.append(tiddler)
 
         return safe_tiddlers, non_safe_tiddlers
 
-    def export_to_file(self, path, *extra_args, format=None, predicates=None, key=lambda t: t.created):
-        if format is None:
-            format = path.split('.')[-1]
+    @staticmethod
+    def __cache_key(tiddler, encoding, backend, assets):
+        # tiddlers are keyed by a digest of everything their conversion depends on,
+        # so that edited tiddlers are converted again. the location of the assets is part of the key
+        # only for tiddlers that may refer to binary tiddlers, so that the others hit the cache
+        # whatever the path of the export
+        content = tiddler.content or ''
+        refers_to_assets = (isinstance(tiddler, BinaryTiddler) or
+                            '[img' in content or '![' in content or '<img' in content)
+        location = None
+        if assets is not None and refers_to_assets:
+            location = (assets.directory, assets.relative_to)
+        digest = hashlib.sha1(content.encode('utf-8', 'surrogatepass')).hexdigest()
+        return (tiddler.title, tiddler.created, tiddler.modified, tuple(tiddler.tags), tiddler.type_,
+                digest, encoding, backend, location)
 
-        tiddlers = self.__get_tiddlers(predicates)
+    def __check_safe(self, tiddler, backend, assets, check):
+        # the pdf safety check check() of tiddler, raising RuntimeError if pandoc fails.
+        # the result is cached, as the check takes one pandoc (and latex) call per tiddler
+        cache = self.conversion_cache
+        if cache is None:
+            check()
+            return
 
-        if format in {'pdf'}:
-            safe_tiddlers, non_safe_tiddlers = self.__get_safe_tiddlers_multithread(tiddlers, format)
+        key = ('safety_check',) + self.__cache_key(tiddler, 'latin-1', backend, assets)
+        error = cache.get(key)
+        if error is None:
+            try:
+                check()
+            except RuntimeError as exception:
+                error = str(exception)
+            else:
+                error = ''
+            cache.put(key, error)
+        if error:
+            raise RuntimeError(error)
+
+    def __convert_tiddler(self, tiddler, encoding, backend, assets):
+        # returns the conversion of tiddler to markdown, or to ast blocks serialized as json
+        if backend == 'ast':
+            export = lambda: json.dumps(tiddler.export_ast(encoding=encoding, assets=assets))
         else:
-            safe_tiddlers = tiddlers
-            non_safe_tiddlers = []
-        safe_tiddlers.sort(key=key)
-
-        with tempfile.NamedTemporaryFile('w', suffix='.md', delete=False) as fh:
-            title = '% {}\n' \
-                    '% {}\n' \
-                    '% {}\n\n'.format(self.title,
-                                      self.subtitle,
-                                      str(datetime.date.today()))
-            fh.write(title)
-
-            for tiddler in tqdm.tqdm(safe_tiddlers):
-                if format in {'pdf'}:
-                    encoding = 'latin-1'
+            export = lambda: tiddler.export(encoding=encoding, assets=assets)
+
+        cache = self.conversion_cache
+        if cache is None:
+            return export()
+
+        key = self.__cache_key(tiddler, encoding, backend, assets)
+        result = cache.get(key)
+        if result is None:
+            result = export()
+            if result is not None:
+                cache.put(key, result)
+        return result
+
+    @staticmethod
+    def __encoding(format):
+        # see ExportTiddlerMixin.export_to_file
+        return 'latin-1' if format in {'pdf'} else 'utf-8'
+
+    def __write_fragments(self, fragments, backend, title_block=True, heading=None):
+        # writes the converted tiddlers (see __convert_tiddler) to a temporary pandoc input file
+        if backend == 'ast':
+            with METRICS.span('write_ast'), \
+                    tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as fh:
+                blocks = []
+                if heading is not None:
+                    blocks.append({'t': 'Header', 'c': [1, NULL_ATTR, text_to_inlines(heading)]})
+                for fragment in fragments:
+                    # ast blocks are kept as json, since document modifies the blocks in place
+                    blocks.extend(json.loads(fragment))
+                    blocks.extend([HORIZONTAL_RULE, HORIZONTAL_RULE])
+                if title_block:
+                    blocks = document(blocks, self.title, self.subtitle, str(datetime.date.today()))
                 else:
-                    encoding = 'utf-8'
-                tiddler_md = tiddler.export(encoding=encoding)
-                fh.write(tiddler_md)
+                    blocks = document(blocks)
+                json.dump(blocks, fh)
+            return fh.name, 'json'
+
+        with METRICS.span('write_markdown'), \
+                tempfile.NamedTemporaryFile('w', suffix='.md', delete=False) as fh:
+            if title_block:
+                title = '% {}\n' \
+                        '% {}\n' \
+                        '% {}\n\n'.format(self.title,
+                                          self.subtitle,
+                                          str(datetime.date.today()))
+                fh.write(title)
+            if heading is not None:
+                fh.write('# {}\n\n'.format(heading))
+
+            for fragment in fragments:
+                fh.write(fragment)
                 fh.write('\n\n---\n\n---\n\n')
+        return fh.name, 'md'
+
+    def write_source(self, tiddlers, format, backend, assets=None, title_block=True, heading=None):
+        '''writes the tiddlers to a temporary pandoc input file.
+        assets maps titles of binary tiddlers to their asset files (see AssetDirectory).
+        the file starts with the title block of the wiki (unless title_block is False)
+        and the top-level heading heading, if given.
+        returns the file name and its pandoc format ('md' or 'json').
+        '''
+        encoding = self.__encoding(format)
+        fragments = (self.__convert_tiddler(tiddler, encoding, backend, assets)
+                     for tiddler in METRICS.progress(tiddlers, desc='export'))
+        return self.__write_fragments(fragments, backend, title_block, heading)
+
+    def assets(self, directory, relative_to=None):
+        '''returns an AssetDirectory writing the binary tiddlers of the wiki to directory on demand,
+        referenced by paths relative to the directory relative_to (absolute paths if None).
+        '''
+        return AssetDirectory(directory, self, relative_to)
 
-        pypandoc.convert_file(fh.name,
-                              format,
-                              format='md',
-                              outputfile=path,
-                              extra_args=extra_args)
+    @contextlib.contextmanager
+    def __export_assets(self, path, format, assets_dir):
+        # the AssetDirectory of an export to path. a pdf embeds the images, so they are written
+        # to a temporary directory by default, which is removed after pandoc ran.
+        # other formats link to the assets relative to the directory of path
+        if format in {'pdf'}:
+            if assets_dir is None:
+                with tempfile.TemporaryDirectory() as directory:
+                    yield self.assets(directory)
+            else:
+                yield self.assets(assets_dir)
+            return
+
+        if assets_dir is None:
+            assets_dir = os.path.splitext(path)[0] + '_assets'
+        yield self.assets(assets_dir, relative_to=os.path.dirname(os.path.abspath(path)))
+
+    @staticmethod
+    def __resource_path(assets):
+        # pandoc looks up images to embed (e.g. in docx) relative to the working directory,
+        # so the directory relative asset paths refer to is added
+        if assets.relative_to is None:
+            return []
+        return ['--resource-path={}{}.'.format(assets.relative_to, os.pathsep)]
+
+    def export_to_file(self, path, *extra_args, format=None, predicates=None, key=lambda t: t.created,
+                       reverse=False, limit=None, backend='markdown', assets_dir=None):
+        '''export the (filtered) tiddlers sorted by key to a file at <path>.
+        if limit is given, only the first <limit> tiddlers in this order are exported,
+        e.g. the newest 50 with key=lambda t: t.created, reverse=True, limit=50.
+        with backend='ast' the tiddlers are converted to one pandoc json ast document
+        and pandoc is called once (-f json), without re-parsing intermediate markdown.
+        binary tiddlers (and images referring to them) are exported as references to files
+        in assets_dir, by default <path without extension>_assets (a temporary directory for pdf,
+        where the images are embedded), relative to the directory of path (absolute for pdf).
+        each distinct payload is written once.
+        '''
+        if format is None:
+            format = path.split('.')[-1]
+
+        with self.__export_assets(path, format, assets_dir) as assets:
+            with METRICS.span('select_tiddlers'):
+                tiddlers = self.__get_tiddlers(predicates, key, reverse, limit)
+
+            if format in {'pdf'}:
+                tiddlers = list(tiddlers)
+                with METRICS.span('safety_check', format=format):
+                    safe_tiddlers, non_safe_tiddlers = self.__get_safe_tiddlers_multithread(tiddlers, format,
+                                                                                            backend, assets)
+                # the checks complete in any order
+                safe_tiddlers.sort(key=key, reverse=reverse)
+            else:
+                safe_tiddlers = tiddlers
+                non_safe_tiddlers = []
+
+            source, source_format = self.write_source(safe_tiddlers, format, backend, assets)
+
+            with METRICS.span('export_wiki_to_file', format=format):
+                METRICS.convert_file(source,
+                                     format,
+                                     format=source_format,
+                                     outputfile=path,
+                                     extra_args=list(extra_args) + self.__resource_path(assets))
 
         if non_safe_tiddlers:
             msg = 'Could only export {} out of {} tiddlers.'
-            print(msg.format(len(safe_tiddlers), len(tiddlers)))
-            print("The following tiddlers raised a pandoc error:")
+            METRICS.progress.message(msg.format(len(safe_tiddlers), len(tiddlers)))
+            METRICS.progress.message("The following tiddlers raised a pandoc error:")
             for tiddler in non_safe_tiddlers:
-                print("\t{}".format(tiddler.title))
-
-    def open_in_browser(self, *extra_args, format='html', predicates=None, key=lambda t: t.created):
-
-        tiddlers = self.__get_tiddlers(predicates)
-        tiddlers.sort(key=key)
-        with tempfile.NamedTemporaryFile('w', suffix='.'+format, delete=False) as fh:
-            title = '% {}\n' \
-                    '% {}\n' \
-                    '% {}\n\n'.format(self.title,
-                                      self.subtitle,
-                                      str(datetime.date.today()))
-            result = title
-
-            for tiddler in tqdm.tqdm(tiddlers):
-                if format in {'pdf'}:
-                    encoding = 'latin-1'
+                METRICS.progress.message("\t{}".format(tiddler.title))
+
+    @staticmethod
+    def __shared_encoding(tiddler, encoding, backend, assets):
+        # the encoding strips the characters it lacks (see ExportTiddlerMixin.export_to_file),
+        # so a tiddler without such characters is converted once for all encodings, if they are stripped
+        # before anything could add some: the markdown export strips html only after pandoc converted it,
+        # and tw5 after its images were replaced by paths of assets
+        if encoding == 'utf-8':
+            return encoding
+        text = tiddler.title + str(tiddler.tags)
+        if not isinstance(tiddler, BinaryTiddler):  # the payload is never stripped
+            text += tiddler.content or ''
+        if backend != 'ast':
+            if tiddler.type_ == 'text/html':
+                return encoding
+            if tiddler.type_ == 'text/vnd.tiddlywiki' and assets is not None:
+                text += os.path.abspath(assets.directory)
+        try:
+            text.encode(encoding)
+        except UnicodeEncodeError:
+            return encoding
+        return 'utf-8'
+
+    def __check_pdf(self, fragment, backend):
+        # the safety check of export_to_file on an already converted tiddler, raises RuntimeError
+        with tempfile.NamedTemporaryFile('w', suffix='.pdf') as fh:
+            if backend == 'ast':
+                METRICS.convert_text(json.dumps(document(json.loads(fragment))), 'pdf', format='json',
+                                     outputfile=fh.name)
+            else:
+                METRICS.convert_text(fragment, 'pdf', format='md', outputfile=fh.name)
+
+    def export_targets(self, targets, backend='markdown', assets_dir=None):
+        """exports the wiki to several files at once, e.g. as html, md, pdf and per-tag pdfs.
+        targets are ExportTargets or tuples (path, format, predicates, key, reverse, limit, extra_args)
+        of the arguments of export_to_file, all but path optional.
+        each tiddler is converted once (once per encoding, if it has characters latin-1 lacks
+        or is html, whose characters are only known after its conversion),
+        and checked once for pdf targets, in parallel. then the targets are written in parallel
+        from the shared conversions. all targets share the assets directory assets_dir,
+        by default <path without extension>_assets of the first target that is not a pdf,
+        linked relative to the directory of the targets, if all targets but pdfs are in one directory.
+        returns a dict path -> list of the tiddlers that could not be exported to path.
+        """
+        targets = [ExportTarget(*target) if not isinstance(target, ExportTarget) else target
+                   for target in targets]
+        for target in targets:
+            if isinstance(target.extra_args, str):
+                msg = "extra_args of the target {} must be a list of arguments (e.g. ['--toc']), not a str"
+                raise TypeError(msg.format(target.path))
+        targets = [target._replace(format=target.format or target.path.split('.')[-1],
+                                   key=target.key or (lambda t: t.created))
+                   for target in targets]
+
+        # the conversions are shared, so links to assets are relative only if all targets
+        # but pdfs (which embed the images) are in one directory
+        paths = [target.path for target in targets if target.format not in {'pdf'}]
+        directories = {os.path.dirname(os.path.abspath(path)) for path in paths}
+        relative_to = directories.pop() if len(directories) == 1 else None
+
+        with contextlib.ExitStack() as stack:
+            if assets_dir is None:
+                if paths:
+                    assets_dir = os.path.splitext(paths[0])[0] + '_assets'
                 else:
-                    encoding = 'utf-8'
-                tiddler_md = tiddler.export(encoding=encoding)
-                result += tiddler_md
-                result += '\n\n---\n\n---\n\n'
-
-            pypandoc.convert_text(result,
-                                  format,
-                                  format='md',
-                                  outputfile=fh.name,
-                                  extra_args=extra_args)
-            webbrowser.get(using='chrome').open('file://' + fh.name, new=1)
+                    assets_dir = stack.enter_context(tempfile.TemporaryDirectory())
+            assets = self.assets(assets_dir, relative_to)
+
+            # (tiddler, encoding) -> whether the conversion is checked for pdf
+            conversions = {}
+            plans = []  # the conversions of each target in export order
+            with METRICS.span('select_tiddlers'):
+                for target in targets:
+                    encoding = self.__encoding(target.format)
+                    tiddlers = self.__get_tiddlers(target.predicates, target.key, target.reverse, target.limit)
+                    plan = [(tiddler, self.__shared_encoding(tiddler, encoding, backend, assets))
+                            for tiddler in tiddlers]
+                    for conversion in plan:
+                        conversions[conversion] = conversions.get(conversion, False) or target.format in {'pdf'}
+                    plans.append(plan)
+
+            fragments, non_safe = {}, set()
+            workers = max(1, min(len(conversions), self.__MAX_WORKERS))
+            with METRICS.span('convert_tiddlers', backend=backend), \
+                    concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                future_to_conversion = {}
+                for (tiddler, encoding), check in conversions.items():
+                    ftr = executor.submit(self.__convert_tiddler, tiddler, encoding, backend, assets)
+                    future_to_conversion[ftr] = (tiddler, encoding), check
+
+                checks = {}
+                futures = concurrent.futures.as_completed(future_to_conversion.keys())
+                for future in METRICS.progress(futures, total=len(future_to_conversion), desc='export'):
+                    conversion, check = future_to_conversion[future]
+                    fragments[conversion] = fragment = future.result()
+                    if check and fragment is not None:
+                        check = functools.partial(self.__check_pdf, fragment, backend)
+                        ftr = executor.submit(self.__check_safe, conversion[0], backend, assets, check)
+                        checks[ftr] = conversion
+
+                futures = concurrent.futures.as_completed(checks.keys())
+                for future in METRICS.progress(futures, total=len(checks), desc='safety check'):
+                    try:
+                        future.result()
+                    except RuntimeError as error:
+                        METRICS.progress.message(error)
+                        non_safe.add(checks[future])
+
+            def export(target, plan):
+                exported, failed = [], []
+                for conversion in plan:
+                    if fragments[conversion] is None or (target.format in {'pdf'} and conversion in non_safe):
+                        failed.append(conversion[0])
+                    else:
+                        exported.append(conversion)
+
+                source, source_format = self.__write_fragments((fragments[c] for c in exported), backend)
+                with METRICS.span('export_wiki_to_file', format=target.format):
+                    METRICS.convert_file(source, target.format, format=source_format, outputfile=target.path,
+                                         extra_args=list(target.extra_args) + self.__resource_path(assets))
+                return failed
+
+            with METRICS.span('export_targets'), \
+                    concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(targets))) as executor:
+                futures = [executor.submit(export, target, plan) for target, plan in zip(targets, plans)]
+                results = {target.path: future.result() for target, future in zip(targets, futures)}
+
+        for path, failed in results.items():
+            if failed:
+                METRICS.progress.message('{}: the following tiddlers could not be exported:'.format(path))
+                for tiddler in failed:
+                    METRICS.progress.message("\t{}".format(tiddler.title))
+        return results
+
+    @staticmethod
+    def __embed_args():
+        # the pandoc options embedding images into html, --self-contained is deprecated since pandoc 2.19
+        version = tuple(int(part) for part in re.findall('\\d+', pypandoc.get_pandoc_version())[:2])
+        return ['--embed-resources', '--standalone'] if version >= (2, 19) else ['--self-contained']
+
+    def open_in_browser(self, *extra_args, format='html', predicates=None, key=lambda t: t.created,
+                        reverse=False, limit=None, backend='markdown', assets_dir=None):
 
+        tiddlers = self.__get_tiddlers(predicates, key, reverse, limit)
+        with contextlib.ExitStack() as stack:
+            embed = assets_dir is None
+            if embed:
+                # the images are embedded into the file (html by pandoc's option, pdf, docx etc. always),
+                # so the assets are written to a temporary directory, which is removed after pandoc ran
+                assets_dir = stack.enter_context(tempfile.TemporaryDirectory())
+            assets = self.assets(assets_dir)
+            if embed and format.startswith('html'):
+                tiddlers = list(tiddlers)
+                if assets.referenced_titles(tiddlers):
+                    extra_args = list(extra_args) + self.__embed_args()
+            source, source_format = self.write_source(tiddlers, format, backend, assets)
+            with tempfile.NamedTemporaryFile('w', suffix='.'+format, delete=False) as fh:
+                METRICS.convert_file(source,
+                                     format,
+                                     format=source_format,
+                                     outputfile=fh.name,
+                                     extra_args=extra_args)
+        webbrowser.get(using='chrome').open('file://' + fh.name, new=1)
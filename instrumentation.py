@@ -0,0 +1,191 @@
+import collections
+import contextlib
+import json
+import threading
+import time
+
+import pypandoc
+import tqdm
+
+
+class Progress:
+    '''pluggable progress reporting used by the export pipeline.
+    subclass it and assign an instance to METRICS.progress to replace the default tqdm bars.
+    '''
+
+    def __call__(self, iterable, total=None, desc=None):
+        '''wraps an iterable whose consumption should be reported.'''
+        return iterable
+
+    def message(self, text):
+        '''reports a message, e.g. a pandoc error of a single tiddler.'''
+
+
+class TqdmProgress(Progress):
+    '''the default: tqdm progress bars and printed messages.'''
+
+    def __call__(self, iterable, total=None, desc=None):
+        return tqdm.tqdm(iterable, total=total, desc=desc)
+
+    def message(self, text):
+        print(text)
+
+
+class NullProgress(Progress):
+    '''silent progress reporting, e.g. for cron jobs and benchmarks.'''
+
+
+Span = collections.namedtuple('Span', ['stage', 'labels', 'start', 'seconds'])
+
+
+class Instrumentation:
+    '''collects timing spans per stage (and per tiddler), counters such as
+    pandoc invocations and cache hits, and forwards every event to hooks.
+
+    a hook is a callable getting one event dict, e.g.
+    {'type': 'span', 'stage': 'export_content', 'seconds': 0.1, 'labels': {'tiddler': 'title'}}
+    or {'type': 'count', 'name': 'pandoc_calls', 'value': 1, 'labels': {'from': 'md', 'to': 'pdf'}}.
+    '''
+
+    def __init__(self, progress=None, max_spans=100000):
+        self.progress = TqdmProgress() if progress is None else progress
+        self.hooks = []
+        self.__lock = threading.Lock()
+        self.__max_spans = max_spans
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.spans = collections.deque(maxlen=self.__max_spans)
+            self.stages = {}
+            self.counters = collections.Counter()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def __emit(self, event):
+        for hook in self.hooks:
+            hook(event)
+
+    def record(self, stage, seconds, start=None, **labels):
+        with self.__lock:
+            self.spans.append(Span(stage, labels, start, seconds))
+            calls, total, minimum, maximum = self.stages.get(stage, (0, 0.0, seconds, seconds))
+            self.stages[stage] = (calls + 1, total + seconds, min(minimum, seconds), max(maximum, seconds))
+        self.__emit({'type': 'span', 'stage': stage, 'seconds': seconds, 'labels': labels})
+
+    @contextlib.contextmanager
+    def span(self, stage, **labels):
+        '''times the enclosed block as one span of stage, e.g.
+
+            with METRICS.span('export_content', tiddler=tiddler.title):
+                ...
+        '''
+        start = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - t0, start, **labels)
+
+    def replay(self, events):
+        '''records the span and count events collected by a hook in another process, e.g. a worker.'''
+        for event in events:
+            if event['type'] == 'span':
+                self.record(event['stage'], event['seconds'], **event['labels'])
+            else:
+                self.count(event['name'], event['value'], **event['labels'])
+
+    def count(self, name, value=1, **labels):
+        with self.__lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+        self.__emit({'type': 'count', 'name': name, 'value': value, 'labels': labels})
+
+    def cache(self, name, hit):
+        '''accounts a lookup in the cache called name.'''
+        self.count('cache_hits' if hit else 'cache_misses', cache=name)
+
+    def convert_text(self, source, to, format, **kwargs):
+        '''pypandoc.convert_text, counted and timed as a pandoc invocation.'''
+        self.count('pandoc_calls', **{'from': format, 'to': to})
+        with self.span('pandoc', **{'from': format, 'to': to}):
+            return pypandoc.convert_text(source, to, format=format, **kwargs)
+
+    def convert_file(self, source_file, to, format, **kwargs):
+        '''pypandoc.convert_file, counted and timed as a pandoc invocation.'''
+        self.count('pandoc_calls', **{'from': format, 'to': to})
+        with self.span('pandoc', **{'from': format, 'to': to}):
+            return pypandoc.convert_file(source_file, to, format=format, **kwargs)
+
+    def summary(self):
+        '''returns the aggregated timings per stage and all counters.'''
+        with self.__lock:
+            stages = {stage: {'calls': calls, 'seconds': total, 'min': minimum, 'max': maximum}
+                      for stage, (calls, total, minimum, maximum) in self.stages.items()}
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in self.counters.items()]
+        return {'stages': stages, 'counters': counters}
+
+    def to_json(self, spans=False, **kwargs):
+        '''exports the summary as json, including the recorded spans if spans is True.'''
+        result = self.summary()
+        if spans:
+            with self.__lock:
+                result['spans'] = [span._asdict() for span in self.spans]
+        return json.dumps(result, **kwargs)
+
+    def to_prometheus(self, prefix='pytiddlywiki'):
+        '''exports the summary in the prometheus text exposition format.
+        spans are aggregated per stage (not per tiddler) to keep the label cardinality low.
+        '''
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+        def labels(items):
+            if not items:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, escape(v)) for k, v in items) + '}'
+
+        summary = self.summary()
+        lines = ['# TYPE {}_stage_seconds_total counter'.format(prefix)]
+        for stage, values in sorted(summary['stages'].items()):
+            lines.append('{}_stage_seconds_total{} {}'.format(prefix, labels([('stage', stage)]),
+                                                               values['seconds']))
+        lines.append('# TYPE {}_stage_calls_total counter'.format(prefix))
+        for stage, values in sorted(summary['stages'].items()):
+            lines.append('{}_stage_calls_total{} {}'.format(prefix, labels([('stage', stage)]),
+                                                             values['calls']))
+
+        names = sorted({counter['name'] for counter in summary['counters']})
+        for name in names:
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+            for counter in summary['counters']:
+                if counter['name'] == name:
+                    lines.append('{}_{}_total{} {}'.format(prefix, name,
+                                                          labels(sorted(counter['labels'].items())),
+                                                          counter['value']))
+        return '\n'.join(lines) + '\n'
+
+
+# the instrumentation used throughout PyTiddlyWiki
+METRICS = Instrumentation()
+
+
+if __name__ == "__main__":
+
+    # import the module by name, the instance in __main__ is not the one used by tiddlywiki
+    from instrumentation import METRICS, NullProgress
+    from tiddlywiki import TiddlyWiki
+
+    METRICS.progress = NullProgress()
+    METRICS.add_hook(lambda event: event['type'] == 'count' and print(event))
+
+    tw5 = TiddlyWiki.parse_from_html('./example/tw5.html')
+    tw5.export_to_file('./tw5.md')
+
+    print(METRICS.to_json(indent=2))
+    print(METRICS.to_prometheus())
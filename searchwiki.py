@@ -1,14 +1,13 @@
-import random
+from algorithm import reservoir_sample
 
 
 class SearchWikiMixin:
 
     def get_random_tiddler(self, *predicates):
-        if predicates is None:
-            available = self.tiddlers
-        else:
-            available = list(self.finditer(*predicates))
-        return random.choice(available)
+        sample = reservoir_sample(self.finditer(*predicates), 1)
+        if not sample:
+            raise IndexError('no tiddler satisfies the predicates')
+        return sample[0]
 
     def find_tiddler(self, *predicates):
         for tiddler in self:
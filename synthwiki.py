@@ -0,0 +1,237 @@
+import base64
+import datetime
+import json
+import random
+
+from convertstrings import ConvertStringsMixin
+
+
+class SyntheticWiki:
+    '''deterministic generator of synthetic TiddlyWiki html files for benchmarks.
+    the same parameters (including seed) always produce the same html string.
+
+    tiddlers     number of (non-system) text tiddlers
+    body_size    approximate number of characters of each tiddler body
+    tag_count    number of distinct tags (cardinality), each tiddler gets 0 to 3 of them
+    markup       dict of relative weights of the tw5 markup blocks in a body, see MARKUP
+    images       number of embedded base64 image/png tiddlers, referenced via [img[...]]
+    image_size   number of raw bytes of each image payload
+    store        'div' for the <div> store area (TiddlyWiki < 5.2),
+                 'json' for the json tiddler store (TiddlyWiki >= 5.2)
+    '''
+
+    MARKUP = {'paragraph': 10, 'heading': 2, 'list': 3, 'bold': 2, 'italic': 2, 'link': 2,
+              'katex': 1, 'quote': 1, 'multiline': 1, 'separator': 1}
+
+    WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+             'incididunt ut labore et dolore magna aliqua ut enim ad minim veniam quis '
+             'nostrud exercitation ullamco laboris nisi aliquip ex ea commodo consequat').split()
+
+    START = datetime.datetime(2018, 1, 1)
+
+    def __init__(self, tiddlers=1000, body_size=500, tag_count=20, markup=None,
+                 images=0, image_size=2048, store='div', seed=0):
+        if store not in {'div', 'json'}:
+            raise ValueError("store must be 'div' or 'json', not {!r}".format(store))
+        self.tiddlers = tiddlers
+        self.body_size = body_size
+        self.tag_count = tag_count
+        self.markup = dict(self.MARKUP if markup is None else markup)
+        self.images = images
+        self.image_size = image_size
+        self.store = store
+        self.seed = seed
+
+    def __words(self, rng, n):
+        return ' '.join(rng.choice(self.WORDS) for _ in range(n))
+
+    def __block(self, rng, kind, titles):
+        if kind == 'paragraph':
+            return self.__words(rng, rng.randint(8, 30))
+        if kind == 'heading':
+            return '!' * rng.randint(1, 3) + ' ' + self.__words(rng, 3)
+        if kind == 'list':
+            return '\n'.join(rng.choice(['*', '**', '#', '*#']) + ' ' + self.__words(rng, 4)
+                             for _ in range(rng.randint(2, 5)))
+        if kind == 'bold':
+            return "some ''{}'' text".format(self.__words(rng, 3))
+        if kind == 'italic':
+            return 'some //{}// text'.format(self.__words(rng, 3))
+        if kind == 'link':
+            if titles and rng.random() < 0.5:
+                return 'see [[{}]]'.format(rng.choice(titles))
+            return 'see [[{}|https://example.org/{}]]'.format(self.__words(rng, 2), rng.randint(0, 999))
+        if kind == 'katex':
+            if rng.random() < 0.5:
+                return 'inline $$a^{0}+b^{0}=c^{0}$$ formula'.format(rng.randint(2, 9))
+            return '$$\n\\sum_{{i=1}}^{{{}}} i^2\n$$'.format(rng.randint(2, 99))
+        if kind == 'quote':
+            return '<<< {}\n{}\n<<< {}'.format(self.__words(rng, 8), self.__words(rng, 8), self.__words(rng, 2))
+        if kind == 'multiline':
+            return '"""\n{}\n{}\n"""'.format(self.__words(rng, 4), self.__words(rng, 4))
+        if kind == 'separator':
+            return '---'
+        raise ValueError('unknown markup {!r}'.format(kind))
+
+    def __body(self, rng, image_titles):
+        kinds = list(self.markup)
+        weights = [self.markup[kind] for kind in kinds]
+        blocks = []
+        size = 0
+        while size < self.body_size:
+            if image_titles and rng.random() < 0.05:
+                block = '[img[{}]]'.format(rng.choice(image_titles))
+            else:
+                block = self.__block(rng, rng.choices(kinds, weights)[0], image_titles)
+            blocks.append(block)
+            size += len(block) + 2
+        return '\n\n'.join(blocks)
+
+    @staticmethod
+    def date_string(date):
+        return date.strftime('%Y%m%d%H%M%S') + '000'
+
+    @staticmethod
+    def tag_string(tags):
+        return ' '.join('[[{}]]'.format(tag) if ' ' in tag else tag for tag in tags)
+
+    def records(self):
+        '''returns the list of tiddler field dicts (with unescaped 'text'),
+        including two system tiddlers which are skipped by the parser.
+        '''
+        rng = random.Random(self.seed)
+        tags = ['tag{}'.format(i) if i % 5 else 'multi word tag{}'.format(i)
+                for i in range(self.tag_count)]
+
+        records = [{'title': '$:/SiteTitle', 'text': 'Synthetic Wiki'},
+                   {'title': '$:/SiteSubtitle', 'text': 'generated'}]
+
+        image_titles = []
+        for i in range(self.images):
+            title = 'image {}.png'.format(i)
+            payload = bytes(rng.getrandbits(8) for _ in range(self.image_size))
+            created = self.START + datetime.timedelta(minutes=i)
+            records.append({'created': self.date_string(created),
+                            'modified': self.date_string(created),
+                            'title': title,
+                            'type': 'image/png',
+                            'text': base64.b64encode(payload).decode('ascii')})
+            image_titles.append(title)
+
+        for i in range(self.tiddlers):
+            created = self.START + datetime.timedelta(hours=i, seconds=rng.randint(0, 3599))
+            modified = created + datetime.timedelta(seconds=rng.randint(0, 86400))
+            record = {'created': self.date_string(created),
+                      'modified': self.date_string(modified),
+                      'title': 'tiddler {} {}'.format(i, self.__words(rng, 2)),
+                      'type': 'text/vnd.tiddlywiki',
+                      'text': self.__body(rng, image_titles)}
+            if tags:
+                record['tags'] = self.tag_string(rng.sample(tags, rng.randint(0, min(3, len(tags)))))
+            records.append(record)
+
+        return records
+
+    def __div_store(self, records):
+        encode = ConvertStringsMixin.html_encode
+        divs = []
+        for record in records:
+            options = ''.join(' {}="{}"'.format(key, encode(value))
+                              for key, value in sorted(record.items()) if key != 'text')
+            divs.append('<div{}>\n<pre>{}</pre>\n</div>'.format(options, encode(record['text'])))
+        return ('<div id="storeArea" style="display:none;">\n' +
+                '\n'.join(divs) +
+                '\n</div>')
+
+    @staticmethod
+    def __json_store(records):
+        store = json.dumps(records, ensure_ascii=False).replace('<', '\\u003C')
+        return ('<script class="tiddlywiki-tiddler-store" type="application/json">' +
+                store +
+                '</script>\n'
+                '<div id="storeArea" style="display:none;"></div>')
+
+    def html(self):
+        records = self.records()
+        if self.store == 'div':
+            store = self.__div_store(records)
+        else:
+            store = self.__json_store(records)
+
+        return ('<!doctype html>\n'
+                '<html>\n'
+                '<head>\n'
+                '<meta charset="utf-8" />\n'
+                '<title>Synthetic Wiki — generated</title>\n'
+                '</head>\n'
+                '<body class="tc-body">\n'
+                '<div id="styleArea">\n</div>\n' +
+                store +
+                '\n</body>\n'
+                '</html>\n')
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf8') as fh:
+            fh.write(self.html())
+        return path
+
+
+class PathologicalCorpus:
+    '''malformed inputs for worst-case benchmarks of parsing and conversion,
+    each a unit repeated to size characters.
+    they made the former regular expressions backtrack quadratically (or worse),
+    with linear-time parsing and conversion the time must double with the size.
+    '''
+
+    # tw5 texts of tiddler bodies
+    TEXTS = {'unclosed_link': '[[a|',
+             'unclosed_brackets': '[[',
+             'bracket_in_link': '[[a]b|',
+             'brackets_in_links': '[[a [b] c|d]] ',
+             'unclosed_image': '[img[',
+             'image_options': '[img x',
+             'bold': "''a",
+             'italic': '//a ',
+             'urls': 'http://',
+             'quote_one_line': '<<<',
+             'quote_lines': '<<< a\n',
+             'katex': '$$ ',
+             'display_math': '$$\n',
+             'multiline': '"""\n',
+             'code_fences': '```\n',
+             'headings': '!',
+             'deep_list': '*',
+             'spaces': ' ',
+             'tildes': '~',
+             'mixed': "[[''//~~^^,,`$$"}
+
+    # html store areas
+    STORES = {'unclosed_div': '<div ',
+              'unclosed_pre': '<div title="a" created="20180101000000">\n<pre>',
+              'unclosed_attribute': ' a="',
+              'spaces_in_div': '<div' + ' ' * 50,
+              'unclosed_script': '<script class="tiddlywiki-tiddler-store" type="application/json">'}
+
+    @staticmethod
+    def repeat(unit, size):
+        return unit * max(1, size // len(unit))
+
+    @classmethod
+    def texts(cls, size):
+        return {name: cls.repeat(unit, size) for name, unit in cls.TEXTS.items()}
+
+    @classmethod
+    def stores(cls, size):
+        return {name: cls.repeat(unit, size) for name, unit in cls.STORES.items()}
+
+
+if __name__ == "__main__":
+
+    from tiddlywiki import TiddlyWiki
+
+    for store in ('div', 'json'):
+        html = SyntheticWiki(tiddlers=5, body_size=200, images=1, store=store).html()
+        tw5 = TiddlyWiki.parse_from_string(html)
+        print(store, tw5.title, tw5.subtitle, len(html))
+        for tiddler in tw5:
+            print(tiddler)
@@ -0,0 +1,64 @@
+import collections
+import random
+
+import pytest
+
+from algorithm import Pipeline, reservoir_sample
+from tiddler import Tiddler
+from tiddlywiki import TiddlyWiki
+
+
+@pytest.fixture
+def wiki():
+    rng = random.Random(1)
+    # duplicate keys, so that the order of ties is checked too
+    return TiddlyWiki(tiddlers=[Tiddler('content', title='tiddler {}'.format(i), created=rng.randrange(20))
+                                for i in range(100)])
+
+
+@pytest.mark.parametrize('reverse', [False, True])
+@pytest.mark.parametrize('n', [0, 1, 10, 100, 200])
+def test_sort_limit(wiki, reverse, n):
+    key = lambda t: t.created
+    expected = sorted(wiki, key=key, reverse=reverse)[:n]
+    assert list(wiki.apply(Pipeline().sort(key, reverse).limit(n))) == expected
+
+
+def test_filter_sort_limit(wiki):
+    key = lambda t: t.created
+    even = lambda t: t.created % 2 == 0
+    small = lambda t: t.created < 10
+    pipeline = Pipeline().filter(even).filter(small).sort(key, reverse=True).limit(7)
+    assert list(wiki.apply(pipeline)) == sorted((t for t in wiki if even(t) and small(t)),
+                                                key=key, reverse=True)[:7]
+
+
+def test_limit_is_lazy():
+    def tiddlers():
+        yield from range(3)
+        raise AssertionError('limit read past its end')
+
+    assert list(Pipeline().limit(3).evaluate(tiddlers())) == [0, 1, 2]
+
+
+def test_group(wiki):
+    groups = wiki.apply(Pipeline().filter(lambda t: t.created < 3).group(lambda t: t.created))
+    assert sorted(groups) == [0, 1, 2]
+    assert all(t.created == created for created, tiddlers in groups.items() for t in tiddlers)
+    with pytest.raises(ValueError):
+        Pipeline().group(len).limit(1)
+
+
+def test_reservoir_sample_short():
+    assert sorted(reservoir_sample(range(3), 5)) == [0, 1, 2]
+    assert reservoir_sample([], 1) == []
+
+
+def test_reservoir_sample_uniform():
+    rng = random.Random(0)
+    n, k, runs = 10, 3, 20000
+    counts = collections.Counter(item for _ in range(runs) for item in reservoir_sample(range(n), k, rng))
+    expected = runs * k / n
+    # chi-squared test, 9 degrees of freedom: P(chi2 > 27.9) = 0.001
+    chi2 = sum((counts[item] - expected) ** 2 / expected for item in range(n))
+    assert chi2 < 27.9
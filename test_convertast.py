@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+from convertast import ConvertASTMixin, assign_identifiers, stringify
+from instrumentation import METRICS
+from tiddlywiki import TiddlyWiki
+
+convert = ConvertASTMixin.convert_tw5_to_ast
+
+
+def pandoc_calls():
+    return sum(value for (name, _), value in METRICS.counters.items() if name == 'pandoc_calls')
+
+
+def plain_words(path):
+    # the markdown reader of pandoc applies smart typography and breaks lines differently
+    with open(path, encoding='utf8') as fh:
+        text = fh.read()
+    for smart, plain in (('‘', "'"), ('’', "'"), ('“', '"'), ('”', '"'), ('…', '...'), ('—', '---'), ('–', '--')):
+        text = text.replace(smart, plain)
+    return text.split()
+
+
+def test_backends_match_on_example_wiki(tmp_path):
+    wiki = TiddlyWiki.parse_from_html('./example/tw5.html')
+    words, calls = {}, {}
+    for backend in ('markdown', 'ast'):
+        METRICS.reset()
+        path = str(tmp_path / '{}.txt'.format(backend))
+        wiki.export_to_file(path, format='plain', backend=backend, assets_dir=str(tmp_path / 'assets'))
+        words[backend], calls[backend] = plain_words(path), pandoc_calls()
+    assert words['ast'] == words['markdown']
+    # the markdown backend calls pandoc per tiddler, the ast backend once (and once for the api version)
+    assert calls['ast'] <= 2 < len(wiki) <= calls['markdown']
+
+
+@pytest.mark.parametrize('text, plain', [
+    ('~CamelCase and ~WikiLink', 'CamelCase and WikiLink'),
+    ('~/home ~lower ~Upper a~b ~', '~/home ~lower ~Upper a~b ~'),
+    ('~~strike~~ ~~ ~A1B', 'strike ~~ A1B'),
+])
+def test_tilde(text, plain):
+    assert stringify(convert(text)[0]['c']) == plain
+
+
+def headers(node):
+    if isinstance(node, list):
+        return [header for child in node for header in headers(child)]
+    if isinstance(node, dict):
+        if node.get('t') == 'Header':
+            return [node['c'][1][0]]
+        return headers(node.get('c'))
+    return []
+
+
+def test_nested_identifiers():
+    blocks = convert('! Title\n<<<\n! Title\n!! 2. Été\n<<<\n! 2018-01-01\n! 2018-01-01')
+    markdown = '# Title\n\n> # Title\n> ## 2. Été\n\n# 2018-01-01\n\n# 2018-01-01\n'
+    expected = headers(json.loads(METRICS.convert_text(markdown, 'json', format='md'))['blocks'])
+    assert headers(assign_identifiers(blocks)) == expected == ['title', 'title-1', 'été', 'section', 'section-1']
+
+
+def test_identifiers_are_kept():
+    blocks = [{'t': 'Header', 'c': [1, ['own', [], []], []]}, {'t': 'Header', 'c': [1, ['', [], []], []]}]
+    assert headers(assign_identifiers(blocks)) == ['own', 'section']
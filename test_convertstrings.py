@@ -0,0 +1,85 @@
+import time
+
+import pytest
+
+from convertstrings import ConvertStringsMixin
+from synthwiki import PathologicalCorpus
+
+convert = ConvertStringsMixin.convert_tw5_to_md
+
+
+# the outputs of the baseline conversion
+@pytest.mark.parametrize('text, md', [
+    ('see [[Foo [bar] baz]] ok', 'see [Foo [bar] baz](Foo [bar] baz) ok'),
+    ('see [[Foo [bar]|https://example.org/[x]]] ok', 'see [Foo [bar]](https://example.org/[x)] ok'),
+    ('[[a|b]] and [[c]]', '[a](b) and [c](c)'),
+    ('[[a [[b]]', '[a [[b](a [[b)'),
+    ('[[[a]]', '[[a]([a)'),
+    ('[[a|b|c]]', '[a](b|c)'),
+    ("[[''bold'' x|y]] ''bold''", '[__bold__ x](y) __bold__'),
+    ('[[a]] [b] [[c|d]]', '[a](a) [b] [c](d)'),
+    ('no [[link', 'no [[link'),
+    ('[[|x]] [[y]]', '[[|x]] [y](y)'),
+    ('<<< quote\nlines\n<<< ref\nafter', '> quote\n> lines\n> (ref)\nafter'),
+    ('<<< quote\n<<< ref', '<<< quote\n<<< ref'),
+])
+def test_convert_tw5_to_md(text, md):
+    assert convert(text) == md
+
+
+@pytest.mark.parametrize('tag_string, tags', [
+    ('a b c', ['a', 'b', 'c']),
+    ('[[a b]]', ['a b']),
+    ('[[a[b]] c', ['a[b', 'c']),
+    ('[[a]b]] c]] d', ['a]b', 'c]]', 'd']),
+    ('[[a|b]] c', ['a|b', 'c']),
+    ('[[x]]y', ['x', 'y']),
+    ('a [[b c]] d [[e f]]', ['a', 'b c', 'd', 'e f']),
+])
+def test_get_tag_list(tag_string, tags):
+    assert ConvertStringsMixin.get_tag_list(tag_string) == tags
+
+
+@pytest.mark.parametrize('tags', [
+    ['a', 'b c', 'd', 'e f'],
+    ['c]]', 'a b', 'x]]y', ']]'],
+    ['[[x', 'y]]', 'a[[b', '[a b', 'a [b] c', 'tab\tbed'],
+    ['a|b', 'c d|e', '[', ']'],
+])
+def test_tag_string_round_trip(tags):
+    tag_string = ConvertStringsMixin.get_tag_string(tags)
+    assert ConvertStringsMixin.get_tag_list(tag_string) == tags
+    assert ConvertStringsMixin.get_tag_string(ConvertStringsMixin.get_tag_list(tag_string)) == tag_string
+
+
+def test_tag_string_empty_tags():
+    assert ConvertStringsMixin.get_tag_string(['', 'a', '', 'b c']) == 'a [[b c]]'
+    assert ConvertStringsMixin.get_tag_list(ConvertStringsMixin.get_tag_string([''])) == []
+
+
+@pytest.mark.parametrize('tag', ['a]] b', 'a b]', 'a\nb', '[[x]]'])
+def test_tag_string_unreadable_tags(tag):
+    with pytest.raises(ValueError):
+        ConvertStringsMixin.get_tag_string([tag])
+
+
+def test_no_empty_tags():
+    assert '' not in ConvertStringsMixin.get_tag_list('[[]] a [[]]')
+
+
+def test_iter_links():
+    text = '[[a]] [[b|c]] [[]] [[|d]] [[e\nf]]'
+    assert [link[2:] for link in ConvertStringsMixin.iter_links(text)] == \
+        [(None, 'a'), ('b', 'c'), (None, 'e\nf')]
+    assert [link[2:] for link in ConvertStringsMixin.iter_links(text, names=False, multiline=False)] == \
+        [(None, 'a'), (None, 'b|c'), (None, '|d')]
+
+
+@pytest.mark.parametrize('text', ['[[' * 50000 + ']]', '[[a|' * 50000 + ']]', '[[a\n' * 50000 + ']]',
+                                  PathologicalCorpus.repeat(PathologicalCorpus.TEXTS['brackets_in_links'], 200000)])
+def test_links_linear(text):
+    # a quadratic scan of these takes minutes
+    start = time.perf_counter()
+    convert(text)
+    ConvertStringsMixin.get_tag_list(text)
+    assert time.perf_counter() - start < 5
@@ -0,0 +1,101 @@
+import pytest
+
+from diffwiki import merge_lines
+from synthwiki import SyntheticWiki
+from tiddler import Tiddler
+from tiddlywiki import TiddlyWiki
+
+BASE = ['a\n', 'b\n', 'c\n', 'd\n', 'e\n']
+
+
+def test_merge_lines_unchanged():
+    assert merge_lines(BASE, BASE, BASE) == BASE
+
+
+def test_merge_lines_one_side():
+    ours = ['a\n', 'B\n', 'c\n', 'd\n', 'e\n']
+    assert merge_lines(BASE, ours, BASE) == ours
+    assert merge_lines(BASE, BASE, ours) == ours
+
+
+def test_merge_lines_both_sides():
+    ours = ['a\n', 'B\n', 'c\n', 'd\n', 'e\n']
+    theirs = ['a\n', 'b\n', 'c\n', 'd\n', 'E\n', 'f\n']
+    assert merge_lines(BASE, ours, theirs) == ['a\n', 'B\n', 'c\n', 'd\n', 'E\n', 'f\n']
+
+
+def test_merge_lines_same_change():
+    ours = ['a\n', 'c\n', 'd\n', 'x\n', 'e\n']
+    assert merge_lines(BASE, ours, list(ours)) == ours
+
+
+def test_merge_lines_insert_and_delete():
+    ours = ['x\n'] + BASE
+    theirs = ['a\n', 'b\n', 'c\n', 'e\n']
+    assert merge_lines(BASE, ours, theirs) == ['x\n', 'a\n', 'b\n', 'c\n', 'e\n']
+
+
+@pytest.mark.parametrize('ours, theirs', [
+    (['a\n', 'B\n', 'c\n', 'd\n', 'e\n'], ['a\n', 'X\n', 'c\n', 'd\n', 'e\n']),  # the same line
+    (['a\n', 'B\n', 'c\n', 'd\n', 'e\n'], ['a\n', 'b\n', 'C\n', 'd\n', 'e\n']),  # adjacent lines
+    (['a\n', 'e\n'], ['a\n', 'b\n', 'X\n', 'd\n', 'e\n']),                       # edit of deleted lines
+    (BASE + ['x\n'], BASE + ['y\n']),                                              # appended lines
+])
+def test_merge_lines_conflict(ours, theirs):
+    assert merge_lines(BASE, ours, theirs) is None
+
+
+@pytest.fixture
+def wiki_path(tmp_path):
+    return SyntheticWiki(tiddlers=30).write(str(tmp_path / 'wiki.html'))
+
+
+def test_diff(wiki_path):
+    old, new = TiddlyWiki.parse_from_html(wiki_path), TiddlyWiki.parse_from_html(wiki_path)
+    assert not old.diff(new)
+
+    new[0].content += '\nadded'
+    new[1].tags.append('new')
+    removed = new[2]
+    new.remove_tiddler(removed)
+    added = Tiddler(title='added', content='text')
+    new.add_tiddler(added)
+
+    diff = old.diff(new)
+    assert [t.title for t in diff.added] == ['added']
+    assert [t.title for t in diff.removed] == [removed.title]
+    assert [(change.title, change.fields) for change in diff.changed] == \
+        [(new[0].title, ['content']), (new[1].title, ['tags'])]
+    assert ''.join(diff.changed[0].content_diff()).endswith('+added\n\\ No newline at end of file\n')
+
+
+def test_diff_duplicates(wiki_path):
+    old, new = TiddlyWiki.parse_from_html(wiki_path), TiddlyWiki.parse_from_html(wiki_path)
+    new.add_tiddler(Tiddler(title=new[0].title, content='duplicate'))
+    diff = new.diff(old)
+    assert [t.title for t in diff.duplicates] == [new[0].title]
+    with pytest.raises(ValueError):
+        new.merge(old, old)
+
+
+def test_merge(wiki_path, tmp_path):
+    base, ours, theirs = (TiddlyWiki.parse_from_html(wiki_path) for _ in range(3))
+    ours[0].content = 'first line by us\n' + ours[0].content
+    theirs[0].content += '\nlast line by them'
+    ours[1].caption = 'ours'
+    theirs[1].caption = 'theirs'
+    theirs.remove_tiddler(theirs[2])
+
+    result = ours.merge(base, theirs)
+    assert [(conflict.title, conflict.kind, conflict.fields) for conflict in result.conflicts] == \
+        [(ours[1].title, 'edit/edit', ['caption'])]
+    merged = result.wiki.title_index()
+    assert merged[ours[0].title].content.startswith('first line by us\n')
+    assert merged[ours[0].title].content.endswith('\nlast line by them')
+    assert merged[ours[1].title].caption == 'ours'
+    assert ours[2].title not in merged
+
+    # the merge is spliced into the html of ours
+    path = str(tmp_path / 'merged.html')
+    result.wiki.save_html(path)
+    assert not result.wiki.diff(TiddlyWiki.parse_from_html(path))
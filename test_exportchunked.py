@@ -0,0 +1,106 @@
+import glob
+import os
+import tempfile
+
+import pypandoc
+import pypdf
+import pytest
+
+from instrumentation import METRICS
+from tiddler import Tiddler
+from tiddlywiki import TiddlyWiki
+
+
+@pytest.fixture
+def sources(tmp_path, monkeypatch):
+    # pandoc (and latex) is stubbed in the worker processes (forked after the monkeypatch):
+    # tiddlers containing BROKEN always fail, those containing FLAKY fail once.
+    # every source is kept in the returned directory
+    directory = tmp_path / 'sources'
+    directory.mkdir()
+
+    def convert_file(source_file, to, format, outputfile, extra_args=()):
+        with open(source_file, encoding='utf8') as fh:
+            source = fh.read()
+        with tempfile.NamedTemporaryFile('w', dir=str(directory), delete=False, encoding='utf8') as fh:
+            fh.write(source)
+        flaky = tmp_path / 'flaky'
+        if 'BROKEN' in source or ('FLAKY' in source and not flaky.exists()):
+            flaky.touch()
+            raise RuntimeError('stubbed pandoc failed')
+        writer = pypdf.PdfWriter()
+        writer.add_blank_page(100, 100)
+        with open(outputfile, 'wb') as fh:
+            writer.write(fh)
+
+    monkeypatch.setattr(pypandoc, 'convert_file', convert_file)
+    return directory
+
+
+def read_sources(directory):
+    result = []
+    for path in glob.glob(os.path.join(str(directory), '*')):
+        with open(path, encoding='utf8') as fh:
+            result.append(fh.read())
+    return result
+
+
+def make_wiki(contents):
+    return TiddlyWiki(title='Title', subtitle='Subtitle',
+                      tiddlers=[Tiddler(content, title='tiddler {}'.format(i), created=i)
+                                for i, content in enumerate(contents)])
+
+
+def counter(name):
+    return sum(value for (counter_name, _), value in METRICS.counters.items() if counter_name == name)
+
+
+def test_chunks_are_merged(sources, tmp_path):
+    wiki = make_wiki(['text'] * 5)
+    path = str(tmp_path / 'wiki.pdf')
+    METRICS.reset()
+    assert wiki.export_to_pdf_chunked(path, '--toc', chunk_size=2, max_workers=2) == []
+
+    reader = pypdf.PdfReader(path)
+    assert len(reader.pages) == 3
+    assert [item.title for item in reader.outline] == ['1-2', '3-4', '5-5']
+    assert counter('pdf_chunks') == 3
+
+    # one title block for the whole export, the labels as headings
+    texts = read_sources(sources)
+    assert sum(text.startswith('% Title\n% Subtitle\n') for text in texts) == 1
+    headings = [line for text in texts for line in text.split('\n')
+                if line.startswith('# ') and not line.startswith('# tiddler')]
+    assert sorted(headings) == ['# 1-2', '# 3-4', '# 5-5']
+
+
+def test_failing_tiddler_is_bisected(sources, tmp_path):
+    wiki = make_wiki(['text', 'text', 'BROKEN', 'text', 'text'])
+    path = str(tmp_path / 'wiki.pdf')
+    METRICS.reset()
+    failed = wiki.export_to_pdf_chunked(path, chunk_size=4, max_workers=2, retries=1)
+
+    assert [t.title for t in failed] == ['tiddler 2']
+    # chunk 1-4 is retried once and bisected into [0, 1] and [2, 3], then [2, 3] into [2] and [3]
+    assert counter('pdf_chunk_retries') == 3
+    assert counter('pdf_chunk_bisections') == 2
+    reader = pypdf.PdfReader(path)
+    assert len(reader.pages) == 3
+    assert [item.title for item in reader.outline] == ['1-4', '5-5']
+
+
+def test_flaky_chunk_is_retried(sources, tmp_path):
+    wiki = make_wiki(['text', 'FLAKY', 'text'])
+    path = str(tmp_path / 'wiki.pdf')
+    METRICS.reset()
+    assert wiki.export_to_pdf_chunked(path, chunk_size=2, max_workers=1, retries=1) == []
+    assert counter('pdf_chunk_retries') == 1
+    assert counter('pdf_chunk_bisections') == 0
+    assert len(pypdf.PdfReader(path).pages) == 2
+
+
+def test_nothing_exported(sources, tmp_path):
+    path = str(tmp_path / 'wiki.pdf')
+    with pytest.raises(RuntimeError, match='none of the 1 tiddlers'):
+        make_wiki(['BROKEN']).export_to_pdf_chunked(path, retries=0)
+    assert not os.path.exists(path)
@@ -0,0 +1,123 @@
+import os
+import tempfile
+import webbrowser
+
+import pypandoc
+import pytest
+
+from tiddler import BinaryTiddler, Tiddler
+from tiddlywiki import TiddlyWiki
+
+PNG = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=='
+
+
+@pytest.fixture
+def wiki():
+    return TiddlyWiki(title='Title', subtitle='Subtitle', tiddlers=[
+        Tiddler('an image [img[a.png]] and a copy [img[b.png]]', title='text', created=2),
+        BinaryTiddler(PNG, title='a.png', type='image/png', created=0),
+        BinaryTiddler(PNG, title='b.png', type='image/png', created=1)])
+
+
+def read(path):
+    with open(path, encoding='utf8') as fh:
+        return fh.read()
+
+
+@pytest.mark.parametrize('backend', ['markdown', 'ast'])
+def test_assets_are_linked_relative(wiki, tmp_path, backend):
+    path = str(tmp_path / 'out' / 'wiki.md')
+    os.makedirs(os.path.dirname(path))
+    wiki.export_to_file(path, backend=backend)
+
+    digest = wiki[1].digest
+    # the three references share one asset file, linked relative to the exported file
+    assert os.listdir(str(tmp_path / 'out' / 'wiki_assets')) == [digest + '.png']
+    assert read(path).count('wiki_assets/{}.png'.format(digest)) == 4
+    assert str(tmp_path) not in read(path)
+
+
+def test_assets_dir_elsewhere(wiki, tmp_path):
+    path = str(tmp_path / 'html' / 'wiki.html')
+    os.makedirs(os.path.dirname(path))
+    wiki.export_to_file(path, assets_dir=str(tmp_path / 'images'))
+    assert '../images/{}.png'.format(wiki[1].digest) in read(path)
+
+
+def test_open_in_browser_embeds_assets(wiki, monkeypatch):
+    opened = []
+
+    class Browser:
+        def open(self, url, new=0):
+            opened.append(url)
+
+    monkeypatch.setattr(webbrowser, 'get', lambda using=None: Browser())
+    def directories():
+        return {entry.name for entry in os.scandir(tempfile.gettempdir()) if entry.is_dir()}
+
+    before = directories()
+    wiki.open_in_browser()
+
+    path = opened[0][len('file://'):]
+    try:
+        assert 'data:image/png;base64,' in read(path)
+        # no asset directory is left behind (or shared between exports)
+        assert directories() <= before
+    finally:
+        os.remove(path)
+
+
+@pytest.fixture
+def stubbed_pdf(monkeypatch):
+    # pdflatex is stubbed: sources containing BROKEN fail, other pdfs are written empty
+    convert_text, convert_file = pypandoc.convert_text, pypandoc.convert_file
+
+    def stub(convert, read):
+        def wrapper(source, to, format, outputfile=None, **kwargs):
+            if to != 'pdf':
+                return convert(source, to, format=format, outputfile=outputfile, **kwargs)
+            if 'BROKEN' in read(source):
+                raise RuntimeError('stubbed pdflatex failed')
+            open(outputfile, 'wb').close()
+            return ''
+        return wrapper
+
+    monkeypatch.setattr(pypandoc, 'convert_text', stub(convert_text, lambda source: source))
+    monkeypatch.setattr(pypandoc, 'convert_file', stub(convert_file, read))
+
+
+@pytest.fixture
+def conversions(monkeypatch):
+    calls = []
+    export = Tiddler.export
+
+    def counted(self, *args, **kwargs):
+        calls.append((self.title, kwargs['encoding']))
+        return export(self, *args, **kwargs)
+
+    monkeypatch.setattr(Tiddler, 'export', counted)
+    return calls
+
+
+def test_export_targets(tmp_path, stubbed_pdf, conversions):
+    wiki = TiddlyWiki(title='Title', subtitle='Subtitle', tiddlers=[
+        Tiddler('plain text', title='ascii', created=0),
+        Tiddler('costs 5 €', title='euro', created=1),
+        Tiddler('<p>html</p>', title='html', created=2, type='text/html'),
+        Tiddler('BROKEN', title='broken', created=3)])
+    md, html, pdf = (str(tmp_path / name) for name in ('wiki.md', 'wiki.html', 'wiki.pdf'))
+    results = wiki.export_targets([(md,), (html,), (pdf, None, None, None, True)])
+
+    assert results == {md: [], html: [], pdf: [wiki[3]]}
+    # latin-1 (of the pdf) is shared with utf-8, unless a tiddler has characters latin-1 lacks or is html
+    assert sorted(conversions) == [('ascii', 'utf-8'), ('broken', 'utf-8'), ('euro', 'latin-1'), ('euro', 'utf-8'),
+                                   ('html', 'latin-1'), ('html', 'utf-8')]
+
+    # the shared conversions give the same files as single exports
+    wiki.export_to_file(str(tmp_path / 'single.md'))
+    assert read(md) == read(str(tmp_path / 'single.md'))
+
+
+def test_export_targets_rejects_str_extra_args(wiki, tmp_path):
+    with pytest.raises(TypeError, match='list of arguments'):
+        wiki.export_targets([(str(tmp_path / 'wiki.html'), None, None, None, False, None, '--toc')])
@@ -0,0 +1,59 @@
+import base64
+import os
+
+import pytest
+
+from tiddler import AssetDirectory, BinaryTiddler, Tiddler
+
+PNG = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=='
+
+
+def binary(title, payload=PNG):
+    return BinaryTiddler(payload, title=title, type='image/png')
+
+
+def test_lazy_payload():
+    source = 'prefix' + PNG + 'suffix'
+    tiddler = BinaryTiddler(None, title='a.png', type='image/png', source=source, span=(6, 6 + len(PNG)))
+    assert tiddler.content == PNG
+    assert bytes(tiddler.data) == base64.b64decode(PNG)
+    digest = tiddler.digest
+    tiddler.content = base64.b64encode(b'other').decode('ascii')
+    assert tiddler.digest != digest
+
+
+def test_assets_are_deduplicated(tmp_path):
+    other = base64.b64encode(b'other payload').decode('ascii')
+    tiddlers = [binary('a.png'), binary('b.png'), binary('c.png', other), Tiddler('text', title='text')]
+    assets = AssetDirectory(str(tmp_path / 'assets'), tiddlers)
+
+    paths = assets.to_dict()
+    assert sorted(paths) == ['a.png', 'b.png', 'c.png']
+    # identical payloads share one file named by their digest
+    assert paths['a.png'] == paths['b.png'] != paths['c.png']
+    assert os.path.basename(paths['a.png']) == tiddlers[0].digest + '.png'
+    assert sorted(os.listdir(str(tmp_path / 'assets'))) == sorted({os.path.basename(p) for p in paths.values()})
+    with open(paths['c.png'], 'rb') as fh:
+        assert fh.read() == b'other payload'
+
+
+def test_referenced_titles(tmp_path):
+    tiddlers = [binary('a.png'), binary('b.png'), binary('c.png'),
+                Tiddler('[img[alt|b.png]] ![x](c.png) [img[missing.png]]', title='text')]
+    assets = AssetDirectory(str(tmp_path), tiddlers)
+    assert assets.referenced_titles(tiddlers[3:]) == {'b.png', 'c.png'}
+    assert assets.referenced_titles(tiddlers[:1]) == {'a.png'}
+    assert not os.listdir(str(tmp_path))
+
+
+def test_relative_paths(tmp_path):
+    assets = AssetDirectory(str(tmp_path / 'out' / 'assets'), [binary('a.png')], relative_to=str(tmp_path / 'out'))
+    assert assets.get('a.png') == os.path.join('assets', binary('a.png').digest + '.png')
+    assert assets.get('missing.png') is None
+
+
+def test_asset_path_requires_assets(tmp_path):
+    with pytest.raises(ValueError, match='no asset directory'):
+        binary('a.png').asset_path()
+    with pytest.raises(ValueError):
+        binary('a.png').asset_path(AssetDirectory(str(tmp_path), [binary('b.png')]))
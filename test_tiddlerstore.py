@@ -0,0 +1,76 @@
+import pickle
+import re
+
+import pytest
+
+from synthwiki import SyntheticWiki
+from tiddler import BinaryTiddler
+from tiddlerstore import StoredBinaryTiddler, TiddlerStore
+from tiddlywiki import TiddlyWiki
+
+
+@pytest.fixture
+def wiki(tmp_path):
+    wiki = TiddlyWiki.parse_from_html(SyntheticWiki(tiddlers=60, tag_count=6, images=3)
+                                      .write(str(tmp_path / 'synth.html')))
+    wiki[0].caption = 'a field'
+    return wiki
+
+
+@pytest.fixture
+def store(wiki, tmp_path):
+    with TiddlerStore.from_wiki(wiki, str(tmp_path / 'synth.db')) as store:
+        yield store
+
+
+def test_iter(store, wiki):
+    assert len(store) == len(wiki)
+    assert [(t.title, t.tags, t.created, t.modified, t.type_, t.content) for t in store] == \
+        [(t.title, t.tags, t.created, t.modified, t.type_, t.content) for t in wiki]
+    assert store.find_tiddler(title=wiki[0].title).caption == 'a field'
+
+
+def test_finditer(store, wiki):
+    tags = sorted({tag for t in wiki for tag in t.tags})
+    for tag in tags:
+        assert [t.title for t in store.finditer(tags=tag)] == [t.title for t in wiki if tag in t.tags]
+    assert [t.title for t in store.finditer(tags=tags[:2])] == \
+        [t.title for t in wiki if tags[0] in t.tags and tags[1] in t.tags]
+    assert [t.title for t in store.finditer(type='image/png')] == \
+        [t.title for t in wiki if t.type_ == 'image/png']
+    # predicates are evaluated on the hydrated tiddlers
+    assert [t.title for t in store.finditer(lambda t: t.created.day == 1, tags=tags[0])] == \
+        [t.title for t in wiki if tags[0] in t.tags and t.created.day == 1]
+    assert list(store.finditer(tags='no such tag')) == []
+
+
+@pytest.mark.parametrize('query, words', [('lorem', ['lorem']),
+                                          ('lorem AND veniam', ['lorem', 'veniam']),
+                                          ('"dolor sit"', ['dolor sit'])])
+def test_search(store, wiki, query, words):
+    def matches(tiddler):
+        text = tiddler.title + '\n' + tiddler.content
+        return all(re.search(r'\b{}\b'.format(word), text, re.IGNORECASE) for word in words)
+
+    expected = {t.title for t in wiki if matches(t)}
+    assert expected
+    assert {t.title for t in store.search(query)} == expected
+    assert [t.title for t in store.finditer(search=query)] == [t.title for t in wiki if matches(t)]
+
+
+def test_binary_tiddlers(store, wiki):
+    binaries = [t for t in wiki if isinstance(t, BinaryTiddler)]
+    stored = list(store.finditer(type='image/png'))
+    assert len(stored) == len(binaries) == 3
+    for tiddler, original in zip(stored, binaries):
+        assert isinstance(tiddler, StoredBinaryTiddler)
+        assert bytes(tiddler.data) == bytes(original.data)
+        assert tiddler.digest == original.digest
+        copy = pickle.loads(pickle.dumps(tiddler))
+        assert type(copy) is BinaryTiddler
+        assert bytes(copy.data) == bytes(original.data)
+
+
+def test_reopen(store, wiki):
+    with TiddlerStore(store.path) as reopened:
+        assert (reopened.title, len(reopened)) == (wiki.title, len(wiki))
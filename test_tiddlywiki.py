@@ -0,0 +1,39 @@
+from tiddler import Tiddler
+from tiddlywiki import TiddlyWiki
+
+
+def tiddlers(n):
+    return [Tiddler('content {}'.format(i), title='tiddler {}'.format(i)) for i in range(n)]
+
+
+def test_add_and_remove():
+    a, b, c = tiddlers(3)
+    wiki = TiddlyWiki(tiddlers=[a, b])
+    assert a in wiki and c not in wiki
+    assert not wiki.add_tiddler(a)
+    assert wiki.add_tiddler(c)
+    assert wiki.remove_tiddler(b)
+    assert not wiki.remove_tiddler(b)
+    assert list(wiki) == [a, c]
+
+
+def test_tiddlers_changed_directly():
+    a, b, c, d = tiddlers(4)
+    wiki = TiddlyWiki(tiddlers=[a, b])
+
+    wiki.tiddlers.append(c)
+    assert c in wiki
+    assert not wiki.add_tiddler(c)
+    assert wiki.remove_tiddler(c)
+    assert list(wiki) == [a, b]
+
+    wiki.tiddlers.remove(a)
+    assert a not in wiki
+    assert wiki.add_tiddler(a)
+    assert list(wiki) == [b, a]
+
+    wiki.tiddlers = [d]
+    assert d in wiki and a not in wiki
+    assert wiki.add_tiddler(a)
+    assert wiki.remove_tiddler(d)
+    assert list(wiki) == [a]
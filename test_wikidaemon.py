@@ -0,0 +1,121 @@
+import os
+import socket
+import threading
+
+import pytest
+
+from synthwiki import SyntheticWiki
+from tiddlywiki import TiddlyWiki
+from wikidaemon import LoadedWiki, WikiClient, WikiDaemon, WikiDaemonError
+
+
+@pytest.fixture
+def wiki_path(tmp_path):
+    return SyntheticWiki(tiddlers=40, tag_count=5).write(str(tmp_path / 'synth.html'))
+
+
+@pytest.fixture
+def socket_path(tmp_path, wiki_path):
+    path = str(tmp_path / 'daemon.sock')
+    daemon = WikiDaemon([wiki_path, 'copy=' + wiki_path], path, poll_interval=0)
+    thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+    thread.start()
+    yield path
+    daemon.shutdown()
+    daemon.server_close()
+    thread.join()
+    assert not os.path.exists(path)
+
+
+def test_ping_and_wikis(socket_path, wiki_path):
+    with WikiClient(socket_path) as client:
+        assert client.call('ping') == 'pong'
+        wikis = client.call('wikis')
+    assert sorted(wikis) == ['copy', 'synth']
+    assert wikis['synth']['path'] == wiki_path
+    assert wikis['synth']['tiddlers'] == len(TiddlyWiki.parse_from_html(wiki_path))
+
+
+def test_finditer(socket_path, wiki_path):
+    wiki = TiddlyWiki.parse_from_html(wiki_path)
+    tag = next(tag for t in wiki for tag in t.tags)
+
+    with WikiClient(socket_path, wiki='synth') as client:
+        assert [t.title for t in client.finditer()] == [t.title for t in wiki]
+        assert [t.title for t in client.finditer(tags=tag)] == [t.title for t in wiki if tag in t.tags]
+        assert [t.title for t in client.finditer(pattern='LOREM')] == \
+            [t.title for t in wiki if 'lorem' in t.content]
+        # predicates are evaluated by the client
+        assert [t.title for t in client.finditer(lambda t: t.title.endswith('1'), tags=tag)] == \
+            [t.title for t in wiki if tag in t.tags and t.title.endswith('1')]
+
+        tiddler = client.find_tiddler(title=wiki[3].title)
+        assert (tiddler.title, tiddler.tags, tiddler.created, tiddler.content) == \
+            (wiki[3].title, wiki[3].tags, wiki[3].created, wiki[3].content)
+        assert client.find_tiddler(title='no such tiddler') is None
+
+
+def test_error_mapping(socket_path, monkeypatch):
+    with WikiClient(socket_path) as client:
+        # builtin exceptions are raised again by the client
+        with pytest.raises(ValueError, match='several wikis'):
+            client.call('finditer')
+
+    with WikiClient(socket_path, wiki='synth') as client:
+        with pytest.raises(ValueError, match='unknown method'):
+            client.call('no such method')
+        with pytest.raises(IndexError):
+            client.get_random_tiddler(tags='no such tag')
+
+        class StoreError(Exception):
+            pass
+
+        def select(self, *args, **kwargs):
+            raise StoreError('broken')
+
+        # other exceptions are raised as WikiDaemonError
+        monkeypatch.setattr(LoadedWiki, 'select', select)
+        with pytest.raises(WikiDaemonError, match='broken'):
+            list(client.finditer())
+        # the connection is still usable
+        assert client.call('ping') == 'pong'
+
+    with WikiClient(socket_path, wiki='no such wiki') as client:
+        with pytest.raises(KeyError):
+            list(client.finditer())
+
+
+def test_malformed_request(socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile('rwb') as fh:
+            fh.write(b'not json\n')
+            fh.flush()
+            assert b'"ok": false' in fh.readline()
+
+
+def test_reload(socket_path, wiki_path):
+    with WikiClient(socket_path, wiki='synth') as client:
+        count = len(client)
+        SyntheticWiki(tiddlers=count + 5, tag_count=5).write(wiki_path)
+        stat = os.stat(wiki_path)
+        # the change is noticed even within the resolution of the modification time
+        os.utime(wiki_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        assert len(list(client.finditer())) == count + 5
+        assert client.reload(force=True) == ['synth', 'copy']
+
+
+def test_running_daemon_keeps_its_socket(socket_path, wiki_path):
+    with pytest.raises(WikiDaemonError, match='already serving'):
+        WikiDaemon([wiki_path], socket_path)
+    with WikiClient(socket_path, wiki='synth') as client:
+        assert client.call('ping') == 'pong'
+
+
+def test_stale_socket_is_removed(tmp_path, wiki_path):
+    path = str(tmp_path / 'stale.sock')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+        stale.bind(path)
+    assert os.path.exists(path)
+    with WikiDaemon([wiki_path], path) as daemon:
+        assert daemon.socket_path == path
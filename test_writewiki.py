@@ -0,0 +1,104 @@
+import datetime
+import json
+import re
+
+import pytest
+
+from synthwiki import SyntheticWiki
+from tiddlywiki import TiddlyWiki
+
+
+@pytest.fixture(params=['div', 'json'])
+def wiki_path(request, tmp_path):
+    return SyntheticWiki(tiddlers=50, images=2, store=request.param).write(str(tmp_path / 'wiki.html'))
+
+
+def read(path):
+    with open(path, 'rb') as fh:
+        return fh.read()
+
+
+def test_save_html_unchanged_is_identical(wiki_path, tmp_path):
+    wiki = TiddlyWiki.parse_from_html(wiki_path)
+    copy = str(tmp_path / 'copy.html')
+    wiki.save_html(copy)
+    assert read(copy) == read(wiki_path)
+
+
+def test_save_html_changed_tiddler(wiki_path, tmp_path):
+    wiki = TiddlyWiki.parse_from_html(wiki_path)
+    # the order of tags with spaces survives encoding
+    tagged = next(t for t in wiki if sum(' ' in tag for tag in t.tags) > 1)
+    tagged.tags.append('changed')
+    wiki[5].content += '\nan added line'
+    wiki.remove_tiddler(wiki[7])
+    copy = str(tmp_path / 'copy.html')
+    wiki.save_html(copy)
+
+    saved = TiddlyWiki.parse_from_html(copy)
+    assert not wiki.diff(saved)
+    # saving the saved wiki again changes nothing
+    again = str(tmp_path / 'again.html')
+    saved.save_html(again)
+    assert read(again) == read(copy)
+
+
+def test_export_json_round_trip(wiki_path, tmp_path):
+    wiki = TiddlyWiki.parse_from_html(wiki_path)
+    exported = str(tmp_path / 'wiki.json')
+    wiki.export_json(exported)
+
+    with open(exported, encoding='utf8') as fh:
+        store = fh.read()
+    assert len(json.loads(store)) == len(wiki)
+    html = ('<!doctype html>\n<html>\n<body>\n'
+            '<script class="tiddlywiki-tiddler-store" type="application/json">' + store + '</script>\n'
+            '<div id="storeArea" style="display:none;"></div>\n</body>\n</html>\n')
+    imported = TiddlyWiki.parse_from_string(html)
+    assert not wiki.diff(imported)
+
+    again = str(tmp_path / 'again.json')
+    imported.export_json(again)
+    assert read(again) == read(exported)
+
+
+def test_export_json_predicates(wiki_path, tmp_path):
+    wiki = TiddlyWiki.parse_from_html(wiki_path)
+    exported = str(tmp_path / 'wiki.json')
+    wiki.export_json(exported, predicates=[lambda t: t.title.startswith('tiddler 1')])
+    with open(exported, encoding='utf8') as fh:
+        titles = [record['title'] for record in json.load(fh)]
+    assert titles == [t.title for t in wiki if t.title.startswith('tiddler 1')]
+
+
+def test_save_html_keeps_milliseconds(wiki_path, tmp_path):
+    with open(wiki_path, encoding='utf8') as fh:
+        html = re.sub('(created(?:="|": ?")\\d{14})000', '\\g<1>123', fh.read())
+    with open(wiki_path, 'w', encoding='utf8') as fh:
+        fh.write(html)
+
+    wiki = TiddlyWiki.parse_from_html(wiki_path)
+    changed = [wiki[0], wiki[1]]
+    changed[0].content += '\nan added line'
+    changed[1].created += datetime.timedelta(seconds=1)
+    copy = str(tmp_path / 'copy.html')
+    wiki.save_html(copy)
+
+    with open(copy, encoding='utf8') as fh:
+        saved = fh.read()
+    # the created strings are kept, unless the date changed
+    assert saved.count('123"') == html.count('123"') - 1
+    assert TiddlyWiki.parse_from_html(copy).title_index()[changed[1].title].created == changed[1].created
+
+
+def test_save_html_tags(wiki_path, tmp_path):
+    wiki = TiddlyWiki.parse_from_html(wiki_path)
+    wiki[0].tags = ['c]]', 'a b', '', '[[x', 'd']
+    copy = str(tmp_path / 'copy.html')
+    wiki.save_html(copy)
+    # empty tags cannot be stored
+    assert TiddlyWiki.parse_from_html(copy)[0].tags == ['c]]', 'a b', '[[x', 'd']
+
+    wiki[0].tags = ['a]] b']
+    with pytest.raises(ValueError):
+        wiki.save_html(copy)
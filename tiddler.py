@@ -1,20 +1,30 @@
+import binascii
+import hashlib
+import json
+import mimetypes
+import os
 import re
 import reprlib
+import threading
 
+from convertast import ConvertASTMixin
 from convertstrings import ConvertStringsMixin
 from exporttiddler import ExportTiddlerMixin
+from instrumentation import METRICS
 
 
-class Tiddler(ConvertStringsMixin, ExportTiddlerMixin):
+class Tiddler(ConvertStringsMixin, ConvertASTMixin, ExportTiddlerMixin):
 
+    # attributes and content of the <div> store area are html-escaped and cannot contain < or >,
+    # so each match attempt stops at the next tag and parsing takes linear time, even for malformed input
     RE_TIDDLER = re.compile('<div'
-                            '(?P<options>[\w\W]*?)'
+                            '(?P<options>[^<>]*)'
                             '>\n'
                             '<pre>'
-                            '(?P<content>[\w\W]*?)</pre>\n'
+                            '(?P<content>[^<]*)</pre>\n'
                             '</div>')
 
-    RE_OPTION = re.compile('\s+(?P<key>\w+?)=\"(?P<value>[\w\W]*?)\"')
+    RE_OPTION = re.compile('\s(?P<key>\w+)=\"(?P<value>[^\"]*)\"')
 
     def __init__(self, content, title=None, tags=None, created=None, modified=None,
                  type='text/vnd.tiddlywiki', **kwargs):
@@ -29,14 +39,53 @@ class Tiddler(ConvertStringsMixin, ExportTiddlerMixin):
         self.type_ = type
         self.__dict__.update(kwargs)
 
+    # TiddlyWiki >= 5.2 stores tiddlers as a json array in a script tag, with < escaped as \u003C
+    RE_JSON_STORE = re.compile('<script class="tiddlywiki-tiddler-store" type="application/json">'
+                               '(?P<store>[^<]*)</script>')
+
+    @classmethod
+    def from_attributes(cls, content, attr):
+        """A Tiddler factory
+        Converts the raw string attributes of a stored tiddler.
+        Returns None for tiddlers that are not included,
+        i.e. system tiddlers and tiddlers without title or creation date.
+        """
+        try:
+            attr['tags'] = cls.get_tag_list(attr['tags'])
+        except KeyError:
+            pass
+
+        try:
+            attr['modified'] = cls.string_to_date(attr['modified'])
+        except KeyError:
+            pass
+
+        try:
+            attr['created'] = cls.string_to_date(attr['created'])
+        except KeyError:
+            return None  # don't include tiddlers without creation tag
+
+        try:
+            if attr['title'].startswith('$:/'):
+                return None  # don't include tiddlers, whose title start with '$:/'
+        except KeyError:
+            return None  # don't include tiddlers without title
+
+        return cls(content, **attr)
+
     @classmethod
-    def finditer(cls, buffer):
+    def finditer(cls, buffer, slots=None):
         """generator function, yielding Tiddler instances found in buffer.
         The Tiddler initiator is invoked with the kwargs of all options found in buffer.
+        Both the <div> store area and the json tiddler store of TiddlyWiki >= 5.2 are searched.
+        If a list slots is given, a (kind, start, end, tiddler) tuple is appended for every stored tiddler
+        ('div' or 'json', tiddler None if it is not included) and json store ('json_store', None),
+        see WriteWikiMixin.
         """
         for match in re.finditer(cls.RE_TIDDLER, buffer):
             options = match.group('options')
-            content = match.group('content')
+            span = match.span('content')
+            start, end = match.span()
 
             attr = {}
             for match in re.finditer(cls.RE_OPTION, options):
@@ -44,28 +93,70 @@ class Tiddler(ConvertStringsMixin, ExportTiddlerMixin):
                 value = match.group('value')
                 attr[key] = value
 
-            try:
-                attr['tags'] = cls.get_tag_list(attr['tags'])
-            except KeyError:
-                pass
+            if cls.is_binary_type(attr.get('type')):
+                # the base64 payload is not copied, but kept as a slice of buffer
+                attr.update(source=buffer, span=span)
+                tiddler = BinaryTiddler.from_attributes(None, attr)
+            else:
+                tiddler = cls.from_attributes(buffer[span[0]:span[1]], attr)
+            if slots is not None:
+                slots.append(('div', start, end, tiddler))
+            if tiddler is not None:
+                yield tiddler
 
-            try:
-                attr['modified'] = cls.string_to_date(attr['modified'])
-            except KeyError:
-                pass
+        yield from cls.finditer_json(buffer, slots)
 
-            try:
-                attr['created'] = cls.string_to_date(attr['created'])
-            except KeyError:
-                continue  # don't include tiddlers without creation tag
+    RE_WHITESPACE = re.compile('\\s*')
 
-            try:
-                if attr['title'].startswith('$:/'):
-                    continue  # don't include tiddlers, whose title start with '$:/'
-            except KeyError:
-                continue  # don't include tiddlers without title
+    @classmethod
+    def iter_json_array(cls, buffer, start):
+        """generator function, yielding (value, start, end) of the elements of the json array
+        at position start of buffer, decoded one by one without copying the array.
+        """
+        decoder = json.JSONDecoder()
+        pos = cls.RE_WHITESPACE.match(buffer, start).end()
+        if buffer[pos:pos + 1] != '[':
+            raise ValueError('no json array at position {}'.format(pos))
+        pos = cls.RE_WHITESPACE.match(buffer, pos + 1).end()
+        if buffer[pos:pos + 1] == ']':
+            return
+        while True:
+            value, end = decoder.raw_decode(buffer, pos)
+            yield value, pos, end
+            pos = cls.RE_WHITESPACE.match(buffer, end).end()
+            if buffer[pos:pos + 1] == ']':
+                return
+            if buffer[pos:pos + 1] != ',':
+                raise ValueError('expected , or ] at position {}'.format(pos))
+            pos = cls.RE_WHITESPACE.match(buffer, pos + 1).end()
 
-            yield cls(content, **attr)
+    @classmethod
+    def finditer_json(cls, buffer, slots=None):
+        """generator function, yielding Tiddler instances found in the json tiddler stores of buffer.
+        As in the <div> store area, the content stays html-escaped.
+        """
+        for match in re.finditer(cls.RE_JSON_STORE, buffer):
+            if slots is not None:
+                slots.append(('json_store',) + match.span('store') + (None,))
+            for attr, start, end in cls.iter_json_array(buffer, match.start('store')):
+                content = attr.pop('text', '')
+                attr = {key: value for key, value in attr.items() if key.isidentifier()}
+                if cls.is_binary_type(attr.get('type')):
+                    tiddler = BinaryTiddler.from_attributes(content, attr)
+                else:
+                    tiddler = cls.from_attributes(cls.html_encode(content), attr)
+                if slots is not None:
+                    slots.append(('json', start, end, tiddler))
+                if tiddler is not None:
+                    yield tiddler
+
+    @staticmethod
+    def is_binary_type(type_):
+        '''True for content types that TiddlyWiki stores base64 encoded, e.g. image/png.'''
+        if type_ is None or type_ == 'image/svg+xml':
+            return False
+        return (type_.startswith(('image/', 'audio/', 'video/', 'font/')) or
+                type_ in {'application/pdf', 'application/octet-stream', 'application/zip'})
 
     @classmethod
     def parse_from_string(cls, buffer):
@@ -99,6 +190,172 @@ class Tiddler(ConvertStringsMixin, ExportTiddlerMixin):
         return result
 
 
+class BinaryTiddler(Tiddler):
+    """A Tiddler with base64 encoded binary content, e.g. of type image/png or application/pdf.
+    When parsed, the base64 payload is kept as a lazy slice (source, span) of the parsed buffer.
+    It is decoded on demand by data, and exported as a reference to an asset file
+    (see AssetDirectory), so that the payload never passes through pandoc.
+    """
+
+    def __init__(self, content, *args, source=None, span=None, **kwargs):
+        super().__init__(content, *args, **kwargs)
+        if source is not None:
+            self._source = source
+            self._span = span
+
+    @property
+    def content(self):
+        '''the base64 payload, sliced from the source on every access.'''
+        start, end = self._span
+        return self._source[start:end]
+
+    @content.setter
+    def content(self, value):
+        self._source = '' if value is None else value
+        self._span = (0, len(self._source))
+        self.__dict__.pop('_digest', None)
+
+    @property
+    def data(self):
+        '''the decoded payload as memoryview.'''
+        start, end = self._span
+        return memoryview(binascii.a2b_base64(self._source[start:end]))
+
+    @property
+    def digest(self):
+        '''sha256 hex digest of the decoded payload, identical images have identical digests.'''
+        if '_digest' not in self.__dict__:
+            self._digest = hashlib.sha256(self.data).hexdigest()
+        return self._digest
+
+    @property
+    def extension(self):
+        return mimetypes.guess_extension(self.type_) or '.bin'
+
+    def write_asset(self, directory):
+        """writes the decoded payload to <directory>/<digest><extension>, unless it exists.
+        returns the path of the asset.
+        """
+        data = None
+        if '_digest' not in self.__dict__:
+            # decoded once, for the digest and the file
+            data = self.data
+            self._digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(directory, self.digest + self.extension)
+        if not os.path.exists(path):
+            os.makedirs(directory, exist_ok=True)
+            with open(path, 'wb') as fh:
+                fh.write(self.data if data is None else data)
+        return path
+
+    def asset_path(self, assets=None):
+        '''returns the path of the asset file of the payload in assets (see AssetDirectory),
+        raises ValueError if assets does not contain this tiddler.
+        '''
+        path = None if assets is None else assets.get(self.title)
+        if path is None:
+            raise ValueError('no asset directory for the binary tiddler {!r}'.format(self.title))
+        return path
+
+    def export_content(self, format='md', encoding='utf-8', assets=None):
+        '''export a reference to the asset file instead of the payload:
+        an image for image types, a link otherwise.
+        '''
+        path = self.asset_path(assets)
+        if self.type_.startswith('image/'):
+            content = '![{}](<{}>)'.format(self.title, path)
+        else:
+            content = '[{}](<{}>)'.format(self.title, path)
+        return METRICS.convert_text(content, format, format='md')
+
+    def export_content_ast(self, encoding='utf-8', assets=None):
+        node = 'Image' if self.type_.startswith('image/') else 'Link'
+        inline = {'t': node, 'c': [['', [], []], [{'t': 'Str', 'c': self.title}], [self.asset_path(assets), '']]}
+        return [{'t': 'Para', 'c': [inline]}]
+
+    def export_to_file(self, path, format=None, encoding='utf-8', backend='markdown', assets=None):
+        if assets is None:
+            # absolute paths, as pandoc looks up images to embed relative to the working directory
+            assets = AssetDirectory(os.path.splitext(path)[0] + '_assets', [self])
+        super().export_to_file(path, format=format, encoding=encoding, backend=backend, assets=assets)
+
+    def __getstate__(self):
+        # pickle the payload only, not the whole source buffer
+        state = dict(self.__dict__)
+        state['_source'] = self.content
+        state['_span'] = (0, len(state['_source']))
+        return state
+
+    def __str__(self):
+        return (self.title + '\n' +
+                '\ttype: ' + str(self.type_) + ', ' +
+                '\tsize: ' + str(len(self.content) * 3 // 4) + ' bytes\n' +
+                '\tcreated: ' + str(self.created) + ', '
+                '\tmodified: ' + str(self.modified))
+
+
+class AssetDirectory:
+    """Maps the titles of the binary tiddlers of a wiki to asset files in directory.
+    Each payload is decoded and written on first use only,
+    identical payloads (same digest) are written once.
+    The asset paths are relative to the directory relative_to (e.g. of the exported file),
+    or absolute if relative_to is None.
+    """
+
+    def __init__(self, directory, tiddlers, relative_to=None):
+        self.directory = directory
+        self.relative_to = relative_to
+        self.__binaries = {t.title: t for t in tiddlers if isinstance(t, BinaryTiddler)}
+        self.__paths = {}
+        self.__lock = threading.Lock()
+
+    def get(self, title, default=None):
+        """returns the asset path of the binary tiddler with title, or default."""
+        try:
+            tiddler = self.__binaries[title]
+        except KeyError:
+            return default
+        with self.__lock:
+            if title not in self.__paths:
+                with METRICS.span('write_asset', tiddler=title):
+                    path = tiddler.write_asset(self.directory)
+                if self.relative_to is None:
+                    self.__paths[title] = os.path.abspath(path)
+                else:
+                    self.__paths[title] = os.path.relpath(path, self.relative_to)
+            return self.__paths[title]
+
+    def __contains__(self, title):
+        return title in self.__binaries
+
+    def to_dict(self, titles=None):
+        """writes the assets (of titles, by default all), returns a plain dict of title -> asset path
+        (e.g. for worker processes).
+        """
+        if titles is None:
+            titles = self.__binaries
+        return {title: self.get(title) for title in titles if title in self.__binaries}
+
+    # targets of images in tw5 ([img[alt|target]]), markdown and html, see referenced_titles
+    RE_REFERENCES = (re.compile('\\[\\s*img[^\\[\\]]*\\[(?P<link>(?:[^\\[\\]]|\\](?!\\]))+)\\]\\]'),
+                     re.compile('!\\[[^\\]\\n]*\\]\\(\\s*<?(?P<link>[^<>()"\\n]*)'),
+                     re.compile('<img\\s[^<>]*?src\\s*=\\s*["\'](?P<link>[^"\'<>]*)["\']'))
+
+    def referenced_titles(self, tiddlers):
+        """returns the set of titles of the binary tiddlers among tiddlers or referenced by their images."""
+        titles = set()
+        for tiddler in tiddlers:
+            if isinstance(tiddler, BinaryTiddler):
+                titles.add(tiddler.title)
+                continue
+            # content of the <div> store area is html-escaped
+            content = Tiddler.unescape_html(tiddler.content or '')
+            for pattern in self.RE_REFERENCES:
+                for match in pattern.finditer(content):
+                    titles.add(match.group('link').rpartition('|')[2].strip())
+        return titles & self.__binaries.keys()
+
+
 if __name__ == "__main__":
 
     tiddler_string = r"""
@@ -0,0 +1,315 @@
+import binascii
+import datetime
+import functools
+import sqlite3
+import threading
+
+from algorithm import reservoir_sample
+from exportchunked import ExportChunkedMixin
+from exportwiki import ExportWikiMixin
+from instrumentation import METRICS
+from tiddler import BinaryTiddler, Tiddler
+
+
+class StoredTiddler(Tiddler):
+    """A Tiddler hydrated lazily from a row of a TiddlerStore.
+    title, tags, created, modified and type_ are read with the row.
+    content is read from the database on every access (and thus never held in memory),
+    further fields are read on first access.
+    """
+
+    def __init__(self, store, id, title, created, modified, type, tags):
+        self._store = store
+        self._id = id
+        self.title = title
+        self.created = created
+        self.modified = modified
+        self.type_ = type
+        self.tags = tags
+
+    def __getattr__(self, name):
+        # only called for attributes that are not set on the instance
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name == 'content':
+            return self._store.get_content(self._id)
+        if '_fields' not in self.__dict__:
+            self._fields = self._store.get_fields(self._id)
+            for key, value in self._fields.items():
+                self.__dict__.setdefault(key, value)
+            if name in self.__dict__:
+                return self.__dict__[name]
+        raise AttributeError(name)
+
+    def __reduce__(self):
+        # e.g. for worker processes: pickled as a plain, fully hydrated Tiddler (or BinaryTiddler)
+        attr = {key: value for key, value in self._store.get_fields(self._id).items()
+                if key.isidentifier()}
+        attr.update(title=self.title, tags=self.tags, created=self.created,
+                    modified=self.modified, type=self.type_)
+        cls = BinaryTiddler if isinstance(self, BinaryTiddler) else Tiddler
+        return functools.partial(cls, **attr), (self.content,)
+
+
+class StoredBinaryTiddler(StoredTiddler, BinaryTiddler):
+    """A BinaryTiddler hydrated lazily from a row of a TiddlerStore.
+    The base64 payload is read from the database on access only,
+    i.e. when its asset file is written (see AssetDirectory), so it never passes through pandoc.
+    """
+
+    @property
+    def content(self):
+        return self._store.get_content(self._id)
+
+    @property
+    def data(self):
+        return memoryview(binascii.a2b_base64(self.content))
+
+
+class TiddlerStore(ExportWikiMixin, ExportChunkedMixin):
+    """A persistent tiddler store in a local sqlite database.
+    A parsed TiddlyWiki is imported with import_wiki.
+    Queries (find_tiddler, finditer, get_random_tiddler and the fts5 full text search)
+    are answered by sql, yielding StoredTiddler (or StoredBinaryTiddler) instances streamed from a cursor,
+    so the wiki is never loaded into memory as a whole.
+    The ExportWikiMixin methods work on the store as on a TiddlyWiki.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS wiki (
+            key TEXT PRIMARY KEY,
+            value TEXT);
+        CREATE TABLE IF NOT EXISTS tiddlers (
+            id INTEGER PRIMARY KEY,
+            title TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created TEXT,
+            modified TEXT,
+            type TEXT);
+        CREATE INDEX IF NOT EXISTS tiddlers_title ON tiddlers(title);
+        CREATE INDEX IF NOT EXISTS tiddlers_created ON tiddlers(created);
+        CREATE TABLE IF NOT EXISTS tags (
+            tiddler_id INTEGER NOT NULL REFERENCES tiddlers(id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            tag TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS tags_tag ON tags(tag);
+        CREATE INDEX IF NOT EXISTS tags_tiddler ON tags(tiddler_id);
+        CREATE TABLE IF NOT EXISTS fields (
+            tiddler_id INTEGER NOT NULL REFERENCES tiddlers(id) ON DELETE CASCADE,
+            key TEXT NOT NULL,
+            value);
+        CREATE INDEX IF NOT EXISTS fields_tiddler ON fields(tiddler_id);
+        CREATE VIRTUAL TABLE IF NOT EXISTS tiddlers_fts
+            USING fts5(title, content, content='tiddlers', content_rowid='id');
+    '''
+
+    # tags are concatenated with the ascii unit separator, which does not occur in tags
+    SELECT = '''
+        SELECT t.id, t.title, t.created, t.modified, t.type,
+               (SELECT group_concat(tag, char(31))
+                FROM (SELECT tag FROM tags WHERE tiddler_id = t.id ORDER BY position))
+        FROM tiddlers AS t
+    '''
+
+    STANDARD_ATTRIBUTES = {'content', 'title', 'tags', 'created', 'modified', 'type_'}
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        # the connection is shared with the worker threads of ExportWikiMixin
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.__lock = threading.RLock()
+        with self.connection:
+            self.connection.executescript(self.SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __get_meta(self, key):
+        with self.__lock:
+            row = self.connection.execute('SELECT value FROM wiki WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    @property
+    def title(self):
+        return self.__get_meta('title')
+
+    @property
+    def subtitle(self):
+        return self.__get_meta('subtitle')
+
+    @staticmethod
+    def __date_to_sql(date):
+        return None if date is None else date.isoformat(' ')
+
+    @staticmethod
+    def __sql_to_date(value):
+        return None if value is None else datetime.datetime.fromisoformat(value)
+
+    def import_wiki(self, tiddly_wiki, replace=True):
+        """imports all tiddlers of tiddly_wiki with bulk inserts in a single transaction.
+        if replace is True, the tiddlers already in the store are removed first.
+        returns the number of imported tiddlers.
+        """
+        with METRICS.span('store_import', path=self.path), self.__lock, self.connection:
+            cursor = self.connection.cursor()
+            if replace:
+                cursor.execute('DELETE FROM tiddlers')
+            cursor.executemany('INSERT OR REPLACE INTO wiki (key, value) VALUES (?, ?)',
+                               [('title', tiddly_wiki.title), ('subtitle', tiddly_wiki.subtitle)])
+
+            first_id = cursor.execute('SELECT coalesce(max(id), 0) + 1 FROM tiddlers').fetchone()[0]
+            tiddler_rows, tag_rows, field_rows = [], [], []
+            for id, tiddler in enumerate(tiddly_wiki, start=first_id):
+                tiddler_rows.append((id, tiddler.title, tiddler.content,
+                                     self.__date_to_sql(tiddler.created),
+                                     self.__date_to_sql(tiddler.modified),
+                                     tiddler.type_))
+                tag_rows.extend((id, position, tag) for position, tag in enumerate(tiddler.tags))
+                for key, value in vars(tiddler).items():
+                    if key.startswith('_') or key in self.STANDARD_ATTRIBUTES:
+                        continue
+                    if not isinstance(value, (str, int, float)) and value is not None:
+                        value = str(value)
+                    field_rows.append((id, key, value))
+
+            cursor.executemany('INSERT INTO tiddlers (id, title, content, created, modified, type) '
+                               'VALUES (?, ?, ?, ?, ?, ?)', tiddler_rows)
+            cursor.executemany('INSERT INTO tags (tiddler_id, position, tag) VALUES (?, ?, ?)', tag_rows)
+            cursor.executemany('INSERT INTO fields (tiddler_id, key, value) VALUES (?, ?, ?)', field_rows)
+            # re-indexing the external content table at once is faster than row-wise triggers
+            cursor.execute("INSERT INTO tiddlers_fts (tiddlers_fts) VALUES ('rebuild')")
+
+        return len(tiddler_rows)
+
+    @classmethod
+    def from_wiki(cls, tiddly_wiki, path=':memory:'):
+        """A TiddlerStore factory
+        Returns a TiddlerStore at path containing all tiddlers of tiddly_wiki
+        """
+        store = cls(path)
+        store.import_wiki(tiddly_wiki)
+        return store
+
+    def get_content(self, id):
+        with self.__lock:
+            return self.connection.execute('SELECT content FROM tiddlers WHERE id = ?', (id,)).fetchone()[0]
+
+    def get_fields(self, id):
+        with self.__lock:
+            rows = self.connection.execute('SELECT key, value FROM fields WHERE tiddler_id = ?', (id,))
+            return dict(rows.fetchall())
+
+    def __hydrate(self, row):
+        id, title, created, modified, type, tags = row
+        cls = StoredBinaryTiddler if Tiddler.is_binary_type(type) else StoredTiddler
+        return cls(self, id, title, self.__sql_to_date(created), self.__sql_to_date(modified),
+                   type, [] if tags is None else tags.split('\x1f'))
+
+    def __query(self, tags=(), title=None, type=None, search=None, order_by='t.id', limit=None):
+        if isinstance(tags, str):
+            tags = (tags,)
+
+        conditions, parameters = [], []
+        for tag in tags:
+            conditions.append('t.id IN (SELECT tiddler_id FROM tags WHERE tag = ?)')
+            parameters.append(tag)
+        if title is not None:
+            conditions.append('t.title = ?')
+            parameters.append(title)
+        if type is not None:
+            conditions.append('t.type = ?')
+            parameters.append(type)
+        if search is not None:
+            conditions.append('t.id IN (SELECT rowid FROM tiddlers_fts WHERE tiddlers_fts MATCH ?)')
+            parameters.append(search)
+
+        sql = self.SELECT
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY ' + order_by
+        if limit is not None:
+            sql += ' LIMIT ?'
+            parameters.append(limit)
+        return sql, parameters
+
+    def __stream(self, sql, parameters):
+        with self.__lock:
+            cursor = self.connection.execute(sql, parameters)
+        while True:
+            with self.__lock:
+                rows = cursor.fetchmany(256)
+            if not rows:
+                return
+            for row in rows:
+                yield self.__hydrate(row)
+
+    def __iter__(self):
+        return self.__stream(*self.__query())
+
+    def __len__(self):
+        with self.__lock:
+            return self.connection.execute('SELECT count(*) FROM tiddlers').fetchone()[0]
+
+    def finditer(self, *predicates, tags=(), title=None, type=None, search=None):
+        """generator function, yielding the tiddlers that have all tags and the given title and type,
+        match the fts5 query search (e.g. 'einstein OR relativity') and satisfy all predicates.
+        the keyword filters are evaluated by sql, the predicates on the hydrated tiddlers.
+        """
+        for tiddler in self.__stream(*self.__query(tags, title, type, search)):
+            if all(p(tiddler) for p in predicates):
+                yield tiddler
+
+    def find_tiddler(self, *predicates, tags=(), title=None, type=None, search=None):
+        return next(self.finditer(*predicates, tags=tags, title=title, type=type, search=search), None)
+
+    def get_random_tiddler(self, *predicates, tags=(), title=None, type=None, search=None):
+        if predicates:
+            sample = reservoir_sample(self.finditer(*predicates, tags=tags, title=title,
+                                                    type=type, search=search), 1)
+        else:
+            sample = list(self.__stream(*self.__query(tags, title, type, search,
+                                                      order_by='random()', limit=1)))
+        if not sample:
+            raise IndexError('no tiddler satisfies the predicates')
+        return sample[0]
+
+    def search(self, match, limit=None):
+        """generator function, yielding the tiddlers matching the fts5 query match, best match first."""
+        sql = ('SELECT t.id, t.title, t.created, t.modified, t.type, '
+               '       (SELECT group_concat(tag, char(31)) '
+               '        FROM (SELECT tag FROM tags WHERE tiddler_id = t.id ORDER BY position)) '
+               'FROM tiddlers_fts JOIN tiddlers AS t ON t.id = tiddlers_fts.rowid '
+               'WHERE tiddlers_fts MATCH ? ORDER BY tiddlers_fts.rank')
+        parameters = [match]
+        if limit is not None:
+            sql += ' LIMIT ?'
+            parameters.append(limit)
+        return self.__stream(sql, parameters)
+
+    def apply(self, algorithm):
+        return algorithm.evaluate(self)
+
+
+if __name__ == "__main__":
+
+    from tiddlywiki import TiddlyWiki
+
+    tw5 = TiddlyWiki.parse_from_html('./example/tw5.html')
+
+    with TiddlerStore.from_wiki(tw5) as store:
+        print(store.title, store.subtitle, len(store))
+
+        for tiddler in store.finditer(tags='journal'):
+            print(tiddler)
+
+        for tiddler in store.search('einstein OR vonnegut'):
+            print(tiddler.title)
+
+        store.export_to_file('./tw5_letters.md', predicates=[lambda t: 'letter' in t.tags])
@@ -1,11 +1,15 @@
 import re
 
+from instrumentation import METRICS
 from searchwiki import SearchWikiMixin
+from diffwiki import DiffWikiMixin
 from exportwiki import ExportWikiMixin
+from exportchunked import ExportChunkedMixin
 from tiddler import Tiddler
+from writewiki import WriteWikiMixin
 
 
-class TiddlyWiki(SearchWikiMixin, ExportWikiMixin):
+class TiddlyWiki(SearchWikiMixin, ExportWikiMixin, ExportChunkedMixin, WriteWikiMixin, DiffWikiMixin):
 
     RE_TITLE = re.compile('<title>(?P<title>[\w\W]*?) — '
                           '(?P<subtitle>[\w\W]*?)</title>')
@@ -14,11 +18,24 @@ class TiddlyWiki(SearchWikiMixin, ExportWikiMixin):
         self.title = title
         self.subtitle = subtitle
         self.tiddlers = []
+        # membership is tested in O(1), the list keeps the order
+        self.__members = set()
+        self.__members_of = self.tiddlers
+        self.set_source()
         if tiddlers is not None:
             self.add_tiddlers(tiddlers)
 
+    def __sync_members(self):
+        # tiddlers is a public list, which may be changed (or replaced) directly,
+        # so the set is rebuilt if it is not the set of the current list any more
+        if self.__members_of is not self.tiddlers or len(self.__members) != len(self.tiddlers):
+            self.__members = set(self.tiddlers)
+            self.__members_of = self.tiddlers
+        return self.__members
+
     def add_tiddler(self, tiddler):
-        if tiddler not in self.tiddlers:
+        if tiddler not in self.__sync_members():
+            self.__members.add(tiddler)
             self.tiddlers.append(tiddler)
             return True
 
@@ -29,7 +46,8 @@ class TiddlyWiki(SearchWikiMixin, ExportWikiMixin):
             self.add_tiddler(tiddler)
 
     def remove_tiddler(self, tiddler):
-        if tiddler in self.tiddlers:
+        if tiddler in self.__sync_members():
+            self.__members.remove(tiddler)
             self.tiddlers.remove(tiddler)
             return True
 
@@ -46,7 +64,7 @@ class TiddlyWiki(SearchWikiMixin, ExportWikiMixin):
 
     def __contains__(self, tiddler):
         assert isinstance(tiddler, Tiddler)
-        return tiddler in self.tiddlers
+        return tiddler in self.__sync_members()
 
     @classmethod
     def parse_title(cls, buffer):
@@ -61,11 +79,15 @@ class TiddlyWiki(SearchWikiMixin, ExportWikiMixin):
         """A TiddlyWiki factory
         Returns a TiddlyWiki instance containing all tiddlers found in string buffer
         """
-        title, subtitle = cls.parse_title(buffer)
-        tiddly_wiki = cls(title=title, subtitle=subtitle)
+        with METRICS.span('parse'):
+            title, subtitle = cls.parse_title(buffer)
+            tiddly_wiki = cls(title=title, subtitle=subtitle)
 
-        for tiddler in Tiddler.finditer(buffer):
-            tiddly_wiki.add_tiddler(tiddler)
+            slots = []
+            for tiddler in Tiddler.finditer(buffer, slots):
+                tiddly_wiki.add_tiddler(tiddler)
+            # remembered for save_html
+            tiddly_wiki.set_source(buffer, slots)
 
         return tiddly_wiki
 
@@ -74,10 +96,13 @@ class TiddlyWiki(SearchWikiMixin, ExportWikiMixin):
         """A TiddlyWiki factory
         Returns a TiddlyWiki instance containing all tiddlers found in html_file
         """
-        with open(html_file, 'r', encoding='utf8') as html:
+        with METRICS.span('read', file=html_file), \
+                open(html_file, 'r', encoding='utf8') as html:
             buffer = html.read()
 
-        return cls.parse_from_string(buffer)
+        tiddly_wiki = cls.parse_from_string(buffer)
+        tiddly_wiki.source_path = html_file
+        return tiddly_wiki
 
     def apply(self, algorithm):
         return algorithm.evaluate(self)
@@ -0,0 +1,437 @@
+"""a resident wiki daemon serving queries and exports over a unix domain socket
+
+    python wikidaemon.py --socket /tmp/pytiddlywiki.sock ./example/tw5.html journal=./journal.html
+
+the wikis are parsed once and reloaded when their files change,
+the tag and title indexes and the conversions of exported tiddlers are kept in memory.
+WikiClient offers the query and export methods of SearchWikiMixin and ExportWikiMixin.
+
+protocol: one json object per line in both directions, e.g.
+
+    {"method": "finditer", "wiki": "tw5", "params": {"tags": ["journal"], "content": false}}
+    {"ok": true, "result": [{"title": "...", "tags": [...], "created": "2018-01-08T22:25:50", ...}]}
+    {"ok": false, "error": "IndexError", "message": "no tiddler satisfies the predicates"}
+"""
+import argparse
+import builtins
+import datetime
+import json
+import operator
+import os
+import random
+import re
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from algorithm import reservoir_sample
+from exportwiki import ExportCache
+from instrumentation import METRICS, NullProgress
+from tiddler import Tiddler
+from tiddlywiki import TiddlyWiki
+
+
+DEFAULT_SOCKET = '/tmp/pytiddlywiki.sock'
+
+STANDARD_ATTRIBUTES = {'content', 'title', 'tags', 'created', 'modified', 'type_'}
+
+
+def tiddler_to_json(tiddler, content=True):
+    '''returns the json representation of tiddler used by the protocol.'''
+    result = {'title': tiddler.title,
+              'tags': tiddler.tags,
+              'created': None if tiddler.created is None else tiddler.created.isoformat(),
+              'modified': None if tiddler.modified is None else tiddler.modified.isoformat(),
+              'type': tiddler.type_,
+              'fields': {key: value for key, value in vars(tiddler).items()
+                         if not key.startswith('_') and key not in STANDARD_ATTRIBUTES
+                         and isinstance(value, (str, int, float, bool))}}
+    if content:
+        result['content'] = tiddler.content
+    return result
+
+
+def tiddler_from_json(data):
+    '''returns a Tiddler of the json representation data, with content None if it was not sent.'''
+    def date(value):
+        return None if value is None else datetime.datetime.fromisoformat(value)
+
+    return Tiddler(data.get('content'), title=data['title'], tags=data['tags'],
+                   created=date(data['created']), modified=date(data['modified']),
+                   type=data['type'], **data['fields'])
+
+
+class LoadedWiki:
+    """A TiddlyWiki parsed from path, with a title and a tag index."""
+
+    def __init__(self, name, path, conversion_cache):
+        self.name = name
+        self.path = path
+        self.conversion_cache = conversion_cache
+        self.mtime = None
+        self.load()
+
+    def load(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        with METRICS.span('daemon_load', wiki=self.name):
+            wiki = TiddlyWiki.parse_from_html(self.path)
+            wiki.conversion_cache = self.conversion_cache
+            titles, tags = {}, {}
+            for tiddler in wiki:
+                titles.setdefault(tiddler.title, []).append(tiddler)
+                for tag in tiddler.tags:
+                    tags.setdefault(tag, []).append(tiddler)
+        # replaced at once, requests being served keep the previous wiki
+        self.wiki, self.titles, self.tags, self.mtime = wiki, titles, tags, mtime
+
+    def changed(self):
+        try:
+            return os.stat(self.path).st_mtime_ns != self.mtime
+        except FileNotFoundError:
+            return False  # e.g. while the file is replaced
+
+    def select(self, tags=(), title=None, type=None, pattern=None):
+        '''returns the tiddlers (in wiki order) having all tags, the title and the type,
+        whose content matches the regular expression pattern (case-insensitive).
+        the candidates are taken from the smallest matching index.
+        '''
+        if isinstance(tags, str):
+            tags = [tags]
+        candidates = [self.tags.get(tag, []) for tag in tags]
+        if title is not None:
+            candidates.append(self.titles.get(title, []))
+
+        if candidates:
+            tiddlers = min(candidates, key=len)
+        else:
+            tiddlers = self.wiki.tiddlers
+        regex = None if pattern is None else re.compile(pattern, re.IGNORECASE)
+
+        return [t for t in tiddlers
+                if all(tag in t.tags for tag in tags)
+                and (title is None or t.title == title)
+                and (type is None or t.type_ == type)
+                and (regex is None or regex.search(t.content))]
+
+
+class WikiDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves the wikis of paths over the unix domain socket socket_path.
+    paths are file paths or name=path pairs, the name defaulting to the file name without extension.
+    changed files are reloaded before answering a request, at most every poll_interval seconds.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, paths, socket_path=DEFAULT_SOCKET, poll_interval=1.0, cache_size=4096):
+        if os.path.exists(socket_path):
+            self.__remove_stale_socket(socket_path)
+        self.socket_path = socket_path
+        self.poll_interval = poll_interval
+        self.conversion_cache = ExportCache(cache_size)
+        self.wikis = {}
+        for path in paths:
+            name, _, path = path.rpartition('=')
+            name = name or os.path.splitext(os.path.basename(path))[0]
+            self.wikis[name] = LoadedWiki(name, path, self.conversion_cache)
+
+        self.__lock = threading.Lock()
+        self.__last_poll = 0.0
+
+        super().__init__(socket_path, WikiRequestHandler)
+
+    @staticmethod
+    def __remove_stale_socket(socket_path):
+        # a socket left behind by a previous daemon is removed, the one of a running daemon is not
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(socket_path)
+            except ConnectionRefusedError:
+                os.remove(socket_path)
+                return
+            except FileNotFoundError:
+                return
+        raise WikiDaemonError('a daemon is already serving {}'.format(socket_path))
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def reload(self, force=False):
+        '''reloads the changed wikis (all wikis if force is True), returns their names.'''
+        with self.__lock:
+            reloaded = []
+            for name, loaded in self.wikis.items():
+                if force or loaded.changed():
+                    loaded.load()
+                    METRICS.count('daemon_reloads', wiki=name)
+                    reloaded.append(name)
+            return reloaded
+
+    def __poll(self):
+        now = time.monotonic()
+        if now - self.__last_poll >= self.poll_interval:
+            self.__last_poll = now
+            self.reload()
+
+    def __wiki(self, name):
+        if name is None:
+            if len(self.wikis) != 1:
+                raise ValueError('several wikis are served, choose one of: ' + ', '.join(self.wikis))
+            return next(iter(self.wikis.values()))
+        try:
+            return self.wikis[name]
+        except KeyError:
+            raise KeyError('no wiki named {!r}'.format(name)) from None
+
+    def __selection(self, loaded, titles, tags, title, type, pattern):
+        if titles is None:
+            return loaded.select(tags, title, type, pattern), None
+        # an explicit (already sorted) selection of the client
+        order = {name: position for position, name in enumerate(titles)}
+        tiddlers = [t for name in order for t in loaded.titles.get(name, [])]
+        return tiddlers, lambda t: order[t.title]
+
+    def handle_request_data(self, request):
+        '''answers one request of the protocol, returns the json-serializable result.'''
+        method = request['method']
+        params = request.get('params') or {}
+        if method == 'ping':
+            return 'pong'
+        if method == 'wikis':
+            return {name: {'path': loaded.path, 'title': loaded.wiki.title,
+                           'subtitle': loaded.wiki.subtitle, 'tiddlers': len(loaded.wiki)}
+                    for name, loaded in self.wikis.items()}
+        if method == 'reload':
+            return self.reload(force=params.get('force', False))
+        if method == 'metrics':
+            return METRICS.summary()
+        if method == 'shutdown':
+            # shutdown blocks until serve_forever returns, which waits for this request
+            threading.Thread(target=self.shutdown).start()
+            return None
+
+        self.__poll()
+        loaded = self.__wiki(request.get('wiki'))
+
+        filters = {key: params.get(key) for key in ('tags', 'title', 'type', 'pattern')}
+        filters['tags'] = filters['tags'] or ()
+
+        if method == 'finditer':
+            tiddlers = loaded.select(**filters)
+            if params.get('limit') is not None:
+                tiddlers = tiddlers[:params['limit']]
+            return [tiddler_to_json(t, params.get('content', True)) for t in tiddlers]
+
+        if method == 'find_tiddler':
+            tiddlers = loaded.select(**filters)
+            return tiddler_to_json(tiddlers[0]) if tiddlers else None
+
+        if method == 'get_random_tiddler':
+            sample = reservoir_sample(loaded.select(**filters), 1, random)
+            if not sample:
+                raise IndexError('no tiddler satisfies the predicates')
+            return tiddler_to_json(sample[0])
+
+        if method in {'export_to_file', 'open_in_browser', 'export_to_pdf_chunked'}:
+            tiddlers, order = self.__selection(loaded, params.pop('titles', None), **filters)
+            selected = {id(t) for t in tiddlers}
+            kwargs = {key: value for key, value in params.items() if key not in filters}
+            kwargs['predicates'] = [lambda t: id(t) in selected]
+            # callables cannot be sent, the sort key is an attribute name
+            kwargs['key'] = order or operator.attrgetter(kwargs.get('key', 'created'))
+            args = kwargs.pop('extra_args', [])
+            if method == 'open_in_browser':
+                return getattr(loaded.wiki, method)(*args, **kwargs)
+            path = kwargs.pop('path')
+            result = getattr(loaded.wiki, method)(path, *args, **kwargs)
+            if method == 'export_to_pdf_chunked':
+                return [t.title for t in result]
+            return None
+
+        raise ValueError('unknown method {!r}'.format(method))
+
+
+class WikiRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                with METRICS.span('daemon_request', method=request.get('method')):
+                    response = {'ok': True, 'result': self.server.handle_request_data(request)}
+            except Exception as error:
+                response = {'ok': False, 'error': type(error).__name__, 'message': str(error)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class WikiDaemonError(RuntimeError):
+    """An error raised by the daemon, which is no builtin exception."""
+
+
+class WikiClient:
+    """A thin client of WikiDaemon with the query and export methods of
+    SearchWikiMixin and ExportWikiMixin, e.g.
+
+        wiki = WikiClient(wiki='tw5')
+        journal = list(wiki.finditer(tags='journal'))
+        wiki.export_to_file('./tw5_journal.pdf', '--toc', tags='journal')
+
+    the keyword filters tags, title, type and pattern (a regular expression searched in the content)
+    are evaluated by the daemon, predicates and callable keys by the client,
+    which then sends the titles of the selected tiddlers.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, wiki=None, timeout=None):
+        self.socket_path = socket_path
+        self.wiki = wiki
+        self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__socket.settimeout(timeout)
+        self.__socket.connect(socket_path)
+        self.__file = self.__socket.makefile('rwb')
+        self.__lock = threading.Lock()
+
+    def close(self):
+        self.__file.close()
+        self.__socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def call(self, method, **params):
+        '''sends one request, returns its result or raises its error.'''
+        request = {'method': method, 'wiki': self.wiki, 'params': params}
+        with self.__lock:
+            self.__file.write(json.dumps(request).encode('utf-8') + b'\n')
+            self.__file.flush()
+            line = self.__file.readline()
+        if not line:
+            raise ConnectionError('the daemon closed the connection')
+        response = json.loads(line)
+        if response['ok']:
+            return response['result']
+
+        error = getattr(builtins, response['error'], None)
+        if not (isinstance(error, type) and issubclass(error, Exception)):
+            error = WikiDaemonError
+        raise error(response['message'])
+
+    @property
+    def title(self):
+        return self.__info()['title']
+
+    @property
+    def subtitle(self):
+        return self.__info()['subtitle']
+
+    def __info(self):
+        wikis = self.call('wikis')
+        return wikis[self.wiki] if self.wiki is not None else next(iter(wikis.values()))
+
+    def __len__(self):
+        return self.__info()['tiddlers']
+
+    def __iter__(self):
+        return self.finditer()
+
+    def finditer(self, *predicates, tags=(), title=None, type=None, pattern=None):
+        for data in self.call('finditer', tags=tags, title=title, type=type, pattern=pattern):
+            tiddler = tiddler_from_json(data)
+            if all(p(tiddler) for p in predicates):
+                yield tiddler
+
+    def find_tiddler(self, *predicates, tags=(), title=None, type=None, pattern=None):
+        if predicates:
+            return next(self.finditer(*predicates, tags=tags, title=title, type=type, pattern=pattern), None)
+        data = self.call('find_tiddler', tags=tags, title=title, type=type, pattern=pattern)
+        return None if data is None else tiddler_from_json(data)
+
+    def get_random_tiddler(self, *predicates, tags=(), title=None, type=None, pattern=None):
+        if predicates:
+            sample = reservoir_sample(self.finditer(*predicates, tags=tags, title=title,
+                                                    type=type, pattern=pattern), 1)
+            if not sample:
+                raise IndexError('no tiddler satisfies the predicates')
+            return sample[0]
+        return tiddler_from_json(self.call('get_random_tiddler', tags=tags, title=title,
+                                           type=type, pattern=pattern))
+
+    def __export_params(self, predicates, key, reverse, limit, filters):
+        if predicates is None and isinstance(key, str):
+            return dict(filters, key=key, reverse=reverse, limit=limit)
+        # selected and sorted here, the daemon exports the tiddlers in the order of titles
+        tiddlers = list(self.finditer(*(predicates or ()), **filters))
+        if isinstance(key, str):
+            key = operator.attrgetter(key)
+        tiddlers.sort(key=key, reverse=reverse)
+        if limit is not None:
+            tiddlers = tiddlers[:limit]
+        return {'titles': [t.title for t in tiddlers]}
+
+    def export_to_file(self, path, *extra_args, format=None, predicates=None, key='created',
+                       reverse=False, limit=None, backend='markdown', assets_dir=None,
+                       tags=(), title=None, type=None, pattern=None):
+        '''see ExportWikiMixin.export_to_file, path is a path on the host of the daemon.'''
+        params = self.__export_params(predicates, key, reverse, limit,
+                                      dict(tags=tags, title=title, type=type, pattern=pattern))
+        self.call('export_to_file', path=os.path.abspath(path), extra_args=extra_args, format=format,
+                  backend=backend, assets_dir=assets_dir and os.path.abspath(assets_dir), **params)
+
+    def open_in_browser(self, *extra_args, format='html', predicates=None, key='created',
+                        reverse=False, limit=None, backend='markdown',
+                        tags=(), title=None, type=None, pattern=None):
+        params = self.__export_params(predicates, key, reverse, limit,
+                                      dict(tags=tags, title=title, type=type, pattern=pattern))
+        self.call('open_in_browser', extra_args=extra_args, format=format, backend=backend, **params)
+
+    def export_to_pdf_chunked(self, path, *extra_args, predicates=None, key='created', reverse=False,
+                              limit=None, chunk_by='count', chunk_size=200, max_workers=None,
+                              retries=1, backend='markdown', tags=(), title=None, type=None, pattern=None):
+        '''see ExportChunkedMixin.export_to_pdf_chunked, chunk_by is 'count', 'month' or 'tag'.
+        returns the titles of the tiddlers that could not be exported.
+        '''
+        params = self.__export_params(predicates, key, reverse, limit,
+                                      dict(tags=tags, title=title, type=type, pattern=pattern))
+        return self.call('export_to_pdf_chunked', path=os.path.abspath(path), extra_args=extra_args,
+                         chunk_by=chunk_by, chunk_size=chunk_size, max_workers=max_workers,
+                         retries=retries, backend=backend, **params)
+
+    def reload(self, force=False):
+        return self.call('reload', force=force)
+
+    def metrics(self):
+        return self.call('metrics')
+
+    def shutdown(self):
+        self.call('shutdown')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('paths', nargs='+', metavar='[name=]path', help='html files of the wikis')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET)
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='seconds between checks for changed files')
+    parser.add_argument('--cache-size', type=int, default=4096, help='number of cached conversions')
+    args = parser.parse_args(argv)
+
+    METRICS.progress = NullProgress()
+    with WikiDaemon(args.paths, args.socket, args.poll_interval, args.cache_size) as daemon:
+        print('serving {} on {}'.format(', '.join(daemon.wikis), args.socket), file=sys.stderr)
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
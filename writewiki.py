@@ -0,0 +1,315 @@
+import json
+import os
+import re
+import tempfile
+
+from instrumentation import METRICS
+from tiddler import Tiddler
+
+
+class WriteWikiMixin:
+    """Writes a TiddlyWiki back to html (spliced into the parsed html), to json and to .tid files.
+
+    Writes are incremental: a tiddler is encoded again only if it changed since it was parsed
+    or last encoded. Unchanged tiddlers and all html around them (including the skipped system
+    tiddlers) are written as zero-copy slices of the parsed html.
+
+    As parsed, the content of tiddlers is html-escaped (see Tiddler.finditer), and so are the fields
+    of tiddlers of the <div> store area. Fields of added tiddlers and of tiddlers of the json store are not.
+    """
+
+    RE_STORE_AREA = re.compile('<div id="storeArea"[^<>]*>')
+    RE_ATTRIBUTE = re.compile('\\s(?P<key>[^\\s=<>]+)="(?P<value>[^"]*)"')
+
+    # attributes of Tiddler which are not written as fields
+    STANDARD_ATTRIBUTES = {'content', 'title', 'tags', 'created', 'modified', 'type_'}
+
+    def set_source(self, buffer=None, slots=(), path=None):
+        """remembers the parsed html buffer and the slots of its stored tiddlers (see Tiddler.finditer),
+        together with a fingerprint of each parsed tiddler, to write them back with save_html.
+        """
+        self.source_path = path
+        self.__source = buffer
+        self.__source_bytes = None
+        self.__offsets = None
+        self.__slots = list(slots)
+        self.__origin = {tiddler: (kind, self.fingerprint(tiddler), start, end)
+                         for kind, start, end, tiddler in self.__slots if tiddler is not None}
+        # format -> {tiddler: (fingerprint, encoding)}
+        self.__encoded = {'div': {}, 'json': {}, 'tid': {}}
+        # directory -> {tiddler: file name}
+        self.__tid_files = {}
+
+    def set_source_of(self, wiki, replaced=None):
+        """takes over the parsed html of wiki, e.g. of ours in a merge, so that this wiki is saved
+        into it with save_html. replaced maps tiddlers of this wiki to the tiddlers of wiki whose place
+        in the store area they take: they are written there, encoded again if they differ.
+        """
+        self.set_source(wiki.__source, (), wiki.source_path)
+        places = {original: tiddler for tiddler, original in (replaced or {}).items()}
+        self.__slots = [(kind, start, end, places.get(tiddler, tiddler))
+                        for kind, start, end, tiddler in wiki.__slots]
+        # the fingerprints stay those of the parsed tiddlers
+        self.__origin = {places.get(tiddler, tiddler): origin for tiddler, origin in wiki.__origin.items()}
+
+    @staticmethod
+    def fingerprint(tiddler):
+        '''a snapshot of the attributes of tiddler, compared by identity of their values (i.e. fast).
+        the tags are copied, as they are usually changed in place.
+        '''
+        attributes = vars(tiddler)
+        if '_digest' in attributes:  # a cache of BinaryTiddler
+            attributes = {key: value for key, value in attributes.items() if key != '_digest'}
+        return tuple(tiddler.tags), tuple(attributes.items())
+
+    def fields(self, tiddler):
+        """returns the fields of tiddler as TiddlyWiki stores them: unescaped strings, content as 'text'.
+        fields that are not parsed (e.g. tmap.id, whose name is no identifier) are kept from the parsed html,
+        and so are the created and modified strings whose dates did not change
+        (string_to_date drops their milliseconds).
+        """
+        origin = self.__origin.get(tiddler)
+        escaped = origin is not None and origin[0] == 'div'
+
+        def unescape(value):
+            return Tiddler.unescape_html(value) if escaped else value
+
+        original = self.__original_fields(origin)
+        fields = {key: value for key, value in original.items() if not key.isidentifier()}
+        fields['title'] = unescape(tiddler.title)
+        for key in ('created', 'modified'):
+            date = getattr(tiddler, key)
+            if date is None:
+                continue
+            if key in original and Tiddler.string_to_date(original[key]) == date:
+                fields[key] = original[key]
+            else:
+                fields[key] = Tiddler.date_to_string(date)
+        if tiddler.tags:
+            fields['tags'] = unescape(Tiddler.get_tag_string(tiddler.tags))
+        if tiddler.type_ is not None:
+            fields['type'] = tiddler.type_
+        for key, value in vars(tiddler).items():
+            if key.startswith('_') or key in self.STANDARD_ATTRIBUTES or value is None:
+                continue
+            fields[key] = unescape(str(value))
+        fields['text'] = Tiddler.unescape_html(tiddler.content or '')
+        return fields
+
+    def __original_fields(self, origin):
+        if origin is None:
+            return {}
+        kind, _, start, end = origin
+        if kind == 'div':
+            options = self.__source[start:self.__source.index('>', start)]
+            return {match.group('key'): Tiddler.unescape_html(match.group('value'))
+                    for match in self.RE_ATTRIBUTE.finditer(options)}
+        return json.loads(self.__source[start:end])
+
+    def encode_div(self, tiddler):
+        '''returns the <div> store area element of tiddler.'''
+        fields = self.fields(tiddler)
+        text = fields.pop('text')
+        options = ''.join(' {}="{}"'.format(key, Tiddler.html_encode(value))
+                          for key, value in sorted(fields.items()))
+        return '<div{}>\n<pre>{}</pre>\n</div>'.format(options, Tiddler.html_encode(text)).encode('utf-8')
+
+    def encode_json(self, tiddler):
+        '''returns the json object of tiddler, as in the json store and json exports of TiddlyWiki.'''
+        # < is escaped as TiddlyWiki does, so that the json store cannot end its <script> element
+        return json.dumps(self.fields(tiddler), ensure_ascii=False).replace('<', '\\u003C').encode('utf-8')
+
+    def encode_tid(self, tiddler):
+        '''returns the .tid file of tiddler: one "field: value" line per field, a blank line and the text.'''
+        fields = self.fields(tiddler)
+        text = fields.pop('text')
+        header = ''.join('{}: {}\n'.format(key, value) for key, value in sorted(fields.items()))
+        return (header + '\n' + text).encode('utf-8')
+
+    def __encode(self, tiddler, format):
+        # returns the encoding of tiddler in format ('div', 'json' or 'tid'),
+        # i.e. a slice of the parsed html or a cached encoding, if tiddler has not changed
+        fingerprint = self.fingerprint(tiddler)
+        origin = self.__origin.get(tiddler)
+        if origin is not None and origin[0] == format and origin[1] == fingerprint:
+            return self.__bytes(origin[2], origin[3])
+
+        cache = self.__encoded[format]
+        cached = cache.get(tiddler)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+
+        METRICS.count('tiddlers_encoded', format=format)
+        encoded = {'div': self.encode_div, 'json': self.encode_json, 'tid': self.encode_tid}[format](tiddler)
+        cache[tiddler] = (fingerprint, encoded)
+        return encoded
+
+    def __bytes(self, start, end):
+        # a zero-copy slice of the parsed html, at the byte offsets of the character offsets start and end
+        if self.__source_bytes is None:
+            self.__source_bytes = memoryview(self.__source.encode('utf-8'))
+            if len(self.__source_bytes) != len(self.__source):
+                # not ascii: the byte offsets of all slot boundaries are computed once
+                positions = {0, len(self.__source)} | {position for slot in self.__slots for position in slot[1:3]}
+                if not any(slot[0] == 'json_store' for slot in self.__slots):
+                    positions.add(self.__insert_position())
+                positions = sorted(positions)
+                self.__offsets, offset, previous = {}, 0, 0
+                for position in positions:
+                    offset += len(self.__source[previous:position].encode('utf-8'))
+                    self.__offsets[position] = offset
+                    previous = position
+        if self.__offsets is None:
+            return self.__source_bytes[start:end]
+        return self.__source_bytes[self.__offsets[start]:self.__offsets[end]]
+
+    def __insert_position(self):
+        # tiddlers added to a wiki without json store are inserted after the last <div> tiddler
+        divs = [end for kind, start, end, tiddler in self.__slots if kind == 'div']
+        if divs:
+            return divs[-1]
+        match = self.RE_STORE_AREA.search(self.__source)
+        if match is None:
+            raise ValueError('the parsed html has no store area')
+        return match.end()
+
+    def __html_chunks(self):
+        tiddlers = set(self)
+        added = [tiddler for tiddler in self if tiddler not in self.__origin]
+
+        # the json elements are grouped by store and joined again,
+        # so that removed tiddlers leave no dangling commas
+        stores = []
+        for kind, start, end, tiddler in self.__slots:
+            if kind == 'json_store':
+                stores.append((start, end, []))
+            elif kind == 'json':
+                stores[-1][2].append((start, end, tiddler))
+
+        if stores:
+            stores[-1][2].extend((None, None, tiddler) for tiddler in added)
+            boundaries = [(start, end, 'json', elements) for start, end, elements in stores]
+        else:
+            insert = self.__insert_position()
+            boundaries = [(insert, insert, 'div', [(None, None, tiddler) for tiddler in added])]
+        boundaries += [(start, end, kind, [(start, end, tiddler)])
+                       for kind, start, end, tiddler in self.__slots if kind == 'div']
+        boundaries.sort(key=lambda boundary: (boundary[0], boundary[1]))
+
+        pos = 0
+        for start, end, kind, elements in boundaries:
+            yield self.__bytes(pos, start)
+            pos = end
+            if kind == 'json':
+                yield b'['
+            first, previous_end = True, None
+            for element_start, element_end, tiddler in elements:
+                if tiddler is None:
+                    chunk = self.__bytes(element_start, element_end)  # skipped, e.g. a system tiddler
+                elif tiddler in tiddlers:
+                    chunk = self.__encode(tiddler, kind)
+                else:
+                    previous_end = None  # removed
+                    continue
+                if kind == 'json' and not first:
+                    # the separator between adjacent parsed elements is kept
+                    if previous_end is None or element_start is None:
+                        yield b',\n'
+                    else:
+                        yield self.__bytes(previous_end, element_start)
+                elif kind == 'div' and element_start is None:
+                    yield b'\n'
+                yield chunk
+                first, previous_end = False, element_end
+            if kind == 'json':
+                yield b']'
+        yield self.__bytes(pos, len(self.__source))
+
+    @staticmethod
+    def __write_atomic(path, chunks):
+        # written to a temporary file, which replaces path, so that path is never left half written
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as fh:
+            try:
+                for chunk in chunks:
+                    fh.write(chunk)
+            except BaseException:
+                fh.close()
+                os.remove(fh.name)
+                raise
+        os.replace(fh.name, path)
+
+    def save_html(self, path=None):
+        """writes the wiki to the html file path (by default the parsed file), splicing the tiddlers
+        into the store area of the parsed html: changed tiddlers are encoded again,
+        removed ones are left out and added ones are appended to the (last) store.
+        """
+        if self.__source is None:
+            raise ValueError('only a parsed TiddlyWiki can be saved as html, see export_json and export_tid')
+        path = path or self.source_path
+        if path is None:
+            raise ValueError('no path given and the TiddlyWiki was not parsed from a file')
+
+        with METRICS.span('save_html', path=path):
+            self.__write_atomic(path, self.__html_chunks())
+
+    def export_json(self, path, predicates=None):
+        """writes the (filtered) tiddlers to path as json array, the format of TiddlyWiki's json export,
+        which TiddlyWiki imports by drag and drop.
+        """
+        tiddlers = self.finditer(*predicates) if predicates else iter(self)
+
+        def chunks():
+            yield b'['
+            for i, tiddler in enumerate(tiddlers):
+                yield b',\n' if i else b''
+                yield self.__encode(tiddler, 'json')
+            yield b']'
+
+        with METRICS.span('export_json', path=path):
+            self.__write_atomic(path, chunks())
+
+    @staticmethod
+    def tid_file_name(title):
+        '''the file name of the .tid file of title: characters not allowed in file names are replaced by _.'''
+        name = re.sub('[<>:"/\\\\|?*\\x00-\\x1f]', '_', title).strip(' .')[:200]
+        return (name or '_') + '.tid'
+
+    def export_tid(self, directory, predicates=None):
+        """writes the (filtered) tiddlers to directory as .tid files, the format of TiddlyWiki on node.js.
+        only the files of changed tiddlers are written again, and the files of tiddlers removed since
+        the last export to directory are deleted. returns the number of written files.
+        """
+        os.makedirs(directory, exist_ok=True)
+        tiddlers = list(self.finditer(*predicates)) if predicates else list(self)
+        previous = self.__tid_files.get(directory, {})
+        files, names, written = {}, set(), 0
+
+        with METRICS.span('export_tid', directory=directory):
+            for tiddler in tiddlers:
+                name = self.tid_file_name(tiddler.title)
+                stem, n = name[:-4], 1
+                while name.lower() in names:  # e.g. titles differing in case or replaced characters
+                    n += 1
+                    name = '{} ({}).tid'.format(stem, n)
+                names.add(name.lower())
+                files[tiddler] = name
+
+                cached = self.__encoded['tid'].get(tiddler)
+                unchanged = (cached is not None and cached[0] == self.fingerprint(tiddler) and
+                             previous.get(tiddler) == name and os.path.exists(os.path.join(directory, name)))
+                if unchanged:
+                    continue
+                with open(os.path.join(directory, name), 'wb') as fh:
+                    fh.write(self.__encode(tiddler, 'tid'))
+                written += 1
+
+            for tiddler, name in previous.items():
+                if files.get(tiddler) != name and name.lower() not in names:
+                    try:
+                        os.remove(os.path.join(directory, name))
+                    except FileNotFoundError:
+                        pass
+
+        self.__tid_files[directory] = files
+        return written